@@ -1,27 +1,35 @@
 import asyncio
+import atexit
 import logging
 import os
-import sys
 
 from dotenv import load_dotenv
 
-from backend.connector import ChainConnector
+from backend.accounts import HealthFactorAccountsLoader
+from backend.connector import AsyncChainConnector, ChainConnector, HealthFactorMonitor
 from backend.database import Database
-from backend.notifier import Notifier
+from backend.logqueue import setup_logging
+from backend.metrics import start_metrics_server
+from backend.dispatcher import NotificationDispatcher
+from backend.incremental import HealthFactorWatcher
+from backend.notifier import AsyncNotifier, Notifier
+from backend.periodic import PeriodicSweeper
+from backend.ratelimit import configure_rate_limits, parse_rate_limits
+from backend.rpc_pool import RpcPool, load_rpc_urls
+from backend.scheduling import AdaptiveScheduler, HealthFactorStore
+from backend.sharding import LocalLeaseStore, SettingLeaseStore, ShardOwnership, run_workers
+from backend.tokens import TokenMetadataCache
+from backend.tracked import TrackedAccountsIndex
 from backend.types import Chain
 
 load_dotenv()
 
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s %(pathname)s %(levelname)s %(message)s',
-    handlers=[
-        logging.FileHandler("backend.log"),
-        logging.StreamHandler(sys.stdout),
-    ],
-    force=True,
-)
+# Setup logging. Records are written from a background thread, as JSON lines to LOG_FILE (rotated by size and age) and as text to stdout.
+# LOG_JSON=0 writes text to LOG_FILE too. Workers of the sharded mode write to their own files, since every process rotates its file.
+LOG_FILE = os.environ.get('LOG_FILE', 'backend.log')
+if os.environ.get('SHARD_WORKER_INDEX') is not None:
+    LOG_FILE = LOG_FILE.removesuffix('.log') + f'.{os.environ["SHARD_WORKER_INDEX"]}.log'
+atexit.register(setup_logging(LOG_FILE, json_file=os.environ.get('LOG_JSON', '1') == '1').stop)
 logging.getLogger('httpx').setLevel(logging.WARNING)
 logging.info('Starting backend')
 
@@ -38,42 +46,137 @@ LENDING_POOL_ADDRESSES = {  # Mapping of chain to its Aave v2 and v3 pool addres
 
 }
 
+# In the sharded mode (async only) SHARD_WORKERS workers split the pools into SHARD_ADDRESS_RANGES address ranges each.
+# Without SHARD_WORKER_INDEX this process runs all the workers as child processes. Workers on several hosts get distinct
+# SHARD_WORKER_INDEX values and hold their leases in the setting table. SHARD_LEASES=local keeps them in a local file instead.
+SHARD_WORKERS = int(os.environ.get('SHARD_WORKERS', '1'))
+SHARD_WORKER_INDEX = os.environ.get('SHARD_WORKER_INDEX')
+SHARD_ADDRESS_RANGES = int(os.environ.get('SHARD_ADDRESS_RANGES', '4'))
+if SHARD_WORKERS > 1 and SHARD_WORKER_INDEX is None:
+    run_workers(SHARD_WORKERS)
+
 database = Database(
     supabase_url=os.environ['SUPABASE_URL'],
     supabase_key=os.environ['SUPABASE_KEY'],
 )
 logging.info('Connected to database')
 notifier = Notifier(database=database)
+async_notifier = AsyncNotifier(
+    database=database,
+    dispatcher=NotificationDispatcher(),
+)
+tracked_index = TrackedAccountsIndex(database=database)
+token_cache = TokenMetadataCache(database=database)
+accounts_loader = HealthFactorAccountsLoader(database=database)
+
+# Async mode scans all chains concurrently. Set ASYNC_RPC=0 to fall back to blocking RPC calls.
+ASYNC_RPC = os.environ.get('ASYNC_RPC', '1') == '1'
+# With INCREMENTAL_HF_CHECK=1 (async only) health factors are rechecked every block for the accounts affected by new events.
+INCREMENTAL_HF_CHECK = os.environ.get('INCREMENTAL_HF_CHECK', '0') == '1'
+# In the adaptive mode (async only) every account is checked at its own interval, from every block to hourly, depending on its last health factor.
+# It replaces both the periodic and the incremental checks. Last health factors are saved to the health_factor table (backend/sql/health_factor.sql).
+ADAPTIVE_HF_CHECK = os.environ.get('ADAPTIVE_HF_CHECK', '0') == '1'
+# With RPC_POOL=1 (async only) each chain uses all urls of {chain}_HTTP_RPC (comma separated). Otherwise, or with a single url, only the first url is used.
+# RPC_POOL_PUBLIC_NODE=1 adds the public node of the chain from data/rpc_nodes.json, which is rate limited and often behind the head.
+RPC_POOL = os.environ.get('RPC_POOL', '0') == '1'
+RPC_POOL_PUBLIC_NODE = os.environ.get('RPC_POOL_PUBLIC_NODE', '0') == '1'
+rpc_pools: dict[Chain, RpcPool] = {}
+# With BATCH_RPC=1 (async only) log and block number calls of the V2 and V3 connectors of a chain are merged into JSON-RPC batches.
+# The block number is fetched once per tick and one eth_getLogs call serves both pools.
+BATCH_RPC = os.environ.get('BATCH_RPC', '0') == '1'
+# RPC_RATE_LIMITS sets the compute units per second of the paid RPC providers, e.g. `eth-mainnet.g.alchemy.com=330,polygon-mainnet.g.alchemy.com=330`.
+# Calls to a provider wait for its quota, liquidation alerts and at-risk health factor checks first.
+configure_rate_limits(parse_rate_limits(os.environ.get('RPC_RATE_LIMITS', '')))
+# Liquidations of a chain with {chain}_WS_RPC set (async only) are streamed through a websocket subscription instead of being polled.
+
+shards = None
+if SHARD_WORKERS > 1:
+    assert ASYNC_RPC and SHARD_WORKER_INDEX is not None
+    shards = ShardOwnership(
+        store=LocalLeaseStore('shard_leases.json') if os.environ.get('SHARD_LEASES') == 'local' else SettingLeaseStore(database),
+        worker_index=int(SHARD_WORKER_INDEX),
+        workers_count=SHARD_WORKERS,
+        pools=[(chain, aave_version) for chain, pool_addresses in LENDING_POOL_ADDRESSES.items() for aave_version, pool_address in zip((2, 3), pool_addresses) if pool_address is not None],
+        address_ranges=SHARD_ADDRESS_RANGES,
+    )
+    shards.renew()
 
-connectors: list[ChainConnector] = []
+
+def get_rpc_pool(chain: Chain) -> RpcPool | None:
+    """V2 and V3 connectors of a chain share its pool and so its endpoint statistics"""
+    if not RPC_POOL:
+        return None
+    if chain not in rpc_pools:
+        rpc_urls = load_rpc_urls(chain, os.environ[f'{chain.value}_HTTP_RPC'], include_public_node=RPC_POOL_PUBLIC_NODE)
+        if len(rpc_urls) < 2:
+            return None  # Nothing to hedge or fail over to, the direct provider is cheaper
+        rpc_pools[chain] = RpcPool(rpc_urls)
+    return rpc_pools[chain]
+
+
+def create_connector(chain: Chain, pool_address: str, aave_version: int) -> ChainConnector | AsyncChainConnector:
+    if ASYNC_RPC:
+        return AsyncChainConnector(
+            chain=chain,
+            http_rpc_url=os.environ[f'{chain.value}_HTTP_RPC'].split(',')[0],
+            notifier=async_notifier,
+            database=database,
+            pool_address=pool_address,
+            aave_version=aave_version,
+            tracked_index=tracked_index,
+            token_cache=token_cache,
+            rpc_pool=get_rpc_pool(chain),
+            accounts_loader=accounts_loader,
+            shards=shards,
+            ws_rpc_url=os.environ.get(f'{chain.value}_WS_RPC'),
+            batch_rpc=BATCH_RPC,
+        )
+    return ChainConnector(
+        chain=chain,
+        http_rpc_url=os.environ[f'{chain.value}_HTTP_RPC'].split(',')[0],
+        notifier=notifier,
+        database=database,
+        pool_address=pool_address,
+        aave_version=aave_version,
+    )
+
+
+def create_health_factor_monitor(connector: AsyncChainConnector) -> HealthFactorMonitor:
+    if ADAPTIVE_HF_CHECK:
+        return AdaptiveScheduler(connector, HealthFactorStore(database, connector.chain, connector.aave_version, shards))
+    if INCREMENTAL_HF_CHECK:
+        return HealthFactorWatcher(connector)
+    return PeriodicSweeper(connector)
+
+
+connectors: list[ChainConnector | AsyncChainConnector] = []
 for chain in Chain:
     v2_pool_address, v3_pool_address = LENDING_POOL_ADDRESSES[chain]
     if v2_pool_address is not None:
-        connectors.append(ChainConnector(
-            chain=chain,
-            http_rpc_url=os.environ[f'{chain.value}_HTTP_RPC'],
-            notifier=notifier,
-            database=database,
-            pool_address=v2_pool_address,
-            aave_version=2,
-        ))
+        connectors.append(create_connector(chain, v2_pool_address, aave_version=2))
     
     if v3_pool_address is not None:
-        connectors.append(ChainConnector(
-            chain=chain,
-            http_rpc_url=os.environ[f'{chain.value}_HTTP_RPC'],
-            notifier=notifier,
-            database=database,
-            pool_address=v3_pool_address,
-            aave_version=3,
-        ))
+        connectors.append(create_connector(chain, v3_pool_address, aave_version=3))
 
 logging.info('Created connectors')
 
+# Metrics are served on http://METRICS_HOST:METRICS_PORT/metrics. Workers of the sharded mode use the following ports.
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '9100')) + (int(SHARD_WORKER_INDEX) if SHARD_WORKER_INDEX is not None else 0)
+
 loop = asyncio.get_event_loop()
+loop.run_until_complete(start_metrics_server(METRICS_HOST, METRICS_PORT))
+if shards is not None:
+    loop.create_task(shards.run())
 for connector in connectors:
-    loop.create_task(connector.monitor_health_factor())
+    if isinstance(connector, AsyncChainConnector):
+        loop.create_task(connector.monitor_health_factor(create_health_factor_monitor(connector)))
+    else:
+        loop.create_task(connector.monitor_health_factor())
     loop.create_task(connector.monitor_liquidations())
 
 logging.info('Started monitoring tasks')
-loop.run_forever()
+try:
+    loop.run_forever()
+finally:
+    loop.run_until_complete(async_notifier.close())  # Sends the queued notifications, saves their timestamps and closes the OneSignal session
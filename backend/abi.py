@@ -0,0 +1,12 @@
+"""Contract ABIs of backend/abi. Every file is parsed once per process and shared by all connectors."""
+import functools
+import json
+
+ABI_DIR = './backend/abi'
+
+
+@functools.cache
+def load_abi(name: str) -> list[dict]:
+    """Parsed ABI of backend/abi/{name}.json. Must not be modified, the same list is returned to every caller."""
+    with open(f'{ABI_DIR}/{name}.json') as f:
+        return json.loads(f.read())
@@ -0,0 +1,67 @@
+import asyncio
+import logging
+import time
+
+from backend.columns import AccountTable
+from backend.database import HEALTH_FACTOR_NOTIFICATION_INTERVAL, Database
+from backend.types import Chain, ChainAccountWithAllData
+
+ACCOUNTS_SNAPSHOT_PERIOD = 60 * 30  # seconds, new accounts, changed thresholds and expired cooldowns are picked up after this
+
+PoolKey = tuple[Chain, int]  # (chain, aave version)
+
+
+class HealthFactorAccountsLoader():
+    """Loads the accounts to check of all chains and aave versions with one query instead of one per connector.
+    The snapshot is reused by the following sweeps until it is older than ACCOUNTS_SNAPSHOT_PERIOD.
+    Notified accounts are marked in it as soon as their notifications are queued, so a cached snapshot never returns
+    an account that is in its notification cooldown or whose notification is still being sent.
+    Accounts are kept in one AccountTable per pool, rows are turned into ChainAccountWithAllData only when asked for a list.
+    The periodic sweeps and the full sweeps of the incremental mode check the table, the adaptive scheduler asks for a list on reload.
+    In the sharded mode the snapshot is also reloaded when the owned shards change, because the cooldowns of the accounts
+    taken over were written by their previous owner after the snapshot was loaded.
+    """
+    def __init__(self, database: Database) -> None:
+        self.database = database
+        self.snapshot: dict[PoolKey, AccountTable] = {}
+        self.loaded_at: float | None = None
+        self.shards_generation = 0  # Generation of the owned shards when the snapshot was loaded
+        self.lock = asyncio.Lock()
+
+    def load(self) -> None:
+        snapshot: dict[PoolKey, AccountTable] = {}
+        accounts_count = 0
+        for accounts in self.database.iter_accounts_for_hf_check():
+            pages: dict[PoolKey, list[ChainAccountWithAllData]] = {}
+            for account in accounts:
+                pages.setdefault((account.account.chain, account.account.aave_version), []).append(account)
+            for key, page in pages.items():
+                if key not in snapshot:
+                    snapshot[key] = AccountTable(*key)
+                snapshot[key].append(page)
+            accounts_count += len(accounts)
+        for table in snapshot.values():
+            table.pack()
+        self.snapshot = snapshot
+        self.loaded_at = time.monotonic()
+        logging.info('Loaded %d accounts of %d pools for health factor checks', accounts_count, len(self.snapshot))
+
+    async def get_table(self, chain: Chain, aave_version: int, shards_generation: int = 0) -> AccountTable:
+        """shards_generation is ShardOwnership.generation in the sharded mode"""
+        async with self.lock:  # Connectors that start their sweeps together wait for one query
+            if self.loaded_at is None or time.monotonic() - self.loaded_at >= ACCOUNTS_SNAPSHOT_PERIOD or shards_generation != self.shards_generation:
+                self.shards_generation = shards_generation
+                await asyncio.to_thread(self.load)
+            return self.snapshot.get((chain, aave_version), AccountTable(chain, aave_version))
+
+    async def get(self, chain: Chain, aave_version: int, shards_generation: int = 0) -> list[ChainAccountWithAllData]:
+        table = await self.get_table(chain, aave_version, shards_generation)
+        return table.to_accounts(table.get_active_rows(time.time() - HEALTH_FACTOR_NOTIFICATION_INTERVAL))
+
+    def forget(self, accounts: list[ChainAccountWithAllData]) -> None:
+        """Must be called after notifying the accounts"""
+        notified_at = time.time()
+        for key, table in self.snapshot.items():
+            notified = [account for account in accounts if (account.account.chain, account.account.aave_version) == key]
+            if len(notified) > 0:
+                table.mark_notified(table.find_rows(notified), notified_at)
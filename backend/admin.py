@@ -1,18 +1,30 @@
 import logging
 import os
+from typing import TYPE_CHECKING
 
-from aiogram import Bot
 from dotenv import load_dotenv
 
+if TYPE_CHECKING:
+    from aiogram import Bot
+
 load_dotenv()
 
-TG_BOT_TOKEN = os.environ['TG_BOT_TOKEN']
 TG_ADMIN_ID = 327150749
 
-bot = Bot(token=TG_BOT_TOKEN, parse_mode='HTML')
+_bot: 'Bot | None' = None
+
+
+def get_bot() -> 'Bot':
+    """The bot is created on the first admin message. Importing aiogram is a noticeable part of the startup time."""
+    global _bot
+    if _bot is None:
+        from aiogram import Bot
+        _bot = Bot(token=os.environ['TG_BOT_TOKEN'], parse_mode='HTML')
+    return _bot
+
 
 async def send_admin_message(text: str):
     try:
-        await bot.send_message(TG_ADMIN_ID, text)
+        await get_bot().send_message(TG_ADMIN_ID, text)
     except Exception:
         logging.error('Couldnt send a telegram notification')
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+from aiohttp import ClientResponseError
+from web3 import AsyncWeb3
+from web3.types import FilterParams, LogReceipt
+
+from backend.jsonrpc import JsonRpcBatcher
+from backend.rpc import get_semaphore
+
+BACKFILL_CONCURRENCY = 4  # How many ranges are fetched at once before they are processed and checkpointed
+MIN_BLOCK_RANGE = 10
+MAX_BLOCK_RANGE = 5000
+BLOCK_RANGE_GROWTH = 1.5  # Block range is multiplied by this after every successful full range
+REFUSED_RANGE_MESSAGES = (  # Lowercase parts of the errors of providers that refuse a range or the size of its result
+    'query returned more than',  # Infura, -32005 query returned more than 10000 results
+    'log response size exceeded',  # Alchemy, -32602
+    'limited to',  # QuickNode, -32602 eth_getLogs is limited to a 10,000 range
+    'block range',  # Geth based nodes, Ankr, publicnode, e.g. -32000 block range is too wide, exceed maximum block range: 50000
+    'range too large',  # Erigon
+    'too many results',
+    'max results',  # llamarpc, -32000 query exceeds max results 20000
+    'response size',
+    'query timeout',  # Blast, -32000 query timeout exceeded, consider reducing your block range
+)
+
+
+def is_refused_range_error(exception: Exception) -> bool:
+    """Whether the provider refused the range (too many results, range too wide), so a smaller one may succeed.
+    Other errors, like outages or rate limits, are raised.
+    """
+    if isinstance(exception, ClientResponseError):
+        return exception.status == 413
+    if isinstance(exception, ValueError):
+        # web3 raises ValueError with the RPC error payload, e.g. {'code': -32005, 'message': 'query returned more than 10000 results'}
+        message = str(exception).lower()
+        return any(refused_range_message in message for refused_range_message in REFUSED_RANGE_MESSAGES)
+    return False
+
+
+class LogBackfiller():
+    """Fetches logs of a long block range with several concurrent eth_getLogs calls.
+    The range of a single call grows while the provider accepts it and is halved when the provider refuses it.
+    A range that times out is split once, a half that times out again is raised like other errors.
+    Logs are processed in block order and progress is checkpointed after every window of concurrent ranges,
+    so a restart continues from the last processed block instead of from the beginning.
+    With a JSON-RPC batcher the calls are merged with the ones of the other connectors of the endpoint.
+    """
+    def __init__(self, web3: AsyncWeb3, rpc_url: str, block_range: int, json_rpc: JsonRpcBatcher | None = None) -> None:
+        self.web3 = web3
+        self.rpc_url = rpc_url
+        self.block_range = block_range
+        self.json_rpc = json_rpc
+
+    async def get_logs(self, filter_params: FilterParams, from_block: int, to_block: int, timed_out: bool = False) -> list[LogReceipt]:
+        try:
+            async with get_semaphore(self.rpc_url):
+                range_filter_params: FilterParams = {**filter_params, 'fromBlock': from_block, 'toBlock': to_block}
+                if self.json_rpc is not None:
+                    logs = await self.json_rpc.get_logs(range_filter_params)
+                else:
+                    logs = await self.web3.eth.get_logs(range_filter_params)
+        except Exception as e:
+            is_first_timeout = isinstance(e, asyncio.TimeoutError) and not timed_out
+            if not (is_refused_range_error(e) or is_first_timeout) or from_block == to_block:
+                raise
+            timed_out = timed_out or is_first_timeout
+            middle = (from_block + to_block) // 2
+            self.block_range = max(MIN_BLOCK_RANGE, min(self.block_range, middle - from_block + 1))
+            logging.info('Splitting blocks %d-%d on %s after %r. Block range is now %d', from_block, to_block, self.rpc_url, e, self.block_range)
+            first_half, second_half = await asyncio.gather(
+                self.get_logs(filter_params, from_block, middle, timed_out),
+                self.get_logs(filter_params, middle + 1, to_block, timed_out),
+            )
+            return first_half + second_half
+
+        if to_block - from_block + 1 >= self.block_range:
+            self.block_range = min(MAX_BLOCK_RANGE, int(self.block_range * BLOCK_RANGE_GROWTH))
+        return list(logs)
+
+    async def backfill(
+            self,
+            filter_params: FilterParams,
+            from_block: int,
+            to_block: int,
+            process_logs: Callable[[list[LogReceipt]], Awaitable[None]],
+            checkpoint: Callable[[int], Awaitable[None]],
+    ) -> int:
+        """Fetch and process logs of blocks from_block..to_block (inclusive). Returns the number of processed logs."""
+        logs_count = 0
+        next_block = from_block
+        while next_block <= to_block:
+            ranges = []
+            for _ in range(BACKFILL_CONCURRENCY):
+                if next_block > to_block:
+                    break
+                range_end = min(to_block, next_block + self.block_range - 1)
+                ranges.append((next_block, range_end))
+                next_block = range_end + 1
+
+            results = await asyncio.gather(*(self.get_logs(filter_params, start, end) for start, end in ranges))
+            for logs in results:
+                await process_logs(logs)
+                logs_count += len(logs)
+            await checkpoint(ranges[-1][1])
+
+        return logs_count
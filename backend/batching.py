@@ -0,0 +1,77 @@
+import asyncio
+import logging
+
+from aiohttp import ClientResponseError
+from web3.contract import AsyncContract
+from web3.exceptions import ContractLogicError
+
+from backend.metrics import MULTICALL_BATCH_SECONDS
+from backend.rpc import get_semaphore, rpc_host
+
+MIN_BATCH_SIZE = 10
+MAX_BATCH_SIZE = 500
+BATCH_SIZE_GROWTH = 1.25  # Batch size is multiplied by this after every successful full batch
+BATCH_TIMEOUT = 20  # seconds
+
+
+def is_oversized_batch_error(exception: Exception) -> bool:
+    """Whether the batch may succeed if it is split in smaller parts. Outages (5xx, connection errors) are not, they are raised."""
+    if isinstance(exception, ContractLogicError):
+        return True  # aggregate3 with allowFailure only reverts as a whole when it runs out of gas
+    if isinstance(exception, ClientResponseError):
+        return exception.status == 413
+    if isinstance(exception, ValueError):
+        # web3 raises ValueError with the RPC error payload, e.g. {'code': -32000, 'message': 'out of gas'}
+        message = str(exception).lower()
+        return 'gas' in message or 'too large' in message or 'size limit' in message
+    return False
+
+
+class MulticallBatcher():
+    """Executes many calls through Multicall3.aggregate3.
+    Batches are sent concurrently, limited by the semaphore of the RPC host.
+    The batch size grows while batches succeed and a batch that runs out of gas is split in half. A batch that times out
+    is split once, a half that times out again is raised like other errors, so an unavailable node fails the sweep.
+    A single failing call doesn't fail its batch, its result is just None.
+    """
+    def __init__(self, multicall_contract: AsyncContract, rpc_url: str, batch_size: int) -> None:
+        self.multicall_contract = multicall_contract
+        self.rpc_url = rpc_url
+        self.batch_size = batch_size
+
+    async def aggregate(self, calls: list[tuple[str, bytes]]) -> list[bytes | None]:
+        """Execute (target, calldata) calls and return their raw results in the same order"""
+        batch_size = self.batch_size
+        batches = [calls[i:i + batch_size] for i in range(0, len(calls), batch_size)]
+        results = await asyncio.gather(*(self.execute_batch(batch) for batch in batches))
+        return [result for batch_results in results for result in batch_results]
+
+    async def execute_batch(self, calls: list[tuple[str, bytes]], timed_out: bool = False) -> list[bytes | None]:
+        """timed_out is set for the halves of a batch that timed out"""
+        try:
+            async with get_semaphore(self.rpc_url):
+                with MULTICALL_BATCH_SECONDS.time(host=rpc_host(self.rpc_url)):
+                    response = await asyncio.wait_for(
+                        self.multicall_contract.functions.aggregate3([(target, True, data) for target, data in calls]).call(),
+                        BATCH_TIMEOUT,
+                    )
+        except Exception as e:
+            is_first_timeout = isinstance(e, asyncio.TimeoutError) and not timed_out and len(calls) > 1
+            if not is_oversized_batch_error(e) and not is_first_timeout:
+                raise
+            if len(calls) == 1:
+                logging.warning('A single call to %s failed on %s: %r', calls[0][0], self.rpc_url, e)
+                return [None]
+
+            half = len(calls) // 2
+            self.batch_size = max(MIN_BATCH_SIZE, min(self.batch_size, half))
+            logging.info('Splitting a batch of %d calls on %s after %r. Batch size is now %d', len(calls), self.rpc_url, e, self.batch_size)
+            first_half, second_half = await asyncio.gather(
+                self.execute_batch(calls[:half], timed_out or is_first_timeout),
+                self.execute_batch(calls[half:], timed_out or is_first_timeout),
+            )
+            return first_half + second_half
+
+        if len(calls) >= self.batch_size:
+            self.batch_size = min(MAX_BATCH_SIZE, int(self.batch_size * BATCH_SIZE_GROWTH))
+        return [return_data if success else None for success, return_data in response]
@@ -0,0 +1,34 @@
+"""Compares the local getUserAccountData codec with web3's generic ABI machinery.
+Run with `python -m backend.benchmarks.codec`
+"""
+import timeit
+
+from eth_abi import decode
+from web3 import Web3
+
+from backend.abi import load_abi
+from backend.codec import decode_user_account_data_bulk, encode_get_user_account_data
+
+ACCOUNTS_COUNT = 10_000
+REPEAT = 5
+
+
+def main() -> None:
+    pool_contract = Web3().eth.contract(address='0x87870Bca3F3fD6335C3F4ce8392D69350B4fA4E2', abi=load_abi('v3_pool'))
+
+    addresses = [Web3.to_checksum_address(i.to_bytes(20, 'big')) for i in range(1, ACCOUNTS_COUNT + 1)]
+    results = [b''.join(i.to_bytes(32, 'big') for i in range(n, n + 6)) for n in range(ACCOUNTS_COUNT)]
+
+    benchmarks = {
+        'encodeABI': lambda: [pool_contract.encodeABI(fn_name='getUserAccountData', args=[address]) for address in addresses],
+        'local encode': lambda: [encode_get_user_account_data(address) for address in addresses],
+        'eth_abi decode': lambda: [decode(['uint256'] * 6, result) for result in results],
+        'local decode': lambda: decode_user_account_data_bulk(results),  # type: ignore[arg-type]
+    }
+    for name, benchmark in benchmarks.items():
+        best = min(timeit.repeat(benchmark, number=1, repeat=REPEAT))
+        print(f'{name:>16}: {best * 1000:8.2f} ms per {ACCOUNTS_COUNT} accounts, {best / ACCOUNTS_COUNT * 1e6:6.2f} us per account')
+
+
+if __name__ == '__main__':
+    main()
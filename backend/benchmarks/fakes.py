@@ -0,0 +1,464 @@
+"""Local stand-ins for the services used by the backend, served over HTTP from a background thread:
+an Ethereum JSON-RPC node that knows Multicall3, the aave pool and ERC-20 tokens, the Supabase REST API and OneSignal.
+Also the in-memory databases, notifiers and batchers shared by the benchmarks and the tests.
+"""
+import asyncio
+import itertools
+import json
+import random
+import threading
+from collections import Counter
+from typing import Any, Generator
+
+from aiohttp import web
+from eth_abi import decode, encode
+from eth_utils import event_abi_to_log_topic, function_signature_to_4byte_selector
+from web3.providers.async_base import AsyncJSONBaseProvider
+from web3.types import RPCEndpoint, RPCResponse
+
+from backend.abi import load_abi
+from backend.codec import DECIMALS_SELECTOR, GET_USER_ACCOUNT_DATA_SELECTOR, SYMBOL_SELECTOR, WORD_SIZE
+from backend.connector import LIQUIDATION_TOPIC, MULTICALL_ADDRESS
+from backend.types import Chain, ChainAccount, ChainAccountWithAllData
+
+AGGREGATE3_SELECTOR = function_signature_to_4byte_selector('aggregate3((address,bool,bytes)[])')
+GET_RESERVES_LIST_SELECTOR = function_signature_to_4byte_selector('getReservesList()')
+NO_DEBT_COLLATERAL = 10 ** 18  # Collateral and debt returned with every health factor, in the base currency
+
+
+class FakeChain():
+    """JSON-RPC node with `latency` seconds per request. A `failure_rate` share of requests is answered with 503.
+    Multicall batches of more than `max_calls` calls run out of gas. Logs subscriptions are served on /ws.
+    JSON-RPC batches are answered unless `batches_supported` is False. eth_getLogs of more than `max_logs_range` blocks is refused.
+    """
+    def __init__(self, pool_address: str, health_factors: dict[str, float], reserves: list[str], logs: list[dict], head_block: int, latency: float = 0, failure_rate: float = 0, max_calls: int = 1000, batches_supported: bool = True, max_logs_range: int | None = None) -> None:
+        self.pool_address = pool_address.lower()
+        self.health_factors = {address.lower(): health_factor for address, health_factor in health_factors.items()}
+        self.reserves = reserves
+        self.logs = logs
+        self.head_block = head_block
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.max_calls = max_calls
+        self.calls: Counter[str] = Counter()  # JSON-RPC method (or multicall inner calls) -> count
+        self.http_requests = 0
+        self.batches_supported = batches_supported
+        self.max_logs_range = max_logs_range
+        self.random = random.Random(0)
+        self.subscriptions: list[tuple[web.WebSocketResponse, str]] = []
+
+    def answer_call(self, target: str, data: bytes) -> bytes | None:
+        selector = data[:4]
+        if selector == GET_USER_ACCOUNT_DATA_SELECTOR and target.lower() == self.pool_address:
+            health_factor = self.health_factors.get('0x' + data[16:36].hex())
+            if health_factor is None:
+                return encode(['uint256'] * 6, [0, 0, 0, 0, 0, 2 ** 256 - 1])
+            return encode(['uint256'] * 6, [NO_DEBT_COLLATERAL, NO_DEBT_COLLATERAL, 0, 8000, 7500, int(health_factor * 10 ** 18)])
+        if selector == GET_RESERVES_LIST_SELECTOR and target.lower() == self.pool_address:
+            return encode(['address[]'], [self.reserves])
+        if selector == SYMBOL_SELECTOR:
+            return encode(['string'], ['TKN'])
+        if selector == DECIMALS_SELECTOR:
+            return encode(['uint8'], [18])
+        return None
+
+    def eth_call(self, transaction: dict) -> bytes:
+        target = transaction['to']
+        data = bytes.fromhex((transaction.get('data') or transaction.get('input'))[2:])
+        if target.lower() != MULTICALL_ADDRESS.lower() or data[:4] != AGGREGATE3_SELECTOR:
+            self.calls['eth_call'] += 1
+            result = self.answer_call(target, data)
+            if result is None:
+                raise ValueError('execution reverted')
+            return result
+
+        calls = decode(['(address,bool,bytes)[]'], data[4:])[0]
+        self.calls['aggregate3'] += 1
+        self.calls['aggregate3 inner calls'] += len(calls)
+        if len(calls) > self.max_calls:
+            raise ValueError('out of gas')
+        results = []
+        for call_target, _, call_data in calls:
+            result = self.answer_call(call_target, call_data)
+            results.append((result is not None, result or b''))
+        return encode(['(bool,bytes)[]'], [results])
+
+    def get_logs(self, filter_params: dict) -> list[dict]:
+        from_block, to_block = int(filter_params['fromBlock'], 16), int(filter_params['toBlock'], 16)
+        if self.max_logs_range is not None and to_block - from_block + 1 > self.max_logs_range:
+            raise ValueError(f'block range is too wide, at most {self.max_logs_range} blocks are allowed')
+        addresses = filter_params.get('address')
+        if isinstance(addresses, str):
+            addresses = [addresses]
+        topics = [None if topic is None else {topic.lower()} if isinstance(topic, str) else {item.lower() for item in topic} for topic in filter_params.get('topics') or []]
+        return [
+            log for log in self.logs
+            if from_block <= int(log['blockNumber'], 16) <= to_block and (addresses is None or log['address'].lower() in {address.lower() for address in addresses})
+            and all(topic is None or (i < len(log['topics']) and log['topics'][i].lower() in topic) for i, topic in enumerate(topics))
+        ]
+
+    def answer(self, body: dict) -> dict:
+        method, params = body['method'], body['params']
+        self.calls[method] += 1
+        try:
+            if method == 'eth_chainId':
+                result: Any = '0x1'
+            elif method == 'eth_blockNumber':
+                result = hex(self.head_block)
+            elif method == 'eth_call':
+                result = '0x' + self.eth_call(params[0]).hex()
+            elif method == 'eth_getLogs':
+                result = self.get_logs(params[0])
+            else:
+                return {'jsonrpc': '2.0', 'id': body['id'], 'error': {'code': -32601, 'message': f'{method} is not supported'}}
+        except ValueError as e:
+            return {'jsonrpc': '2.0', 'id': body['id'], 'error': {'code': -32000, 'message': str(e)}}
+        return {'jsonrpc': '2.0', 'id': body['id'], 'result': result}
+
+    async def handle(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.http_requests += 1
+        await asyncio.sleep(self.latency)
+        if self.random.random() < self.failure_rate:
+            return web.Response(status=503)
+        if isinstance(body, list):
+            if not self.batches_supported:
+                return web.json_response({'jsonrpc': '2.0', 'id': None, 'error': {'code': -32600, 'message': 'batch requests are not supported'}})
+            return web.json_response([self.answer(item) for item in body])
+        return web.json_response(self.answer(body))
+
+    async def handle_websocket(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async for message in ws:
+            body = message.json()
+            self.calls[f'ws {body["method"]}'] += 1
+            if body['method'] == 'eth_subscribe' and body['params'][0] == 'logs':
+                subscription = hex(len(self.subscriptions) + 1)
+                self.subscriptions.append((ws, subscription))
+                await ws.send_json({'jsonrpc': '2.0', 'id': body['id'], 'result': subscription})
+            else:
+                await ws.send_json({'jsonrpc': '2.0', 'id': body['id'], 'error': {'code': -32601, 'message': f'{body["method"]} is not supported'}})
+        self.subscriptions = [(subscriber, subscription) for subscriber, subscription in self.subscriptions if subscriber is not ws]
+        return ws
+
+    async def mine_log(self, log: dict) -> None:
+        """Add the log to the chain and push it to the subscribers"""
+        self.logs.append(log)
+        self.head_block = max(self.head_block, int(log['blockNumber'], 16))
+        for ws, subscription in self.subscriptions:
+            await ws.send_json({'jsonrpc': '2.0', 'method': 'eth_subscription', 'params': {'subscription': subscription, 'result': log}})
+
+    async def drop_subscriptions(self) -> None:
+        for ws, _ in list(self.subscriptions):
+            await ws.close()
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=100 * 1024 ** 2)
+        app.router.add_post('/', self.handle)
+        app.router.add_get('/ws', self.handle_websocket)
+        return app
+
+
+class InProcessProvider(AsyncJSONBaseProvider):
+    """web3 provider answered by a FakeChain in the same process, without HTTP. Requests are still encoded to JSON and back."""
+    def __init__(self, chain: FakeChain) -> None:
+        self.chain = chain
+        self.request_ids = itertools.count()
+        super().__init__()
+
+    async def make_request(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        request = json.loads(self.encode_rpc_request(method, params))
+        request['id'] = next(self.request_ids)
+        return self.chain.answer(request)  # type: ignore[return-value]
+
+
+def make_pool_event_log(pool_address: str, aave_version: int, event_name: str, block_number: int, args: dict) -> dict:
+    """Raw log of a pool event, as returned by eth_getLogs"""
+    event_abi = next(item for item in load_abi(f'v{aave_version}_pool') if item.get('type') == 'event' and item['name'] == event_name)
+    indexed = [item for item in event_abi['inputs'] if item['indexed']]
+    not_indexed = [item for item in event_abi['inputs'] if not item['indexed']]
+    return {
+        'address': pool_address,
+        'topics': ['0x' + event_abi_to_log_topic(event_abi).hex()] + ['0x' + encode([item['type']], [args[item['name']]]).hex() for item in indexed],
+        'data': '0x' + encode([item['type'] for item in not_indexed], [args[item['name']] for item in not_indexed]).hex(),
+        'blockNumber': hex(block_number),
+        'blockHash': '0x' + block_number.to_bytes(32, 'big').hex(),
+        'transactionHash': '0x' + block_number.to_bytes(32, 'big').hex(),
+        'transactionIndex': '0x0',
+        'logIndex': '0x0',
+        'removed': False,
+    }
+
+
+def make_liquidation_log(pool_address: str, block_number: int, log_index: int, collateral_asset: str, debt_asset: str, user: str) -> dict:
+    def to_topic(address: str) -> str:
+        return '0x' + '00' * 12 + address[2:].lower()
+
+    return {
+        'address': pool_address,
+        'topics': [LIQUIDATION_TOPIC, to_topic(collateral_asset), to_topic(debt_asset), to_topic(user)],
+        'data': '0x' + encode(['uint256', 'uint256', 'address', 'bool'], [10 ** 18, 2 * 10 ** 18, '0x' + '11' * 20, False]).hex(),
+        'blockNumber': hex(block_number),
+        'blockHash': '0x' + block_number.to_bytes(32, 'big').hex(),
+        'transactionHash': '0x' + (block_number * 1000 + log_index).to_bytes(32, 'big').hex(),
+        'transactionIndex': '0x0',
+        'logIndex': hex(log_index),
+        'removed': False,
+    }
+
+
+class FakeRpcNode():
+    """Answers eth_blockNumber with its block number after `delay` seconds, or with `status` if it is not 200.
+    eth_getLogs is answered with no logs, and the methods it was called with are recorded.
+    """
+    def __init__(self, block_number: int, delay: float = 0, status: int = 200) -> None:
+        self.block_number = block_number
+        self.delay = delay
+        self.status = status
+        self.requests_count = 0
+        self.methods: list[str] = []
+        self.runner: web.AppRunner | None = None
+        self.url = ''
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests_count += 1
+        body = await request.json()
+        self.methods.append(body['method'])
+        await asyncio.sleep(self.delay)
+        if self.status != 200:
+            return web.Response(status=self.status)
+        if body['method'] == 'eth_getLogs':
+            return web.json_response({'jsonrpc': '2.0', 'id': body['id'], 'result': []})
+        return web.json_response({'jsonrpc': '2.0', 'id': body['id'], 'result': hex(self.block_number)})
+
+    async def __aenter__(self) -> 'FakeRpcNode':
+        app = web.Application()
+        app.router.add_post('/', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.url = f'http://127.0.0.1:{self.runner.addresses[0][1]}/'
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        assert self.runner is not None
+        await self.runner.cleanup()
+
+
+class FakeSupabase():
+    """Subset of the PostgREST API used by Database: eq/gt/lt/gte/lte filters, order, limit, count,
+    inserts with upsert, updates and the set_last_health_factor_notifications function
+    """
+    def __init__(self, tables: dict[str, list[dict]], latency: float = 0) -> None:
+        self.tables = tables
+        self.latency = latency
+        self.calls: Counter[str] = Counter()  # 'METHOD table' -> count
+
+    def filter_rows(self, table: str, query: dict[str, str]) -> list[dict]:
+        rows = self.tables.setdefault(table, [])
+        operators = {
+            'eq': lambda a, b: a == b,
+            'gt': lambda a, b: a > b,
+            'lt': lambda a, b: a < b,
+            'gte': lambda a, b: a >= b,
+            'lte': lambda a, b: a <= b,
+        }
+        for column, condition in query.items():
+            if column in ('select', 'order', 'limit', 'offset', 'on_conflict'):
+                continue
+            operator, value = condition.split('.', 1)
+            rows = [row for row in rows if operators[operator](row[column], type(row[column])(value))]
+        return rows
+
+    async def handle_select(self, request: web.Request) -> web.Response:
+        table = request.match_info['table']
+        self.calls[f'GET {table}'] += 1
+        await asyncio.sleep(self.latency)
+        rows = self.filter_rows(table, dict(request.query))
+        if request.query.get('select') == 'count':
+            return web.json_response([{'count': len(rows)}])
+        if 'order' in request.query:
+            rows = sorted(rows, key=lambda row: row[request.query['order'].split('.')[0]])
+        if 'limit' in request.query:
+            rows = rows[:int(request.query['limit'])]
+        return web.json_response(rows)
+
+    async def handle_upsert(self, request: web.Request) -> web.Response:
+        table = request.match_info['table']
+        self.calls[f'POST {table}'] += 1
+        await asyncio.sleep(self.latency)
+        body = await request.json()
+        new_rows = body if isinstance(body, list) else [body]
+        rows = self.tables.setdefault(table, [])
+        for new_row in new_rows:
+            existing = next((row for row in rows if 'key' in row and row['key'] == new_row.get('key')), None)
+            if existing is not None:
+                existing.update(new_row)
+            else:
+                rows.append(new_row)
+        return web.json_response(new_rows, status=201)
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        table = request.match_info['table']
+        self.calls[f'PATCH {table}'] += 1
+        await asyncio.sleep(self.latency)
+        body = await request.json()
+        rows = self.filter_rows(table, dict(request.query))
+        for row in rows:
+            row.update(body)
+        return web.json_response(rows)
+
+    async def handle_set_last_health_factor_notifications(self, request: web.Request) -> web.Response:
+        self.calls['RPC set_last_health_factor_notifications'] += 1
+        await asyncio.sleep(self.latency)
+        body = await request.json()
+        notified = {(account['address'], account['user_id']) for account in body['p_accounts']}
+        for row in self.tables['account']:
+            if row['chain'] == body['p_chain'] and row['aave_version'] == body['p_aave_version'] and (row['address'], row['user_id']) in notified:
+                row['last_health_factor_notification'] = body['p_notified_at']
+        return web.Response(status=204)
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=100 * 1024 ** 2)
+        app.router.add_post('/rest/v1/rpc/set_last_health_factor_notifications', self.handle_set_last_health_factor_notifications)
+        app.router.add_get('/rest/v1/{table}', self.handle_select)
+        app.router.add_post('/rest/v1/{table}', self.handle_upsert)
+        app.router.add_patch('/rest/v1/{table}', self.handle_update)
+        return app
+
+
+class FakeOneSignal():
+    """Local stand-in for the OneSignal notifications API. Records received notifications and Authorization headers.
+    The first `failures` requests are answered with `failure_status` and the `retry_after` header if it is set.
+    """
+    def __init__(self, failures: int = 0, failure_status: int = 429, retry_after: str | None = None) -> None:
+        self.failures = failures
+        self.failure_status = failure_status
+        self.retry_after = retry_after
+        self.requests_count = 0
+        self.notifications: list[tuple[list[str], str, str]] = []
+        self.authorizations: list[str | None] = []
+        self.runner: web.AppRunner | None = None
+        self.url = ''
+
+    async def create_notification(self, request: web.Request) -> web.Response:
+        self.requests_count += 1
+        self.authorizations.append(request.headers.get('Authorization'))
+        if self.requests_count <= self.failures:
+            headers = {'Retry-After': self.retry_after} if self.retry_after is not None else None
+            return web.json_response({'errors': ['Rate limit exceeded']}, status=self.failure_status, headers=headers)
+
+        body = await request.json()
+        self.notifications.append((body['include_player_ids'], body['headings']['en'], body['contents']['en']))
+        return web.json_response({'id': f'notification-{len(self.notifications)}', 'recipients': len(body['include_player_ids'])})
+
+    async def __aenter__(self) -> 'FakeOneSignal':
+        app = web.Application()
+        app.router.add_post('/api/v1/notifications', self.create_notification)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.url = f'http://127.0.0.1:{port}/api/v1/notifications'
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        assert self.runner is not None
+        await self.runner.cleanup()
+
+
+class FakeServices():
+    """Runs the fake chain, Supabase and OneSignal on an event loop in a background thread,
+    so both the blocking and the async connectors can be driven from the main thread
+    """
+    def __init__(self, chain: FakeChain, supabase: FakeSupabase) -> None:
+        self.chain = chain
+        self.supabase = supabase
+        self.onesignal = FakeOneSignal()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.runners: list[web.AppRunner] = []
+        self.chain_url = ''
+        self.supabase_url = ''
+
+    async def serve(self, app: web.Application) -> str:
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', 0).start()
+        self.runners.append(runner)
+        return f'http://127.0.0.1:{runner.addresses[0][1]}'
+
+    async def start_servers(self) -> None:
+        self.chain_url = await self.serve(self.chain.make_app()) + '/'
+        self.supabase_url = await self.serve(self.supabase.make_app())
+        await self.onesignal.__aenter__()
+
+    async def stop_servers(self) -> None:
+        await self.onesignal.__aexit__()
+        for runner in self.runners:
+            await runner.cleanup()
+
+    def __enter__(self) -> 'FakeServices':
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.start_servers(), self.loop).result()
+        return self
+
+    def __exit__(self, *args) -> None:
+        asyncio.run_coroutine_threadsafe(self.stop_servers(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def make_account(address: str, chain: Chain, aave_version: int, user_id: str) -> ChainAccountWithAllData:
+    return ChainAccountWithAllData(ChainAccount(address, chain, aave_version), health_factor_threshold=1.2, user_id=user_id, onesignal_id=None)
+
+
+class FakeAccountsDatabase():
+    """Accounts in their notification cooldown are not returned, like the query filters them"""
+    def __init__(self, accounts: list[ChainAccountWithAllData]) -> None:
+        self.accounts = accounts
+        self.notified: list[ChainAccountWithAllData] = []
+        self.queries_count = 0
+
+    def iter_accounts_for_hf_check(self) -> Generator[list[ChainAccountWithAllData], None, None]:
+        self.queries_count += 1
+        accounts = [account for account in self.accounts if account not in self.notified]
+        for i in range(0, len(accounts), 2):
+            yield accounts[i:i + 2]
+
+
+class FakeAccountDataBatcher():
+    """Returns account data with the health factor equal to the last byte of the queried address"""
+    def __init__(self) -> None:
+        self.calls: list[tuple[str, bytes]] = []
+
+    async def aggregate(self, calls: list[tuple[str, bytes]]) -> list[bytes | None]:
+        self.calls += calls
+        return [bytes(5 * WORD_SIZE) + (data[-1] * 10 ** 18).to_bytes(WORD_SIZE, 'big') for _, data in calls]
+
+
+class FakeSettingsDatabase():
+    """Setting table of the liquidation monitor. Every account is tracked."""
+    def __init__(self, settings: dict[str, str]) -> None:
+        self.settings = settings
+
+    def get_setting(self, key: str) -> str | None:
+        return self.settings.get(key)
+
+    def set_setting(self, key: str, value: str) -> None:
+        self.settings[key] = value
+
+    def is_tracked(self, account) -> bool:
+        return True
+
+
+class FakeLiquidationNotifier():
+    """Records the lowercase addresses notified about their liquidation"""
+    def __init__(self) -> None:
+        self.liquidated: list[str] = []
+
+    async def notify_about_liquidation(self, chain_account, title: str, message: str) -> None:
+        self.liquidated.append(chain_account.address.lower())
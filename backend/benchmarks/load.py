@@ -0,0 +1,209 @@
+"""Load test of a health factor sweep and a liquidations catchup against local fake services.
+Drives ChainConnector with Notifier (blocking mode) or AsyncChainConnector with AsyncNotifier (async mode) end to end
+and reports sweep latency, throughput and the number of RPC, database and OneSignal calls.
+
+Run with `python -m backend.benchmarks.load --positions 1000 10000 100000`
+Save a baseline with `--save-baseline baseline.json` and compare later runs with `--baseline baseline.json`.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+from random import Random
+
+os.environ.setdefault('ONESIGNAL_APP_KEY', 'benchmark')
+os.environ.setdefault('ONESIGNAL_APP_ID', 'benchmark')
+os.environ.setdefault('TG_BOT_TOKEN', '1:benchmark')
+
+from web3 import Web3  # noqa: E402
+
+from backend import notifier as notifier_module  # noqa: E402
+from backend.accounts import HealthFactorAccountsLoader  # noqa: E402
+from backend.benchmarks.fakes import FakeChain, FakeServices, FakeSupabase, make_liquidation_log  # noqa: E402
+from backend.connector import AsyncChainConnector, ChainConnector  # noqa: E402
+from backend.database import Database  # noqa: E402
+from backend.dispatcher import NotificationDispatcher  # noqa: E402
+from backend.notifier import AsyncNotifier, Notifier  # noqa: E402
+from backend.rpc import close_sessions  # noqa: E402
+from backend.tokens import TokenMetadataCache  # noqa: E402
+from backend.tracked import TrackedAccountsIndex  # noqa: E402
+from backend.types import Chain  # noqa: E402
+
+POOL_ADDRESS = '0x87870Bca3F3fD6335C3F4ce8392D69350B4fA4E2'
+RESERVES = ['0x' + '0a' * 20, '0x' + '0b' * 20]
+SUPABASE_KEY = 'benchmark.supabase.key'
+WHALES_COUNT = 10
+WHALE_SHARE = 0.1  # Share of positions that track one of the whale addresses
+HEALTH_FACTOR_THRESHOLD = 1.1
+HEAD_BLOCK = 1_000_000
+LIQUIDATIONS_BLOCK_RANGE = 5_000  # Liquidations are spread over this many blocks before the head
+REGRESSION_TOLERANCE = 0.2  # A run is a regression if its median sweep is slower than the baseline by more than this share
+
+
+def make_fixtures(positions: int, liquidations: int, seed: int = 0) -> tuple[dict[str, float], list[dict], list[dict]]:
+    """Returns health factors by address, account rows and liquidation logs"""
+    random = Random(seed)
+    whales = [Web3.to_checksum_address(random.randbytes(20)) for _ in range(WHALES_COUNT)]
+    accounts = []
+    health_factors = {}
+    notified_long_ago = (datetime.utcnow() - timedelta(days=2)).isoformat()
+    for i in range(positions):
+        address = random.choice(whales) if random.random() < WHALE_SHARE else Web3.to_checksum_address(random.randbytes(20))
+        health_factors.setdefault(address, random.uniform(1.05, 3))
+        accounts.append({
+            'address': address,
+            'chain': Chain.ETHEREUM.value,
+            'aave_version': 3,
+            'user_id': f'user-{i}',
+            'user': {'health_factor_threshold': HEALTH_FACTOR_THRESHOLD, 'onesignal_id': f'onesignal-{i}'},
+            'last_health_factor_notification': notified_long_ago,
+        })
+
+    logs = []
+    addresses = list(health_factors)
+    for i in range(liquidations):
+        block_number = HEAD_BLOCK - LIQUIDATIONS_BLOCK_RANGE + i * LIQUIDATIONS_BLOCK_RANGE // max(liquidations, 1)
+        logs.append(make_liquidation_log(POOL_ADDRESS, block_number, i, RESERVES[0], RESERVES[1], random.choice(addresses)))
+    return health_factors, accounts, logs
+
+
+def run_blocking(services: FakeServices, sweeps: int) -> list[float]:
+    notifier_module.get_onesignal_configuration().host = services.onesignal.url.removesuffix('/notifications')
+    database = Database(supabase_url=services.supabase_url, supabase_key=SUPABASE_KEY)
+    connector = ChainConnector(
+        chain=Chain.ETHEREUM,
+        http_rpc_url=services.chain_url,
+        notifier=Notifier(database=database),
+        database=database,
+        pool_address=POOL_ADDRESS,
+        aave_version=3,
+    )
+    durations = []
+    for _ in range(sweeps):
+        start = time.perf_counter()
+        connector.check_health_factors()
+        durations.append(time.perf_counter() - start)
+    connector.catchup_on_liquidations()
+    return durations
+
+
+async def run_async(services: FakeServices, sweeps: int) -> list[float]:
+    """The connector shares the tracked accounts index, the token metadata cache and the accounts loader like in __main__"""
+    database = Database(supabase_url=services.supabase_url, supabase_key=SUPABASE_KEY)
+    notifier = AsyncNotifier(database=database, dispatcher=NotificationDispatcher(app_id='benchmark', app_key='benchmark', api_url=services.onesignal.url))
+    connector = AsyncChainConnector(
+        chain=Chain.ETHEREUM,
+        http_rpc_url=services.chain_url,
+        notifier=notifier,
+        database=database,
+        pool_address=POOL_ADDRESS,
+        aave_version=3,
+        tracked_index=TrackedAccountsIndex(database=database),
+        token_cache=TokenMetadataCache(database=database),
+        accounts_loader=HealthFactorAccountsLoader(database=database),
+    )
+    await connector.connect()
+    durations = []
+    for _ in range(sweeps):
+        start = time.perf_counter()
+        await connector.check_health_factors()
+        await notifier.join()
+        durations.append(time.perf_counter() - start)
+    await connector.catchup_on_liquidations()
+    await notifier.close()
+    await close_sessions()
+    return durations
+
+
+def run(mode: str, positions: int, liquidations: int, sweeps: int, rpc_latency: float, db_latency: float, failure_rate: float) -> dict:
+    health_factors, accounts, logs = make_fixtures(positions, liquidations)
+    chain = FakeChain(POOL_ADDRESS, health_factors, RESERVES, logs, HEAD_BLOCK, latency=rpc_latency, failure_rate=failure_rate)
+    supabase = FakeSupabase({
+        'account': accounts,
+        'setting': [{'key': f'LAST_{Chain.ETHEREUM.name}_V3_CHECKED_BLOCK', 'value': str(HEAD_BLOCK - LIQUIDATIONS_BLOCK_RANGE - 1)}],
+    }, latency=db_latency)
+    with FakeServices(chain, supabase) as services:
+        durations = run_blocking(services, sweeps) if mode == 'blocking' else asyncio.run(run_async(services, sweeps))
+        notifications = len(services.onesignal.notifications)
+
+    return {
+        'median_sweep_seconds': statistics.median(durations),
+        'max_sweep_seconds': max(durations),
+        'positions_per_second': positions / statistics.median(durations),
+        'rpc_calls': dict(chain.calls),
+        'db_calls': dict(supabase.calls),
+        'notification_calls': notifications,
+    }
+
+
+def compare(name: str, result: dict, baseline: dict | None) -> bool:
+    """Print the result next to the baseline. Returns False on a regression."""
+    print(f'\n{name}')
+    if baseline is None:
+        baseline = {}
+        print('  no baseline')
+
+    def row(label: str, value: float, baseline_value: float | None) -> None:
+        delta = '' if not baseline_value else f'{(value - baseline_value) / baseline_value:+8.1%} vs {baseline_value:g}'
+        print(f'  {label:<56} {value:>12.4g} {delta}')
+
+    row('median sweep, s', result['median_sweep_seconds'], baseline.get('median_sweep_seconds'))
+    row('max sweep, s', result['max_sweep_seconds'], baseline.get('max_sweep_seconds'))
+    row('throughput, positions/s', result['positions_per_second'], baseline.get('positions_per_second'))
+    for group in ('rpc_calls', 'db_calls'):
+        for key, value in sorted(result[group].items()):
+            row(f'{group.replace("_", " ")}: {key}', value, baseline.get(group, {}).get(key))
+    row('notification calls', result['notification_calls'], baseline.get('notification_calls'))
+
+    baseline_sweep = baseline.get('median_sweep_seconds')
+    if baseline_sweep is not None and result['median_sweep_seconds'] > baseline_sweep * (1 + REGRESSION_TOLERANCE):
+        print(f'  REGRESSION: median sweep is more than {REGRESSION_TOLERANCE:.0%} slower than the baseline')
+        return False
+    return True
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--positions', type=int, nargs='+', default=[1_000, 10_000, 100_000])
+    parser.add_argument('--mode', choices=['async', 'blocking'], nargs='+', default=['async'])
+    parser.add_argument('--liquidations', type=int, default=100)
+    parser.add_argument('--sweeps', type=int, default=3)
+    parser.add_argument('--rpc-latency', type=float, default=0.02, help='seconds per JSON-RPC request')
+    parser.add_argument('--db-latency', type=float, default=0.01, help='seconds per database request')
+    parser.add_argument('--failure-rate', type=float, default=0, help='share of JSON-RPC requests answered with 503')
+    parser.add_argument('--baseline', help='JSON file with the results to compare with')
+    parser.add_argument('--save-baseline', help='JSON file to save the results to')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, force=True)
+
+    baselines = {}
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baselines = json.loads(f.read())
+
+    results = {}
+    ok = True
+    for mode in args.mode:
+        for positions in args.positions:
+            name = f'{mode}-{positions}'
+            try:
+                results[name] = run(mode, positions, args.liquidations, args.sweeps, args.rpc_latency, args.db_latency, args.failure_rate)
+            except Exception as e:
+                print(f'\n{name}\n  FAILED: {e!r}')
+                ok = False
+                continue
+            ok = compare(name, results[name], baselines.get(name)) and ok
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as f:
+            f.write(json.dumps(results, indent=2))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,430 @@
+"""Replays the monitor of one pool over a past block range to measure how early it alerts.
+First the liquidation and position event logs of the range and the getUserAccountData results of the liquidated accounts
+(and of any other given accounts) at every `step`th block are recorded into a fixture directory. This needs an archive RPC node.
+Then AsyncChainConnector runs its health factor scheduler and catchup_on_liquidations against the recorded data on a simulated
+block clock, with no sleeps and no network, and the replay reports how many blocks before a liquidation its account was
+warned, how many blocks after it the liquidation alert was sent, and the throughput of the replay.
+The scheduler is the periodic sweep, the incremental watcher or the adaptive scheduler, like in the monitor.
+Prices are not recorded, so the incremental watcher sees only position events and price moves are found by its full sweeps.
+
+Record with `python -m backend.benchmarks.replay record --rpc-url URL --chain ETHEREUM --aave-version 3 --pool-address 0x... --from-block N --to-block M --fixtures DIR`
+Replay with `python -m backend.benchmarks.replay run --fixtures DIR --scheduler periodic --hf-check-interval 75 --liquidation-check-interval 75`
+"""
+import argparse
+import asyncio
+import bisect
+import json
+import logging
+import os
+import statistics
+import time
+from contextlib import contextmanager
+from typing import Generator, NamedTuple
+from unittest import mock
+
+os.environ.setdefault('ONESIGNAL_APP_KEY', 'replay')
+os.environ.setdefault('ONESIGNAL_APP_ID', 'replay')
+os.environ.setdefault('TG_BOT_TOKEN', '1:replay')
+
+from eth_utils import event_abi_to_log_topic, to_hex  # noqa: E402
+from hexbytes import HexBytes  # noqa: E402
+from web3 import AsyncWeb3, Web3  # noqa: E402
+from web3.types import LogReceipt  # noqa: E402
+
+from backend.abi import load_abi  # noqa: E402
+from backend.backfill import LogBackfiller  # noqa: E402
+from backend.benchmarks.fakes import FakeChain, InProcessProvider  # noqa: E402
+from backend.codec import GET_USER_ACCOUNT_DATA_SELECTOR, encode_get_user_account_data  # noqa: E402
+from backend.connector import LIQUIDATION_TOPIC, MAX_BLOCK_RANGE, MULTICALL_ADDRESS, AsyncChainConnector, make_batches  # noqa: E402
+from backend.database import ACCOUNTS_PAGE_SIZE  # noqa: E402
+from backend.incremental import POSITION_EVENTS, HealthFactorWatcher  # noqa: E402
+from backend.rpc import attach_session, close_sessions, get_semaphore, make_async_web3  # noqa: E402
+from backend.scheduling import AdaptiveScheduler, HealthFactorStore  # noqa: E402
+from backend.types import Chain, ChainAccount, ChainAccountWithAllData  # noqa: E402
+
+RECORD_BATCH_SIZE = 100  # getUserAccountData calls per aggregate3 call
+RECORD_CONCURRENCY = 8  # Pinned blocks recorded at once, then appended to the fixtures
+DEFAULT_THRESHOLD = 1.1  # Health factor threshold of the liquidated accounts, which were not necessarily tracked
+DEFAULT_CHECK_INTERVAL = 75  # blocks, 15 minutes on Ethereum like HEALTH_FACTOR_CHECK_PERIOD and LIQUIDATIONS_CHECK_PERIOD
+DEFAULT_BLOCK_TIME = 12  # seconds
+SCHEDULERS = ('periodic', 'incremental', 'adaptive')
+
+
+class FixtureMeta(NamedTuple):
+    chain: str
+    aave_version: int
+    pool_address: str
+    from_block: int
+    to_block: int
+    step: int  # Account data is recorded at every step-th block from from_block
+    accounts: list[tuple[str, float]]  # (address, health factor threshold)
+
+
+class FixtureStore():
+    """Recorded data of one pool over a block range, in a directory: meta.json, logs.json with the raw liquidation logs,
+    position_logs.json with the raw logs of the other position events and account_data.jsonl with the raw getUserAccountData results (None for failed calls) of one pinned block per line.
+    Account data is appended after every few blocks, so an interrupted recording continues where it stopped.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def save_meta(self, meta: FixtureMeta) -> None:
+        with open(self.file('meta.json'), 'w') as f:
+            f.write(json.dumps(meta._asdict(), indent=2))
+
+    def load_meta(self) -> FixtureMeta:
+        with open(self.file('meta.json')) as f:
+            raw_meta = json.loads(f.read())
+        return FixtureMeta(**{**raw_meta, 'accounts': [tuple(account) for account in raw_meta['accounts']]})
+
+    def save_logs(self, logs: list[dict]) -> None:
+        with open(self.file('logs.json'), 'w') as f:
+            f.write(json.dumps(logs))
+
+    def load_logs(self) -> list[dict]:
+        with open(self.file('logs.json')) as f:
+            return json.loads(f.read())
+
+    def save_position_logs(self, logs: list[dict]) -> None:
+        with open(self.file('position_logs.json'), 'w') as f:
+            f.write(json.dumps(logs))
+
+    def load_position_logs(self) -> list[dict]:
+        """Empty for fixtures recorded before position logs were"""
+        if not os.path.exists(self.file('position_logs.json')):
+            return []
+        with open(self.file('position_logs.json')) as f:
+            return json.loads(f.read())
+
+    def append_account_data(self, block: int, results: dict[str, str | None]) -> None:
+        with open(self.file('account_data.jsonl'), 'a') as f:
+            f.write(json.dumps({'block': block, 'results': results}) + '\n')
+
+    def iter_account_data(self) -> Generator[tuple[int, dict[str, str | None]], None, None]:
+        if not os.path.exists(self.file('account_data.jsonl')):
+            return
+        with open(self.file('account_data.jsonl')) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    yield record['block'], record['results']
+
+
+def to_raw_log(log: LogReceipt) -> dict:
+    """Inverse of web3's log formatting, so the logs can be served as eth_getLogs results again"""
+    return {
+        'address': log['address'],
+        'topics': [HexBytes(topic).hex() for topic in log['topics']],
+        'data': HexBytes(log['data']).hex(),
+        'blockNumber': hex(log['blockNumber']),
+        'blockHash': HexBytes(log['blockHash']).hex(),
+        'transactionHash': HexBytes(log['transactionHash']).hex(),
+        'transactionIndex': hex(log['transactionIndex']),
+        'logIndex': hex(log['logIndex']),
+        'removed': log.get('removed', False),
+    }
+
+
+def get_position_topics(aave_version: int) -> list[str]:
+    """Topics of the pool events that HealthFactorWatcher rechecks accounts on, besides LiquidationCall"""
+    return [
+        to_hex(event_abi_to_log_topic(item)) for item in load_abi(f'v{aave_version}_pool')
+        if item.get('type') == 'event' and item['name'] in POSITION_EVENTS and item['name'] != 'LiquidationCall'
+    ]
+
+
+async def record_account_data(web3: AsyncWeb3, rpc_url: str, pool_address: str, addresses: list[str], block: int) -> dict[str, str | None]:
+    multicall_contract = web3.eth.contract(address=MULTICALL_ADDRESS, abi=load_abi('multicall'))
+    results: dict[str, str | None] = {}
+    for batch in make_batches(addresses, RECORD_BATCH_SIZE):
+        async with get_semaphore(rpc_url):
+            response = await multicall_contract.functions.aggregate3(
+                [(pool_address, True, encode_get_user_account_data(address)) for address in batch],
+            ).call(block_identifier=block)
+        results.update((address.lower(), '0x' + data.hex() if success else None) for address, (success, data) in zip(batch, response))
+    return results
+
+
+async def record(store: FixtureStore, rpc_url: str, chain: Chain, aave_version: int, pool_address: str, from_block: int, to_block: int, step: int, accounts: list[tuple[str, float]], threshold: float) -> FixtureMeta:
+    web3 = make_async_web3(rpc_url)
+    await attach_session(web3, rpc_url)
+    backfiller = LogBackfiller(web3, rpc_url, block_range=MAX_BLOCK_RANGE)
+
+    async def record_logs(topics: list[str], name: str) -> list[dict]:
+        logs: list[dict] = []
+
+        async def collect(new_logs: list[LogReceipt]) -> None:
+            logs.extend(to_raw_log(log) for log in new_logs)
+
+        async def checkpoint(block: int) -> None:
+            logging.info('Recorded %s until block %d', name, block)
+
+        await backfiller.backfill({'address': pool_address, 'topics': [topics]}, from_block, to_block, collect, checkpoint)
+        return logs
+
+    logs = await record_logs([LIQUIDATION_TOPIC], 'liquidations')
+    store.save_logs(logs)
+    store.save_position_logs(await record_logs(get_position_topics(aave_version), 'position events'))
+
+    thresholds = {address.lower(): (address, account_threshold) for address, account_threshold in accounts}
+    for log in logs:
+        user = Web3.to_checksum_address('0x' + log['topics'][3][-40:])
+        thresholds.setdefault(user.lower(), (user, threshold))
+    meta = FixtureMeta(chain.value, aave_version, pool_address, from_block, to_block, step, list(thresholds.values()))
+    store.save_meta(meta)
+
+    addresses = [address for address, _ in meta.accounts]
+    recorded = {block for block, _ in store.iter_account_data()}
+    blocks = [block for block in range(from_block, to_block + 1, step) if block not in recorded]
+    for window in make_batches(blocks, RECORD_CONCURRENCY):
+        results = await asyncio.gather(*(record_account_data(web3, rpc_url, pool_address, addresses, block) for block in window))
+        for block, block_results in zip(window, results):
+            store.append_account_data(block, block_results)
+        logging.info('Recorded account data of %d accounts until block %d', len(addresses), window[-1])
+    await close_sessions()
+    return meta
+
+
+class ReplayChain(FakeChain):
+    """FakeChain that answers getUserAccountData with the results recorded at the last pinned block before the current one"""
+    def __init__(self, store: FixtureStore, meta: FixtureMeta) -> None:
+        super().__init__(meta.pool_address, {}, [], store.load_logs() + store.load_position_logs(), head_block=meta.from_block)
+        self.account_data = dict(store.iter_account_data())
+        self.pinned_blocks = sorted(self.account_data)
+        self.block = meta.from_block
+        self.current_account_data: dict[str, str | None] = {}
+
+    def set_block(self, block: int) -> None:
+        self.block = block
+        self.head_block = block + 1  # The connectors treat the latest block as unconfirmed
+        index = bisect.bisect_right(self.pinned_blocks, block)
+        self.current_account_data = self.account_data[self.pinned_blocks[index - 1]] if index > 0 else {}
+
+    def answer_call(self, target: str, data: bytes) -> bytes | None:
+        if data[:4] == GET_USER_ACCOUNT_DATA_SELECTOR and target.lower() == self.pool_address:
+            result = self.current_account_data.get('0x' + data[16:36].hex())
+            return bytes.fromhex(result[2:]) if result is not None else None
+        return super().answer_call(target, data)
+
+
+class ReplayDatabase():
+    """The recorded accounts, all tracked. Notified accounts are not checked again, so every account is alerted once."""
+    def __init__(self, chain: Chain, meta: FixtureMeta) -> None:
+        self.accounts = [
+            ChainAccountWithAllData(ChainAccount(address, chain, meta.aave_version), health_factor_threshold=threshold, user_id=f'replay-{i}', onesignal_id=None)
+            for i, (address, threshold) in enumerate(meta.accounts)
+        ]
+        self.tracked = {address.lower() for address, _ in meta.accounts}
+        self.notified: set[str] = set()
+        self.settings: dict[str, str] = {}
+
+    def iter_accounts_for_hf_check(self, chain: Chain | None = None, aave_version: int | None = None) -> Generator[list[ChainAccountWithAllData], None, None]:
+        accounts = [account for account in self.accounts if account.account.address.lower() not in self.notified]
+        yield from make_batches(accounts, ACCOUNTS_PAGE_SIZE)
+
+    def get_accounts_for_hf_check(self, chain: Chain | None = None, aave_version: int | None = None) -> list[ChainAccountWithAllData]:
+        return [account for page in self.iter_accounts_for_hf_check(chain, aave_version) for account in page]
+
+    def get_setting(self, key: str) -> str | None:
+        return self.settings.get(key)
+
+    def set_setting(self, key: str, value: str) -> None:
+        self.settings[key] = value
+
+    def is_tracked(self, account: ChainAccount) -> bool:
+        return account.address.lower() in self.tracked
+
+    def get_health_factor_rows(self, chain: Chain, aave_version: int, min_address: str | None = None, max_address: str | None = None) -> list[dict]:
+        return []  # No health factors of a previous run, the adaptive scheduler starts by checking every account
+
+
+class ReplayNotifier():
+    """Records the block of the simulated clock at which every alert was sent"""
+    def __init__(self, chain: ReplayChain, database: ReplayDatabase) -> None:
+        self.chain = chain
+        self.database = database
+        self.health_factor_alerts: dict[str, int] = {}  # Lowercase address -> block of its first alert
+        self.liquidation_alerts: dict[str, list[int]] = {}  # Lowercase address -> blocks of its alerts
+
+    async def notify_about_health_factors(self, notifications: list[tuple[ChainAccountWithAllData, str]]) -> None:
+        for account, _ in notifications:
+            address = account.account.address.lower()
+            self.health_factor_alerts.setdefault(address, self.chain.block)
+            self.database.notified.add(address)
+
+    async def notify_about_liquidation(self, chain_account: ChainAccount, title: str, message: str) -> None:
+        self.liquidation_alerts.setdefault(chain_account.address.lower(), []).append(self.chain.block)
+
+
+class ReplayWatcher(HealthFactorWatcher):
+    """Prices are not recorded, so no price sources are watched and no position model is loaded"""
+    async def load_price_sources(self) -> None:
+        pass
+
+    async def refresh_model(self, user_configurations: dict[str, int]) -> None:
+        pass
+
+
+class SimulatedClock():
+    """time.time() and time.monotonic() of the simulated block clock, for the modules that schedule by time"""
+    def __init__(self, chain: ReplayChain, from_block: int, block_time: float) -> None:
+        self.chain = chain
+        self.from_block = from_block
+        self.block_time = block_time
+        self.start = time.time()
+
+    def time(self) -> float:
+        return self.start + (self.chain.block - self.from_block) * self.block_time
+
+    def monotonic(self) -> float:
+        return self.time()
+
+
+@contextmanager
+def simulated_time(clock: SimulatedClock) -> Generator[None, None, None]:
+    with mock.patch('backend.scheduling.time', clock), mock.patch('backend.connector.time', clock), mock.patch('backend.accounts.time', clock):
+        yield
+
+
+async def replay(store: FixtureStore, hf_check_interval: int, liquidation_check_interval: int, scheduler: str = 'periodic', block_time: float = DEFAULT_BLOCK_TIME) -> dict:
+    """The periodic scheduler sweeps every hf_check_interval blocks. The incremental one does a full sweep as often
+    and checks the new blocks at every block in between. The adaptive one checks the due accounts at every block.
+    """
+    meta = store.load_meta()
+    chain = Chain(meta.chain)
+    replay_chain = ReplayChain(store, meta)
+    database = ReplayDatabase(chain, meta)
+    notifier = ReplayNotifier(replay_chain, database)
+    connector = AsyncChainConnector(
+        chain=chain,
+        http_rpc_url='http://replay.invalid',
+        notifier=notifier,  # type: ignore[arg-type]
+        database=database,  # type: ignore[arg-type]
+        pool_address=meta.pool_address,
+        aave_version=meta.aave_version,
+    )
+    connector.web3 = AsyncWeb3(InProcessProvider(replay_chain))
+    connector.backfiller.web3 = connector.web3
+    connector.session_attached = True
+    database.set_setting(connector.last_checked_block_setting_key(), str(meta.from_block - 1))
+
+    watcher = ReplayWatcher(connector)
+    adaptive_scheduler = AdaptiveScheduler(connector, HealthFactorStore(database, chain, meta.aave_version))  # type: ignore[arg-type]
+    clock = SimulatedClock(replay_chain, meta.from_block, block_time)
+
+    async def check_health_factors(block: int) -> None:
+        if scheduler == 'periodic':
+            await connector.check_health_factors()
+        elif scheduler == 'incremental':
+            if (block - meta.from_block) % hf_check_interval == 0:
+                await watcher.full_sweep(block)
+            else:
+                await watcher.check_new_blocks(block)
+        else:
+            if adaptive_scheduler.needs_reload():
+                await adaptive_scheduler.reload_accounts()
+            await adaptive_scheduler.check_due_accounts()
+
+    every_block = scheduler != 'periodic'
+    hf_check_blocks = set(range(meta.from_block, meta.to_block + 1, 1 if every_block else hf_check_interval))
+    liquidation_check_blocks = set(range(meta.from_block, meta.to_block + 1, liquidation_check_interval))
+    health_factor_checks = 0
+    start = time.perf_counter()
+    with simulated_time(clock):
+        for block in sorted(hf_check_blocks | liquidation_check_blocks):
+            replay_chain.set_block(block)
+            if block in hf_check_blocks:
+                checked_accounts = replay_chain.calls['aggregate3 inner calls']
+                await check_health_factors(block)
+                health_factor_checks += replay_chain.calls['aggregate3 inner calls'] > checked_accounts
+            if block in liquidation_check_blocks:
+                await connector.catchup_on_liquidations()
+    seconds = time.perf_counter() - start
+
+    liquidation_blocks: dict[str, int] = {}  # Lowercase address -> block of its first liquidation
+    for log in replay_chain.logs:
+        if log['topics'][0] != LIQUIDATION_TOPIC:
+            continue
+        user = '0x' + log['topics'][3][-40:].lower()
+        liquidation_blocks.setdefault(user, int(log['blockNumber'], 16))
+    warning_leads = []
+    alert_delays = []
+    for user, liquidation_block in liquidation_blocks.items():
+        warned_at = notifier.health_factor_alerts.get(user)
+        if warned_at is not None and warned_at <= liquidation_block:
+            warning_leads.append(liquidation_block - warned_at)
+        alerted_at = [block for block in notifier.liquidation_alerts.get(user, []) if block >= liquidation_block]
+        if len(alerted_at) > 0:
+            alert_delays.append(alerted_at[0] - liquidation_block)
+
+    checked_accounts = replay_chain.calls['aggregate3 inner calls']
+    return {
+        'replayed_blocks': meta.to_block - meta.from_block + 1,
+        'health_factor_checks': health_factor_checks,  # Ticks of the scheduler that checked accounts
+        'checked_accounts': checked_accounts,
+        'seconds': seconds,
+        'blocks_per_second': (meta.to_block - meta.from_block + 1) / seconds,
+        'account_checks_per_second': checked_accounts / seconds,
+        'liquidated_accounts': len(liquidation_blocks),
+        'warned_before_liquidation': len(warning_leads),
+        'median_warning_lead_blocks': statistics.median(warning_leads) if len(warning_leads) > 0 else None,
+        'liquidation_alerts': len(alert_delays),
+        'median_alert_delay_blocks': statistics.median(alert_delays) if len(alert_delays) > 0 else None,
+        'max_alert_delay_blocks': max(alert_delays) if len(alert_delays) > 0 else None,
+    }
+
+
+def print_report(result: dict, block_time: float) -> None:
+    for key, value in result.items():
+        if value is None:
+            print(f'  {key:<32} {"-":>12}')
+        elif key.endswith('_blocks') and key != 'replayed_blocks':
+            print(f'  {key:<32} {value:>12g} (~{value * block_time:g}s)')
+        else:
+            print(f'  {key:<32} {value:>12.4g}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    record_parser = subparsers.add_parser('record')
+    record_parser.add_argument('--rpc-url', required=True, help='archive node')
+    record_parser.add_argument('--chain', choices=[chain.value for chain in Chain], required=True)
+    record_parser.add_argument('--aave-version', type=int, choices=[2, 3], required=True)
+    record_parser.add_argument('--pool-address', required=True)
+    record_parser.add_argument('--from-block', type=int, required=True)
+    record_parser.add_argument('--to-block', type=int, required=True)
+    record_parser.add_argument('--step', type=int, default=10, help='account data is recorded at every step-th block')
+    record_parser.add_argument('--accounts', help='JSON file with [address, threshold] pairs to record besides the liquidated accounts')
+    record_parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help='threshold of the liquidated accounts')
+    record_parser.add_argument('--fixtures', required=True, help='fixture directory')
+    run_parser = subparsers.add_parser('run')
+    run_parser.add_argument('--fixtures', required=True, help='fixture directory')
+    run_parser.add_argument('--scheduler', choices=SCHEDULERS, default='periodic', help='how health factor checks are scheduled')
+    run_parser.add_argument('--hf-check-interval', type=int, default=DEFAULT_CHECK_INTERVAL, help='blocks between health factor sweeps (full sweeps of the incremental scheduler)')
+    run_parser.add_argument('--liquidation-check-interval', type=int, default=DEFAULT_CHECK_INTERVAL, help='blocks between liquidation catchups')
+    run_parser.add_argument('--block-time', type=float, default=DEFAULT_BLOCK_TIME, help='seconds, the simulated clock of the adaptive scheduler and the report')
+    args = parser.parse_args()
+
+    store = FixtureStore(args.fixtures)
+    if args.command == 'record':
+        logging.basicConfig(level=logging.INFO, force=True)
+        accounts = []
+        if args.accounts is not None:
+            with open(args.accounts) as f:
+                accounts = [(address, threshold) for address, threshold in json.loads(f.read())]
+        meta = asyncio.run(record(store, args.rpc_url, Chain(args.chain), args.aave_version, args.pool_address, args.from_block, args.to_block, args.step, accounts, args.threshold))
+        print(f'Recorded {len(meta.accounts)} accounts over blocks {meta.from_block}-{meta.to_block} into {args.fixtures}')
+        return
+
+    logging.basicConfig(level=logging.WARNING, force=True)
+    print(f'Replaying {args.fixtures} with the {args.scheduler} scheduler, health factor sweeps every {args.hf_check_interval} blocks and liquidation checks every {args.liquidation_check_interval} blocks')
+    print_report(asyncio.run(replay(store, args.hf_check_interval, args.liquidation_check_interval, args.scheduler, args.block_time)), args.block_time)
+
+
+if __name__ == '__main__':
+    main()
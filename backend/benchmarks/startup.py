@@ -0,0 +1,77 @@
+"""Measures how long a fresh process takes to import the backend and create the database, the notifiers and the connectors,
+i.e. everything __main__ does before the monitoring tasks start. Every run is a new interpreter, so nothing is cached.
+
+Run with `python -m backend.benchmarks.startup`
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+CONNECTORS_COUNT = 15  # As many as __main__ creates for all the pools
+POOL_ADDRESS = '0x794a61358D6845594F94dc1DB02A252b5b4814aD'
+STARTUP_BUDGET = 1.0  # seconds
+
+
+def measure_startup(mode: str) -> dict[str, float]:
+    """Runs in the child process. Returns seconds spent in every startup stage."""
+    os.environ.setdefault('ONESIGNAL_APP_KEY', 'benchmark')
+    os.environ.setdefault('ONESIGNAL_APP_ID', 'benchmark')
+    os.environ.setdefault('TG_BOT_TOKEN', '1:benchmark')
+    stages = {}
+
+    start = time.perf_counter()
+    from backend.connector import AsyncChainConnector, ChainConnector
+    from backend.database import Database
+    from backend.dispatcher import NotificationDispatcher
+    from backend.notifier import AsyncNotifier, Notifier
+    from backend.types import Chain
+    stages['import'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    database = Database(supabase_url='http://127.0.0.1:1', supabase_key='benchmark.supabase.key')
+    notifier = Notifier(database=database)
+    async_notifier = AsyncNotifier(database=database, dispatcher=NotificationDispatcher(app_id='benchmark', app_key='benchmark'))
+    stages['clients'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pools = [(chain, aave_version) for chain in Chain for aave_version in (2, 3)][:CONNECTORS_COUNT]
+    for chain, aave_version in pools:
+        if mode == 'async':
+            AsyncChainConnector(chain=chain, http_rpc_url='http://127.0.0.1:1', notifier=async_notifier, database=database, pool_address=POOL_ADDRESS, aave_version=aave_version)
+        else:
+            ChainConnector(chain=chain, http_rpc_url='http://127.0.0.1:1', notifier=notifier, database=database, pool_address=POOL_ADDRESS, aave_version=aave_version)
+    stages['connectors'] = time.perf_counter() - start
+    return stages
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=['async', 'blocking'], default='async')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure_startup(args.mode)))
+        return
+
+    runs = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-m', 'backend.benchmarks.startup', '--mode', args.mode, '--child'], capture_output=True, text=True, check=True).stdout
+        stages = json.loads(output.splitlines()[-1])
+        stages['interpreter'] = time.perf_counter() - start - sum(stages.values())  # Interpreter startup and shutdown
+        runs.append(stages)
+
+    for stage in runs[0]:
+        print(f'{stage:<12} {statistics.median(run[stage] for run in runs):8.3f}s')
+    total = statistics.median(sum(run.values()) for run in runs)
+    print(f'{"total":<12} {total:8.3f}s ({"within" if total <= STARTUP_BUDGET else "over"} the {STARTUP_BUDGET}s budget)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Hand-written ABI codec for the few pool methods that are called for every tracked account.
+Aave V2 and V3 pools share the signatures and the return layouts of these methods,
+so the calldata is just a precomputed selector followed by the left-padded address.
+"""
+from typing import NamedTuple
+
+from eth_abi import decode
+from eth_utils import function_signature_to_4byte_selector
+# web3 has no public formatter for raw logs of JSON-RPC responses. This private one is the formatter that web3 applies
+# to eth_getLogs results and is stable in web3==6.8.0, pinned in requirements.txt. Check it when upgrading web3.
+from web3._utils.method_formatters import log_entry_formatter
+from web3.types import LogReceipt
+
+GET_USER_ACCOUNT_DATA_SELECTOR = function_signature_to_4byte_selector('getUserAccountData(address)')
+GET_USER_CONFIGURATION_SELECTOR = function_signature_to_4byte_selector('getUserConfiguration(address)')
+BALANCE_OF_SELECTOR = function_signature_to_4byte_selector('balanceOf(address)')
+SYMBOL_SELECTOR = function_signature_to_4byte_selector('symbol()')
+DECIMALS_SELECTOR = function_signature_to_4byte_selector('decimals()')
+ADDRESS_PADDING = bytes(12)
+WORD_SIZE = 32
+MAX_UINT256 = 2 ** 256 - 1
+
+
+class UserAccountData(NamedTuple):
+    """Result of getUserAccountData. Amounts are in ETH (V2) or in the base currency of the market (V3)."""
+    total_collateral: int
+    total_debt: int
+    available_borrows: int
+    current_liquidation_threshold: int
+    ltv: int
+    health_factor: int
+
+    def health_factor_float(self) -> float:
+        """-1 means that the account has no debt"""
+        if self.health_factor == MAX_UINT256:
+            return -1
+        return self.health_factor / 1e18
+
+
+def encode_address_call(selector: bytes, address: str) -> bytes:
+    return selector + ADDRESS_PADDING + bytes.fromhex(address[2:])
+
+
+def encode_get_user_account_data(address: str) -> bytes:
+    return encode_address_call(GET_USER_ACCOUNT_DATA_SELECTOR, address)
+
+
+def encode_get_user_configuration(address: str) -> bytes:
+    return encode_address_call(GET_USER_CONFIGURATION_SELECTOR, address)
+
+
+def encode_balance_of(address: str) -> bytes:
+    return encode_address_call(BALANCE_OF_SELECTOR, address)
+
+
+def decode_uint256(data: bytes, index: int = 0) -> int:
+    return int.from_bytes(data[index * WORD_SIZE:(index + 1) * WORD_SIZE], 'big')
+
+
+def decode_string(data: bytes) -> str:
+    """Decode a string result. Some old tokens (e.g. MKR) return their symbol as bytes32."""
+    if len(data) == WORD_SIZE:
+        return data.rstrip(b'\0').decode(errors='replace')
+    return decode(['string'], data)[0]
+
+
+def decode_user_account_data(data: bytes) -> UserAccountData:
+    view = memoryview(data)
+    return UserAccountData(*(int.from_bytes(view[i:i + WORD_SIZE], 'big') for i in range(0, 6 * WORD_SIZE, WORD_SIZE)))
+
+
+def decode_user_account_data_bulk(results: list[bytes | None]) -> list[UserAccountData | None]:
+    """Decode multicall results. Failed calls and malformed results are decoded as None."""
+    return [
+        decode_user_account_data(data) if data is not None and len(data) == 6 * WORD_SIZE else None
+        for data in results
+    ]
+
+
+def decode_log(raw_log: dict) -> LogReceipt:
+    """Format a raw log of eth_getLogs or of a logs subscription like web3 does"""
+    return log_entry_formatter(raw_log)
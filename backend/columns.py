@@ -0,0 +1,142 @@
+"""Columnar storage of the accounts to check, so memory and sweep CPU per account stay flat as the number of accounts grows.
+An account is a row: its address is a 20-byte buffer, its threshold and timestamps are NumPy floats and its user is an index into the interned user ids.
+"""
+import logging
+
+import numpy as np
+from eth_utils import is_hex_address
+
+from backend.codec import ADDRESS_PADDING, GET_USER_ACCOUNT_DATA_SELECTOR, WORD_SIZE
+from backend.types import Chain, ChainAccount, ChainAccountWithAllData
+
+ADDRESS_DTYPE = np.dtype('V20')
+HEX_DIGITS = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+CASE_BITS = np.uint64(1) << np.arange(39, -1, -1, dtype=np.uint64)  # Bit of every hex character of an address in the case mask
+NO_DEBT_WORDS = np.full(4, 2 ** 64 - 1, dtype=np.uint64)  # MAX_UINT256 health factor as big-endian 64-bit words
+WORD_WEIGHTS = np.array([2.0 ** 192, 2.0 ** 128, 2.0 ** 64, 1.0])
+
+
+def parse_addresses(addresses: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    """Returns 20-byte addresses and the masks of their uppercase characters, so the original strings can be restored exactly"""
+    hex_addresses = ''.join(address[2:] for address in addresses)
+    characters = np.frombuffer(hex_addresses.encode('ascii'), dtype=np.uint8).reshape(-1, 40)
+    is_upper = (characters >= ord('A')) & (characters <= ord('F'))
+    case_masks = (is_upper * CASE_BITS).sum(axis=1, dtype=np.uint64)
+    return np.frombuffer(bytes.fromhex(hex_addresses), dtype=ADDRESS_DTYPE), case_masks
+
+
+def format_addresses(addresses: np.ndarray, case_masks: np.ndarray) -> list[str]:
+    """Inverse of parse_addresses"""
+    address_bytes = addresses.view(np.uint8).reshape(-1, 20)
+    characters = HEX_DIGITS[np.stack([address_bytes >> 4, address_bytes & 0xF], axis=2).reshape(-1, 40)]
+    is_upper = (case_masks[:, None] & CASE_BITS) != 0
+    characters = np.where(is_upper & (characters >= ord('a')), characters - 32, characters).astype(np.uint8)
+    text = characters.tobytes().decode('ascii')
+    return ['0x' + text[i:i + 40] for i in range(0, len(text), 40)]
+
+
+def encode_get_user_account_data_calls(addresses: np.ndarray) -> list[bytes]:
+    return [GET_USER_ACCOUNT_DATA_SELECTOR + ADDRESS_PADDING + address.tobytes() for address in addresses]
+
+
+def decode_health_factors(results: list[bytes | None]) -> np.ndarray:
+    """Health factors of getUserAccountData results. NaN for failed calls and -1 for accounts without debt."""
+    health_factors = np.full(len(results), np.nan)
+    valid = [i for i, result in enumerate(results) if result is not None and len(result) == 6 * WORD_SIZE]
+    if len(valid) == 0:
+        return health_factors
+    words = np.frombuffer(b''.join(results[i][5 * WORD_SIZE:] for i in valid), dtype='>u8').reshape(-1, 4)  # type: ignore[index]
+    no_debt = (words == NO_DEBT_WORDS).all(axis=1)
+    health_factors[valid] = np.where(no_debt, -1, (words.astype(np.float64) @ WORD_WEIGHTS) / 1e18)
+    return health_factors
+
+
+class AccountTable():
+    """Accounts of one pool, one row per (address, user). Rows are added page by page with append and become readable after pack.
+    Accounts whose address is not 40 hex characters can't be queried, so they are skipped.
+    """
+    def __init__(self, chain: Chain, aave_version: int) -> None:
+        self.chain = chain
+        self.aave_version = aave_version
+        self.addresses = np.zeros(0, dtype=ADDRESS_DTYPE)
+        self.case_masks = np.zeros(0, dtype=np.uint64)
+        self.thresholds = np.zeros(0)
+        self.user_indexes = np.zeros(0, dtype=np.int32)
+        self.last_notified = np.zeros(0)  # Unix timestamps of notifications sent by this process, 0 if none
+        self.user_ids: list[str] = []
+        self.onesignal_ids: list[str | None] = []  # By user index
+        self.user_index_by_id: dict[str, int] = {}
+        self.chunks: list[tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]] = []
+
+    def __len__(self) -> int:
+        return len(self.addresses)
+
+    def intern_user(self, user_id: str, onesignal_id: str | None) -> int:
+        index = self.user_index_by_id.get(user_id)
+        if index is None:
+            index = len(self.user_ids)
+            self.user_index_by_id[user_id] = index
+            self.user_ids.append(user_id)
+            self.onesignal_ids.append(onesignal_id)
+        return index
+
+    def append(self, accounts: list[ChainAccountWithAllData]) -> None:
+        valid_accounts = [account for account in accounts if is_hex_address(account.account.address)]
+        if len(valid_accounts) < len(accounts):
+            logging.warning('Skipping %d accounts with invalid addresses on %s x Aave V%d', len(accounts) - len(valid_accounts), self.chain.name, self.aave_version)
+            accounts = valid_accounts
+        addresses, case_masks = parse_addresses([account.account.address for account in accounts])
+        thresholds = np.array([account.health_factor_threshold for account in accounts], dtype=np.float64)
+        user_indexes = np.array([self.intern_user(account.user_id, account.onesignal_id) for account in accounts], dtype=np.int32)
+        self.chunks.append((addresses, case_masks, thresholds, user_indexes))
+
+    def pack(self) -> None:
+        if len(self.chunks) == 0:
+            return
+        self.addresses, self.case_masks, self.thresholds, self.user_indexes = (
+            np.concatenate([getattr(self, name)] + [chunk[i] for chunk in self.chunks])
+            for i, name in enumerate(('addresses', 'case_masks', 'thresholds', 'user_indexes'))
+        )
+        self.last_notified = np.concatenate([self.last_notified, np.zeros(len(self.addresses) - len(self.last_notified))])
+        self.chunks = []
+
+    def get_addresses(self, rows: np.ndarray) -> list[str]:
+        return format_addresses(self.addresses[rows], self.case_masks[rows])
+
+    def to_accounts(self, rows: np.ndarray) -> list[ChainAccountWithAllData]:
+        return [
+            ChainAccountWithAllData(
+                account=ChainAccount(address=address, chain=self.chain, aave_version=self.aave_version),
+                health_factor_threshold=threshold,
+                user_id=self.user_ids[user_index],
+                onesignal_id=self.onesignal_ids[user_index],
+            )
+            for address, threshold, user_index in zip(self.get_addresses(rows), self.thresholds[rows].tolist(), self.user_indexes[rows].tolist())
+        ]
+
+    def get_active_rows(self, notified_before: float) -> np.ndarray:
+        """Rows that were not notified after the given timestamp"""
+        return np.flatnonzero(self.last_notified < notified_before)
+
+    def get_address_ranges(self, rows: np.ndarray, address_ranges: int) -> np.ndarray:
+        """Same as sharding.get_address_range for every row"""
+        prefixes = self.addresses[rows].view(np.uint8).reshape(-1, 20)[:, :4].astype(np.uint64)
+        prefixes = (prefixes[:, 0] << 24) | (prefixes[:, 1] << 16) | (prefixes[:, 2] << 8) | prefixes[:, 3]
+        return (prefixes * np.uint64(address_ranges)) >> np.uint64(32)
+
+    def find_rows(self, accounts: list[ChainAccountWithAllData]) -> np.ndarray:
+        rows: list[int] = []
+        for account in accounts:
+            user_index = self.user_index_by_id.get(account.user_id)
+            if user_index is None:
+                continue
+            candidates = np.flatnonzero(self.user_indexes == user_index)
+            rows += [row for row, address in zip(candidates.tolist(), self.get_addresses(candidates)) if address == account.account.address]
+        return np.array(rows, dtype=np.int64)
+
+    def mark_notified(self, rows: np.ndarray, notified_at: float) -> None:
+        self.last_notified[rows] = notified_at
+
+    def is_below_threshold(self, rows: np.ndarray, health_factors: np.ndarray) -> np.ndarray:
+        """Same as BaseChainConnector.is_below_threshold for every row. Failed queries are NaN, so they never are."""
+        return (health_factors < self.thresholds[rows]) & (health_factors != -1)
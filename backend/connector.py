@@ -1,24 +1,44 @@
 import asyncio
-import json
+import functools
 import logging
+import time
 import traceback
-from typing import Generator
+from typing import Generator, Protocol
 
+import numpy as np
 from eth_utils import to_checksum_address
-from web3 import HTTPProvider, Web3
-from web3.contract import Contract
-from web3.types import HexBytes, LogReceipt
+from web3 import AsyncWeb3, HTTPProvider, Web3
+from web3.contract import AsyncContract, Contract
+from web3.types import FilterParams, HexBytes, LogReceipt
 
+from backend.abi import load_abi
+from backend.accounts import HealthFactorAccountsLoader
 from backend.admin import send_admin_message
-from backend.database import Database
-from backend.notifier import Notifier
+from backend.backfill import LogBackfiller
+from backend.batching import MulticallBatcher
+from backend.codec import UserAccountData, decode_user_account_data_bulk, encode_get_user_account_data
+from backend.columns import AccountTable, decode_health_factors, encode_get_user_account_data_calls
+from backend.jsonrpc import get_json_rpc_batcher
+from backend.logqueue import log_context, new_sweep_id
+from backend.metrics import BLOCK_LAG, SWEEP_ACCOUNTS, SWEEP_SECONDS, rpc_metrics_middleware, traced
+from backend.database import HEALTH_FACTOR_NOTIFICATION_INTERVAL, Database
+from backend.notifier import AsyncNotifier, Notifier
+from backend.periodic import HEALTH_FACTOR_CHECK_PERIOD, PeriodicSweeper
+from backend.ratelimit import Priority, rate_limit_middleware, rpc_priority
+from backend.rpc import attach_session, make_async_web3
+from backend.rpc_pool import RpcPool
+from backend.scheduling import HealthFactorStore
+from backend.sharding import ShardOwnership
+from backend.stream import LiquidationStream
+from backend.tokens import TokenMetadataCache
+from backend.tracked import USER_TOPIC_FILTER_LIMIT, TrackedAccountsIndex
 from backend.types import Chain, ChainAccount, ChainAccountWithAllData
 
-HEALTH_FACTOR_CHECK_PERIOD = 60 * 15  # every 15 minutes
 LIQUIDATIONS_CHECK_PERIOD = 60 * 15  # every 15 minutes
 HEALTH_FACTOR_BATCH_SIZE = 100  # How many accounts to check at once. Limited by max gas per call.
-MAX_UINT256 = 2 ** 256 - 1
 MAX_BLOCK_RANGE = 100
+MAX_PROCESSED_LIQUIDATIONS = 10_000  # How many processed liquidation logs are remembered to skip the ones delivered twice
+NOT_TRACKED_LOG_SAMPLING = 100  # Only one of this many liquidations of untracked addresses is logged per pool
 
 LIQUIDATION_TOPIC = '0xe413a321e8681d831f4dbccbca790d2952b56f977908e45be37335533e005286'
 MULTICALL_ADDRESS = '0xcA11bde05977b3631167028862bE2a173976CA11'
@@ -36,73 +56,120 @@ def build_subscription_message(pool_address: str, liquidation_topic: str) -> dic
     }]}
 
 
+def address_to_topic(address: str) -> str:
+    return '0x' + '0' * 24 + address[2:].lower()
+
+
 def make_batches(lst: list, batch_size: int) -> Generator[list, None, None]:
     """Yield successive n-sized batches from lst."""
     for i in range(0, len(lst), batch_size):
         yield lst[i:i + batch_size]
 
 
-class ChainConnector():
+def to_health_factors(accounts_data: list[UserAccountData | None]) -> list[float | None]:
+    return [account_data.health_factor_float() if account_data is not None else None for account_data in accounts_data]
+
+
+class HealthFactorMonitor(Protocol):
+    """Strategy of AsyncChainConnector.monitor_health_factor: PeriodicSweeper, HealthFactorWatcher or AdaptiveScheduler"""
+    async def run(self) -> None:
+        """Check health factors until cancelled"""
+
+
+class BaseChainConnector():
+    """Chain and pool configuration shared by the sync and the async connectors"""
     def __init__(
             self,
             chain: Chain,
             http_rpc_url: str,
-            notifier: Notifier,
+            notifier: Notifier | AsyncNotifier,
             database: Database,
             pool_address: str,
             aave_version: int,
     ) -> None:
         self.http_rpc_url = http_rpc_url
-        self.web3 = Web3(HTTPProvider(http_rpc_url))
         self.chain = chain
         self.notifier = notifier
         self.database = database
         self.pool_address = pool_address
         self.aave_version = aave_version
 
-        with open(f'./backend/abi/v{aave_version}_pool.json') as f:
-            pool_abi = json.loads(f.read())
-        
-        with open('./backend/abi/erc20.json') as f:
-            erc20_abi = json.loads(f.read())
+        self.pool_abi = load_abi(f'v{aave_version}_pool')
+        self.erc20_abi = load_abi('erc20')
+        self.multicall_abi = load_abi('multicall')
 
-        with open('./backend/abi/multicall.json') as f:
-            multicall_abi = json.loads(f.read())
-        
-        self.erc20_abi = erc20_abi
-        self.pool_contract: Contract = self.web3.eth.contract(
-            address=pool_address,
-            abi=pool_abi,
-        )
-        self.multical_contract: Contract = self.web3.eth.contract(
-            address=MULTICALL_ADDRESS,
-            abi=multicall_abi,
+    def last_checked_block_setting_key(self) -> str:
+        return f'LAST_{self.chain.name}_V{self.aave_version}_CHECKED_BLOCK'
+
+    def last_streamed_log_setting_key(self) -> str:
+        return f'LAST_{self.chain.name}_V{self.aave_version}_STREAMED_LIQUIDATION'
+
+    def health_factor_message(self, account: ChainAccountWithAllData, health_factor: float) -> str:
+        return f'Health factor on your account {str(self.chain)} {account.account.address} is {health_factor:.2f} which is below the threshold of {account.health_factor_threshold}.'
+
+    def is_below_threshold(self, account: ChainAccountWithAllData, health_factor: float | None) -> bool:
+        return health_factor is not None and health_factor < account.health_factor_threshold and health_factor != -1
+
+    def log_health_factors_count(self, health_factors: list[float | None]) -> None:
+        failed_count = health_factors.count(None)
+        self.log_checked_counts(len(health_factors) - failed_count, failed_count)
+
+    def log_checked_counts(self, checked_count: int, failed_count: int) -> None:
+        logging.info('Got %d health factors on %s x Aave V%d', checked_count, self.chain.name, self.aave_version)
+        if failed_count > 0:
+            logging.warning('Could not get %d health factors on %s x Aave V%d', failed_count, self.chain.name, self.aave_version)
+
+    def liquidation_message(self, user: str, collateral_token_symbol: str, liquidated_collateral_amount: float, debt_token_symbol: str, covered_debt_amount: float) -> str:
+        return f'Your account {user} on chain {self.chain.name} was liquidated. {collateral_token_symbol} {liquidated_collateral_amount} was liquidated to cover {debt_token_symbol} {covered_debt_amount} debt.'
+
+
+class ChainConnector(BaseChainConnector):
+    def __init__(
+            self,
+            chain: Chain,
+            http_rpc_url: str,
+            notifier: Notifier,
+            database: Database,
+            pool_address: str,
+            aave_version: int,
+    ) -> None:
+        super().__init__(
+            chain=chain,
+            http_rpc_url=http_rpc_url,
+            notifier=notifier,
+            database=database,
+            pool_address=pool_address,
+            aave_version=aave_version,
         )
+        self.notifier: Notifier = notifier
+        self.web3 = Web3(HTTPProvider(http_rpc_url))
 
-    def get_health_factors(
+    @functools.cached_property
+    def pool_contract(self) -> Contract:
+        return self.web3.eth.contract(address=self.pool_address, abi=self.pool_abi)
+
+    @functools.cached_property
+    def multical_contract(self) -> Contract:
+        return self.web3.eth.contract(address=MULTICALL_ADDRESS, abi=self.multicall_abi)
+
+    def get_accounts_data(
             self,
             accounts_batch: list[ChainAccountWithAllData],
-    ) -> list[float]:
-        """Get aave health factors of all accounts in the batch"""
-        encoded_calls = []
-        for account in accounts_batch:
-            encoded = self.pool_contract.encodeABI(
-                fn_name='getUserAccountData',
-                args=[account.account.address],
-            )
-            encoded_calls.append((self.pool_contract.address, encoded))
-
-        accounts_data = self.multical_contract.functions.aggregate(encoded_calls).call()[1]
+    ) -> list[UserAccountData | None]:
+        """Get aave account data of all accounts in the batch. None means that the call for the account failed."""
+        encoded_calls = [
+            (self.pool_contract.address, True, encode_get_user_account_data(account.account.address))
+            for account in accounts_batch
+        ]
+        results = self.multical_contract.functions.aggregate3(encoded_calls).call()
+        return decode_user_account_data_bulk([return_data if success else None for success, return_data in results])
 
-        health_factors = []
-        for account_data in accounts_data:
-            raw_health_factor = int.from_bytes(account_data[-32:], "big") 
-            if raw_health_factor == MAX_UINT256:
-                health_factors.append(-1)
-            else:
-                health_factors.append(raw_health_factor / 1e18)
-        
-        return health_factors
+    def get_health_factors(
+            self,
+            accounts_batch: list[ChainAccountWithAllData],
+    ) -> list[float | None]:
+        """Get aave health factors of all accounts in the batch. None means that the call for the account failed."""
+        return to_health_factors(self.get_accounts_data(accounts_batch))
 
     def check_health_factors(self) -> None:
         """
@@ -110,16 +177,18 @@ class ChainConnector():
         2. Check health factor of all these accounts.
         3. Check the health factors against the thresholds and send notifications if needed.
         """
-        logging.info(f'Checking health factors on {self.chain.name} x Aave V{self.aave_version}')
+        logging.info('Checking health factors on %s x Aave V%d', self.chain.name, self.aave_version)
         all_accounts = self.database.get_accounts_for_hf_check(self.chain, self.aave_version)
-        health_factors: list[float] = []
-        for batch in make_batches(all_accounts, HEALTH_FACTOR_BATCH_SIZE):
-            health_factors += self.get_health_factors(batch)
+        unique_accounts = list({account.account: account for account in all_accounts}.values())  # An address tracked by several users is queried once
+        unique_health_factors: dict[ChainAccount, float | None] = {}
+        for batch in make_batches(unique_accounts, HEALTH_FACTOR_BATCH_SIZE):
+            unique_health_factors.update(zip((account.account for account in batch), self.get_health_factors(batch)))
+        health_factors = [unique_health_factors[account.account] for account in all_accounts]
         
-        logging.info(f'Got {len(health_factors)} health factors on {self.chain.name} x Aave V{self.aave_version}')
+        self.log_health_factors_count(health_factors)
         for account, health_factor in zip(all_accounts, health_factors):
-            if health_factor < account.health_factor_threshold and health_factor != -1:
-                message = f'Health factor on your account {str(self.chain)} {account.account.address} is {health_factor:.2f} which is below the threshold of {account.health_factor_threshold}.'
+            if self.is_below_threshold(account, health_factor):
+                message = self.health_factor_message(account, health_factor)
                 self.notifier.notify_about_health_factor(account=account, message=message)
 
     async def monitor_health_factor(self) -> None:
@@ -129,21 +198,21 @@ class ChainConnector():
                 self.check_health_factors()
             except Exception:
                 await send_admin_message('Critical error!')
-                logging.error(f'Error while checking health factors on {self.chain.name} x Aave V{self.aave_version}: {traceback.format_exc()}')
+                logging.error('Error while checking health factors on %s x Aave V%d: %s', self.chain.name, self.aave_version, traceback.format_exc())
                 
             await asyncio.sleep(HEALTH_FACTOR_CHECK_PERIOD)
 
     def catchup_on_liquidations(self) -> None:
         """Catchup on liquidations that occured while the program was not running"""
-        logging.info(f'Checking for liquidations on {self.chain.name} x Aave V{self.aave_version}')
-        setting_key = f'LAST_{self.chain.name}_V{self.aave_version}_CHECKED_BLOCK'
+        logging.info('Checking for liquidations on %s x Aave V%d', self.chain.name, self.aave_version)
+        setting_key = self.last_checked_block_setting_key()
         last_checked_block_raw = self.database.get_setting(setting_key)
         current_block = self.web3.eth.block_number - 1  # Doing -1 because it may be that the current block is not confirmed yet on Avalanche.
         if last_checked_block_raw is None:
-            logging.info(f'No last checked block found. But we set {setting_key} to {current_block}')
+            logging.info('No last checked block found. But we set %s to %d', setting_key, current_block)
             return  # Cant do anything. No state saved.
 
-        logging.info(f'Checking liquidations from block {last_checked_block_raw} to {current_block} on {self.chain.name} x Aave V{self.aave_version}')
+        logging.info('Checking liquidations from block %s to %d on %s x Aave V%d', last_checked_block_raw, current_block, self.chain.name, self.aave_version)
         last_checked_block = int(last_checked_block_raw)
         logs = []
         for from_block in range(last_checked_block, current_block, MAX_BLOCK_RANGE):
@@ -153,7 +222,7 @@ class ChainConnector():
                 'fromBlock': from_block,
                 'toBlock': min(current_block, from_block + MAX_BLOCK_RANGE),
             })
-        logging.info(f'Found {len(logs)} liquidations on {self.chain.name} x Aave V{self.aave_version}')
+        logging.info('Found %d liquidations on %s x Aave V%d', len(logs), self.chain.name, self.aave_version)
         for log in logs:
             self.process_liquidation_log(log)
 
@@ -171,10 +240,10 @@ class ChainConnector():
             aave_version=self.aave_version,
         )
         if not self.database.is_tracked(account):
-            logging.info(f'The liquidated address {user} is not being tracked on {self.chain.name} x Aave V{self.aave_version}. Skipping.')
+            logging.info('The liquidated address %s is not being tracked on %s x Aave V%d. Skipping.', user, self.chain.name, self.aave_version, extra={'sample_every': NOT_TRACKED_LOG_SAMPLING})
             return
 
-        logging.info(f'The liquidated address {user} is being tracked on {self.chain.name} x Aave V{self.aave_version}! Querying data for the notification.')
+        logging.info('The liquidated address %s is being tracked on %s x Aave V%d! Querying data for the notification.', user, self.chain.name, self.aave_version)
         covered_debt_amount_raw = int(log['data'][:32].hex(), 16)
         liquidated_collateral_amount_raw = int(log['data'][32:64].hex(), 16)
 
@@ -186,8 +255,8 @@ class ChainConnector():
         debt_token_decimals = self.web3.eth.contract(address=debt_token_address, abi=self.erc20_abi).functions.decimals().call()  # type: ignore[call-overload]
         covered_debt_amount = covered_debt_amount_raw / 10 ** debt_token_decimals
         
-        logging.info(f'Queried data for the liquidation of {user} on {self.chain.name} x Aave V{self.aave_version}. Sending the notification!')
-        message = f'Your account {user} on chain {self.chain.name} was liquidated. {collateral_token_symbol} {liquidated_collateral_amount} was liquidated to cover {debt_token_symbol} {covered_debt_amount} debt.'
+        logging.info('Queried data for the liquidation of %s on %s x Aave V%d. Sending the notification!', user, self.chain.name, self.aave_version)
+        message = self.liquidation_message(user, collateral_token_symbol, liquidated_collateral_amount, debt_token_symbol, covered_debt_amount)
         self.notifier.notify_about_liquidation(chain_account=account, title='Liquidation occured!', message=message)
 
     async def monitor_liquidations(self):
@@ -197,5 +266,339 @@ class ChainConnector():
                 self.catchup_on_liquidations()
             except Exception:
                 await send_admin_message('Critical error!')
-                logging.error(f'Error while catching up on liquidations on {self.chain.name} x Aave V{self.aave_version}: {traceback.format_exc()}')
+                logging.error('Error while catching up on liquidations on %s x Aave V%d: %s', self.chain.name, self.aave_version, traceback.format_exc())
             await asyncio.sleep(LIQUIDATIONS_CHECK_PERIOD)
+
+
+class AsyncChainConnector(BaseChainConnector):
+    """Same as ChainConnector but all RPC calls are non-blocking, so a slow chain doesn't stall the other connectors.
+    Blocking database calls are moved to worker threads and notifications are queued to the dispatcher.
+    With a tracked accounts index liquidation logs are filtered in memory instead of querying the database for every log.
+    With a token metadata cache liquidation notifications don't need RPC calls for token symbols and decimals.
+    With an RPC pool requests are spread across several endpoints of the chain with hedging and failover.
+    With an accounts loader the accounts of all connectors are loaded with one query and cached between sweeps.
+    In the sharded mode only the accounts and liquidations of the shards owned by this worker are monitored.
+    With a websocket RPC url liquidations are streamed through a logs subscription instead of being polled.
+    With batched RPC the log and block number calls of all connectors of an endpoint are merged into JSON-RPC batches.
+    """
+    def __init__(
+            self,
+            chain: Chain,
+            http_rpc_url: str,
+            notifier: AsyncNotifier,
+            database: Database,
+            pool_address: str,
+            aave_version: int,
+            tracked_index: TrackedAccountsIndex | None = None,
+            token_cache: TokenMetadataCache | None = None,
+            rpc_pool: RpcPool | None = None,
+            accounts_loader: HealthFactorAccountsLoader | None = None,
+            shards: ShardOwnership | None = None,
+            ws_rpc_url: str | None = None,
+            batch_rpc: bool = False,
+    ) -> None:
+        super().__init__(
+            chain=chain,
+            http_rpc_url=http_rpc_url,
+            notifier=notifier,
+            database=database,
+            pool_address=pool_address,
+            aave_version=aave_version,
+        )
+        self.notifier: AsyncNotifier = notifier
+        self.rpc_pool = rpc_pool
+        self.accounts_loader = accounts_loader
+        self.shards = shards
+        self.web3: AsyncWeb3 = AsyncWeb3(rpc_pool) if rpc_pool is not None else make_async_web3(http_rpc_url)
+        self.web3.middleware_onion.add(rpc_metrics_middleware(chain.name), 'metrics')
+        if rpc_pool is None:  # The pool charges the quota of every endpoint it sends to itself
+            self.web3.middleware_onion.add(rate_limit_middleware(http_rpc_url), 'rate_limit')
+        self.json_rpc = get_json_rpc_batcher(chain.name, http_rpc_url, rpc_pool) if batch_rpc else None
+        self.backfiller = LogBackfiller(self.web3, http_rpc_url, block_range=MAX_BLOCK_RANGE, json_rpc=self.json_rpc)
+        self.session_attached = False
+        self.tracked_index = tracked_index
+        self.token_cache = token_cache
+        self.reserve_tokens_cached = False
+        self.ws_rpc_url = ws_rpc_url
+        self.processed_liquidations: dict[tuple[str, int], None] = {}  # (transaction hash, log index), oldest first
+        self.last_streamed_log: tuple[int, int] | None = None  # (block, log index) of the last liquidation handled by the stream
+
+    # Contracts are built on first use, building them for all the connectors would slow down the startup
+    @functools.cached_property
+    def pool_contract(self) -> AsyncContract:
+        return self.web3.eth.contract(address=self.pool_address, abi=self.pool_abi)
+
+    @functools.cached_property
+    def multical_contract(self) -> AsyncContract:
+        return self.web3.eth.contract(address=MULTICALL_ADDRESS, abi=self.multicall_abi)
+
+    @functools.cached_property
+    def batcher(self) -> MulticallBatcher:
+        return MulticallBatcher(self.multical_contract, self.http_rpc_url, batch_size=HEALTH_FACTOR_BATCH_SIZE)
+
+    async def connect(self) -> None:
+        """Share the pooled HTTP session of the RPC host. Must be called from the running event loop."""
+        if not self.session_attached and self.rpc_pool is None:  # The pool uses the pooled sessions of all its endpoints itself
+            await attach_session(self.web3, self.http_rpc_url)
+            self.session_attached = True
+
+    async def get_block_number(self) -> int:
+        if self.json_rpc is not None:
+            return await self.json_rpc.get_block_number()
+        return await self.web3.eth.block_number
+
+    async def get_logs(self, filter_params: FilterParams) -> list[LogReceipt]:
+        if self.json_rpc is not None:
+            return await self.json_rpc.get_logs(filter_params)
+        return await self.web3.eth.get_logs(filter_params)
+
+    async def get_accounts_data(
+            self,
+            accounts: list[ChainAccountWithAllData],
+    ) -> list[UserAccountData | None]:
+        """Get aave account data of all accounts. Batches are sent concurrently. None means that the call for the account failed.
+        An address tracked by several users is queried once.
+        """
+        addresses = list(dict.fromkeys(account.account.address.lower() for account in accounts))
+        encoded_calls = [(self.pool_contract.address, encode_get_user_account_data(address)) for address in addresses]
+        accounts_data = dict(zip(addresses, decode_user_account_data_bulk(await self.batcher.aggregate(encoded_calls))))
+        return [accounts_data[account.account.address.lower()] for account in accounts]
+
+    async def get_health_factors(
+            self,
+            accounts: list[ChainAccountWithAllData],
+    ) -> list[float | None]:
+        """Get aave health factors of all accounts. None means that the call for the account failed."""
+        return to_health_factors(await self.get_accounts_data(accounts))
+
+    def get_shards_generation(self) -> int:
+        return self.shards.generation if self.shards is not None else 0
+
+    async def load_accounts_for_hf_check(self) -> list[ChainAccountWithAllData]:
+        if self.accounts_loader is not None:
+            accounts = await self.accounts_loader.get(self.chain, self.aave_version, self.get_shards_generation())
+        else:
+            accounts = await asyncio.to_thread(self.database.get_accounts_for_hf_check, self.chain, self.aave_version)
+        return self.get_owned_accounts(accounts)
+
+    async def get_account_table(self) -> AccountTable:
+        """Snapshot of the accounts loader for the current owned shards"""
+        assert self.accounts_loader is not None
+        shards_generation = self.get_shards_generation()
+        table = await self.accounts_loader.get_table(self.chain, self.aave_version, shards_generation)
+        while shards_generation != self.get_shards_generation():  # Shards were taken over while the snapshot was loading
+            shards_generation = self.get_shards_generation()
+            table = await self.accounts_loader.get_table(self.chain, self.aave_version, shards_generation)
+        return table
+
+    def get_owned_accounts(self, accounts: list[ChainAccountWithAllData]) -> list[ChainAccountWithAllData]:
+        if self.shards is None:
+            return accounts
+        return [account for account in accounts if self.shards.owns_address(self.chain, self.aave_version, account.account.address)]
+
+    async def check_accounts(self, accounts: list[ChainAccountWithAllData], store: HealthFactorStore | None = None) -> list[ChainAccountWithAllData]:
+        """Check health factors of the given accounts and send notifications if needed. Returns the notified accounts.
+        The checked health factors are recorded in the store if given.
+        """
+        accounts = self.get_owned_accounts(accounts)  # Ownership may have changed since the accounts were loaded
+        if len(accounts) == 0:
+            return []
+        SWEEP_ACCOUNTS.inc(len(accounts), chain=self.chain.name, aave_version=self.aave_version)
+        health_factors = await self.get_health_factors(accounts)
+        if store is not None:
+            store.update(accounts, health_factors, time.time())
+
+        self.log_health_factors_count(health_factors)
+        notifications = []
+        for account, health_factor in zip(accounts, health_factors):
+            if self.is_below_threshold(account, health_factor):
+                assert health_factor is not None
+                notifications.append((account, self.health_factor_message(account, health_factor)))
+
+        await self.notifier.notify_about_health_factors(notifications)
+        notified_accounts = [account for account, _ in notifications]
+        if self.accounts_loader is not None:
+            self.accounts_loader.forget(notified_accounts)
+        return notified_accounts
+
+    async def check_account_table(self, table: AccountTable) -> None:
+        """Same as check_accounts for all the accounts of a table. Ownership, deduplication and thresholds are
+        vectorized over the table columns and only the notified rows are turned into ChainAccountWithAllData.
+        """
+        now = time.time()
+        rows = table.get_active_rows(now - HEALTH_FACTOR_NOTIFICATION_INTERVAL)
+        if self.shards is not None:
+            owned_ranges = self.shards.get_owned_address_ranges(self.chain, self.aave_version)
+            rows = rows[np.isin(table.get_address_ranges(rows, self.shards.address_ranges), owned_ranges)]
+        if len(rows) == 0:
+            return
+        SWEEP_ACCOUNTS.inc(len(rows), chain=self.chain.name, aave_version=self.aave_version)
+        addresses, address_indexes = np.unique(table.addresses[rows], return_inverse=True)  # An address tracked by several users is queried once
+        encoded_calls = [(self.pool_contract.address, data) for data in encode_get_user_account_data_calls(addresses)]
+        health_factors = decode_health_factors(await self.batcher.aggregate(encoded_calls))[address_indexes]
+
+        failed_count = int(np.isnan(health_factors).sum())
+        self.log_checked_counts(len(rows) - failed_count, failed_count)
+        below_threshold = table.is_below_threshold(rows, health_factors)
+        notified_rows = rows[below_threshold]
+        accounts = table.to_accounts(notified_rows)
+        await self.notifier.notify_about_health_factors([
+            (account, self.health_factor_message(account, health_factor))
+            for account, health_factor in zip(accounts, health_factors[below_threshold].tolist())
+        ])
+        table.mark_notified(notified_rows, time.time())
+
+    @traced('check_health_factors')
+    async def check_health_factors(self) -> None:
+        """Same as ChainConnector.check_health_factors.
+        Without an accounts loader accounts are streamed from the database page by page and the next page is read while the current one is checked.
+        """
+        logging.info('Checking health factors on %s x Aave V%d', self.chain.name, self.aave_version)
+        with SWEEP_SECONDS.time(chain=self.chain.name, aave_version=self.aave_version, kind='full'), log_context(sweep_id=new_sweep_id()):
+            if self.accounts_loader is not None:
+                await self.check_account_table(await self.get_account_table())
+                return
+
+            pages = self.database.iter_accounts_for_hf_check(self.chain, self.aave_version)
+            next_page = asyncio.create_task(asyncio.to_thread(next, pages, None))
+            while (accounts := await next_page) is not None:
+                next_page = asyncio.create_task(asyncio.to_thread(next, pages, None))
+                await self.check_accounts(accounts)
+
+    async def monitor_health_factor(self, monitor: HealthFactorMonitor | None = None) -> None:
+        """Check health factor of all accounts on this chain with the given monitor, periodically by default"""
+        with log_context(chain=self.chain.name, aave_version=self.aave_version):  # Also for the tasks started by the monitor
+            await (monitor or PeriodicSweeper(self)).run()
+
+    @traced('catchup_on_liquidations')
+    async def catchup_on_liquidations(self) -> int | None:
+        """Catchup on liquidations that occured while the program was not running.
+        Block ranges are fetched concurrently and the last checked block is saved after every processed window.
+        Returns the last checked block.
+        """
+        logging.info('Checking for liquidations on %s x Aave V%d', self.chain.name, self.aave_version)
+        if self.rpc_pool is not None:
+            self.rpc_pool.log_stats()
+        setting_key = self.last_checked_block_setting_key()
+        last_checked_block_raw = await asyncio.to_thread(self.database.get_setting, setting_key)
+        current_block = await self.get_block_number() - 1  # Doing -1 because it may be that the current block is not confirmed yet on Avalanche.
+        if last_checked_block_raw is None:
+            logging.info('No last checked block found. But we set %s to %d', setting_key, current_block)
+            return None  # Cant do anything. No state saved.
+        # The stream saves the last checked block before the block of its last log, the logs of that block it handled are skipped
+        last_streamed_log_raw = await asyncio.to_thread(self.database.get_setting, self.last_streamed_log_setting_key())
+        if last_streamed_log_raw is not None:
+            block, log_index = (int(value) for value in last_streamed_log_raw.split(':'))
+            self.last_streamed_log = max(self.last_streamed_log or (block, log_index), (block, log_index))
+
+        logging.info('Checking liquidations from block %s to %d on %s x Aave V%d', last_checked_block_raw, current_block, self.chain.name, self.aave_version)
+        BLOCK_LAG.set(current_block - int(last_checked_block_raw), chain=self.chain.name, aave_version=self.aave_version, monitor='liquidations')
+        if self.token_cache is not None and not self.reserve_tokens_cached:
+            # Liquidations can only involve reserves of the pool
+            await self.token_cache.get(self.chain, await self.pool_contract.functions.getReservesList().call(), self.batcher)
+            self.reserve_tokens_cached = True
+
+        topics: list = [LIQUIDATION_TOPIC]
+        if self.tracked_index is not None:
+            await self.tracked_index.refresh_if_stale()
+            tracked_addresses = self.tracked_index.get_addresses(self.chain, self.aave_version)
+            if 0 < len(tracked_addresses) <= USER_TOPIC_FILTER_LIMIT:
+                # Only the logs of tracked users. The user is the third indexed argument of LiquidationCall.
+                topics = [LIQUIDATION_TOPIC, None, None, [address_to_topic(address) for address in tracked_addresses]]
+
+        async def process_logs(logs: list[LogReceipt]) -> None:
+            for log in logs:
+                await self.process_liquidation_log(log)
+
+        async def checkpoint(block: int) -> None:
+            await asyncio.to_thread(self.database.set_setting, setting_key, str(block))
+
+        with rpc_priority(Priority.BACKFILL):  # Processing of the found liquidations goes first again
+            logs_count = await self.backfiller.backfill(
+                {'address': self.pool_address, 'topics': topics},
+                from_block=int(last_checked_block_raw) + 1,  # The last checked block was fully processed
+                to_block=current_block,
+                process_logs=process_logs,
+                checkpoint=checkpoint,
+            )
+        logging.info('Found %d liquidations on %s x Aave V%d', logs_count, self.chain.name, self.aave_version)
+        return current_block
+
+    async def process_liquidation_log(self, log: LogReceipt) -> None:
+        """Same as ChainConnector.process_liquidation_log, but a log that was already processed is skipped.
+        A log can be delivered both by the stream and by the gap-fill after a reconnection. Logs without a transaction hash are not deduplicated.
+        Logs up to the last one handled by the stream are skipped also after a restart.
+        """
+        if self.last_streamed_log is not None and (log['blockNumber'], log['logIndex']) <= self.last_streamed_log:
+            return
+        log_key = (log['transactionHash'].hex(), log['logIndex']) if log.get('transactionHash') is not None else None
+        if log_key in self.processed_liquidations:
+            return
+        with rpc_priority(Priority.LIQUIDATIONS):  # Alerts go before the sweeps and backfills that share the quota
+            await self.notify_about_liquidation_log(log)
+        if log_key is None:
+            return
+        self.processed_liquidations[log_key] = None
+        if len(self.processed_liquidations) > MAX_PROCESSED_LIQUIDATIONS:
+            del self.processed_liquidations[next(iter(self.processed_liquidations))]
+
+    async def notify_about_liquidation_log(self, log: LogReceipt) -> None:
+        collateral_token_address = topic_to_address(log['topics'][1])
+        debt_token_address = topic_to_address(log['topics'][2])
+        user = topic_to_address(log['topics'][3])
+
+        account = ChainAccount(
+            address=user,
+            chain=self.chain,
+            aave_version=self.aave_version,
+        )
+        if self.tracked_index is not None:
+            is_tracked = self.tracked_index.is_tracked(account)
+        else:
+            is_tracked = await asyncio.to_thread(self.database.is_tracked, account)
+        if not is_tracked:
+            logging.info('The liquidated address %s is not being tracked on %s x Aave V%d. Skipping.', user, self.chain.name, self.aave_version, extra={'sample_every': NOT_TRACKED_LOG_SAMPLING})
+            return
+
+        logging.info('The liquidated address %s is being tracked on %s x Aave V%d! Querying data for the notification.', user, self.chain.name, self.aave_version)
+        covered_debt_amount_raw = int(log['data'][:32].hex(), 16)
+        liquidated_collateral_amount_raw = int(log['data'][32:64].hex(), 16)
+
+        tokens = {}
+        if self.token_cache is not None:
+            tokens = await self.token_cache.get(self.chain, [collateral_token_address, debt_token_address], self.batcher)
+        if collateral_token_address.lower() in tokens and debt_token_address.lower() in tokens:
+            collateral_token_symbol, collateral_token_decimals = tokens[collateral_token_address.lower()]
+            debt_token_symbol, debt_token_decimals = tokens[debt_token_address.lower()]
+        else:
+            collateral_token = self.web3.eth.contract(address=collateral_token_address, abi=self.erc20_abi)
+            debt_token = self.web3.eth.contract(address=debt_token_address, abi=self.erc20_abi)
+            collateral_token_symbol, collateral_token_decimals, debt_token_symbol, debt_token_decimals = await asyncio.gather(
+                collateral_token.functions.symbol().call(),  # type: ignore[call-overload]
+                collateral_token.functions.decimals().call(),  # type: ignore[call-overload]
+                debt_token.functions.symbol().call(),  # type: ignore[call-overload]
+                debt_token.functions.decimals().call(),  # type: ignore[call-overload]
+            )
+        liquidated_collateral_amount = liquidated_collateral_amount_raw / 10 ** collateral_token_decimals
+        covered_debt_amount = covered_debt_amount_raw / 10 ** debt_token_decimals
+
+        logging.info('Queried data for the liquidation of %s on %s x Aave V%d. Sending the notification!', user, self.chain.name, self.aave_version)
+        message = self.liquidation_message(user, collateral_token_symbol, liquidated_collateral_amount, debt_token_symbol, covered_debt_amount)
+        await self.notifier.notify_about_liquidation(chain_account=account, title='Liquidation occured!', message=message)
+
+    async def monitor_liquidations(self):
+        """Periodically check liquidations on this chain. With a websocket RPC url they are streamed instead."""
+        with log_context(chain=self.chain.name, aave_version=self.aave_version):
+            if self.ws_rpc_url is not None:
+                await LiquidationStream(self, self.ws_rpc_url, build_subscription_message(self.pool_address, LIQUIDATION_TOPIC)).run()
+                return
+
+            while True:
+                try:
+                    if self.shards is None or self.shards.owns_liquidations(self.chain, self.aave_version):
+                        await self.connect()
+                        await self.catchup_on_liquidations()
+                except Exception:
+                    await send_admin_message('Critical error!')
+                    logging.error('Error while catching up on liquidations on %s x Aave V%d: %s', self.chain.name, self.aave_version, traceback.format_exc())
+                await asyncio.sleep(LIQUIDATIONS_CHECK_PERIOD)
@@ -1,29 +1,84 @@
-from datetime import datetime
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Callable, Generator
 
+from postgrest.exceptions import APIError
 from supabase import Client, create_client
 
+from backend.metrics import DB_QUERY_SECONDS, timed
 from backend.types import Chain, ChainAccount, ChainAccountWithAllData
 
 HEALTH_FACTOR_NOTIFICATION_INTERVAL = 60 * 60 * 12  # 12 hours
+NOTIFICATION_TIMESTAMPS_BATCH_SIZE = 500  # Accounts per set_last_health_factor_notifications call
+ACCOUNTS_PAGE_SIZE = 500  # Must not exceed the max rows setting of PostgREST (1000 on Supabase by default)
+HEALTH_FACTOR_ROWS_BATCH_SIZE = 500  # Rows per page, upsert or delete of the health_factor table
 
 class Database:
     def __init__(self, supabase_url: str, supabase_key: str) -> None:
         self.supabase: Client = create_client(supabase_url, supabase_key)
     
+    @timed(DB_QUERY_SECONDS, query='get_setting')
     def get_setting(self, key: str) -> str | None:
         response = self.supabase.table('setting').select('value').eq('key', key).execute()
         if len(response.data) == 0:
             return None
         return response.data[0]['value']
     
+    @timed(DB_QUERY_SECONDS, query='set_setting')
     def set_setting(self, key: str, value: str) -> None:
         self.supabase.table('setting').upsert({'key': key, 'value': value}).execute()
 
+    @timed(DB_QUERY_SECONDS, query='get_health_factor_rows')
+    def get_health_factor_rows(self, chain: Chain, aave_version: int, min_address: str | None = None, max_address: str | None = None) -> list[dict]:
+        """Rows of the health_factor table (backend/sql/health_factor.sql) of one pool, read in pages ordered by address.
+        Optionally only the addresses from min_address included to max_address excluded.
+        """
+        rows: list[dict] = []
+        while True:
+            query = self.supabase.table('health_factor').select('address, health_factor, checked_at, volatility').eq('chain', chain.value).eq('aave_version', aave_version).order('address').limit(HEALTH_FACTOR_ROWS_BATCH_SIZE)
+            if len(rows) > 0:
+                query = query.gt('address', rows[-1]['address'])
+            elif min_address is not None:
+                query = query.gte('address', min_address)
+            if max_address is not None:
+                query = query.lt('address', max_address)
+            page = query.execute().data
+            rows += page
+            if len(page) < HEALTH_FACTOR_ROWS_BATCH_SIZE:
+                return rows
+
+    @timed(DB_QUERY_SECONDS, query='upsert_health_factor_rows')
+    def upsert_health_factor_rows(self, chain: Chain, aave_version: int, rows: list[dict]) -> None:
+        """Insert or replace rows with address, health_factor, checked_at and volatility of one pool"""
+        for i in range(0, len(rows), HEALTH_FACTOR_ROWS_BATCH_SIZE):
+            batch = [{'chain': chain.value, 'aave_version': aave_version, **row} for row in rows[i:i + HEALTH_FACTOR_ROWS_BATCH_SIZE]]
+            self.supabase.table('health_factor').upsert(batch).execute()
+
+    @timed(DB_QUERY_SECONDS, query='delete_health_factor_rows')
+    def delete_health_factor_rows(self, chain: Chain, aave_version: int, addresses: list[str], checked_before: float) -> None:
+        """Delete the rows of the given addresses that were not updated since checked_before, even by another worker"""
+        for i in range(0, len(addresses), HEALTH_FACTOR_ROWS_BATCH_SIZE):
+            self.supabase.table('health_factor').delete().eq('chain', chain.value).eq('aave_version', aave_version).in_('address', addresses[i:i + HEALTH_FACTOR_ROWS_BATCH_SIZE]).lt('checked_at', checked_before).execute()
+
+    @timed(DB_QUERY_SECONDS, query='is_tracked')
     def is_tracked(self, account: ChainAccount):
         """Check if the given account is tracked by at least one user of the app"""
         response = self.supabase.table('account').select('count').eq('address', account.address).eq('chain', account.chain.value).eq('aave_version', account.aave_version).execute()
         return response.data[0]['count'] > 0
 
+    @timed(DB_QUERY_SECONDS, query='get_tracked_accounts')
+    def get_tracked_accounts(self) -> list[ChainAccount]:
+        """Get all accounts tracked by at least one user of the app. Read in pages like the accounts for health factor checks."""
+        def make_query() -> Any:
+            return self.supabase.table('account').select('address, chain, aave_version, user_id')
+
+        return [
+            ChainAccount(address=raw_account['address'], chain=Chain(raw_account['chain']), aave_version=raw_account['aave_version'])
+            for page in self._iter_raw_account_pages(make_query)
+            for raw_account in page
+        ]
+
+    @timed(DB_QUERY_SECONDS, query='get_users_for_notification')
     def get_users_for_notification(self, account: ChainAccount) -> list[tuple[str | None, datetime]]:
         """Queries users' onesignal id and accounts' last health factor notification timestamp"""
         raw_users = self.supabase.table('account').select('user(onesignal_id), user_id, last_health_factor_notification').eq('address', account.address).eq('chain', account.chain.value).eq('aave_version', account.aave_version).execute()
@@ -33,21 +88,105 @@ class Database:
 
         return users_data
     
+    @timed(DB_QUERY_SECONDS, query='set_last_health_factor_notification')
     def set_last_health_factor_notification(self, account: ChainAccount, user_id: str, timestamp: datetime) -> None:
         """Set the last health factor notification timestamp for the given account"""
         self.supabase.table('account').update({'last_health_factor_notification': timestamp.isoformat()}).eq('address', account.address).eq('chain', account.chain.value).eq('aave_version', account.aave_version).eq('user_id', user_id).execute()
 
-    def _get_raw_accounts(self, chain: Chain, aave_version: int) -> list[dict]:
-        """Get accounts across all app users"""
-        return self.supabase.table('account').select('address, chain, aave_version, user(health_factor_threshold, onesignal_id), user_id, last_health_factor_notification').eq('chain', chain.value).eq('aave_version', aave_version).execute().data
-
-    def get_accounts_for_hf_check(self, chain: Chain, aave_version: int) -> list[ChainAccountWithAllData]:
-        """Get accounts across all app users to check their health factors"""
-        raw_accounts = self._get_raw_accounts(chain=chain, aave_version=aave_version)
-        accounts = []
-        current_timestamp_seconds = int(datetime.utcnow().timestamp()) 
-        for raw_account in raw_accounts:
-            account = ChainAccountWithAllData(
+    @timed(DB_QUERY_SECONDS, query='set_last_health_factor_notifications')
+    def set_last_health_factor_notifications(self, accounts: list[ChainAccountWithAllData], timestamp: datetime) -> None:
+        """Set the last health factor notification timestamp for many accounts with one call per pool.
+        Uses the set_last_health_factor_notifications function from backend/sql, or per account updates if it is not deployed.
+        """
+        pools: dict[tuple[Chain, int], list[ChainAccountWithAllData]] = {}
+        for account in accounts:
+            pools.setdefault((account.account.chain, account.account.aave_version), []).append(account)
+
+        for (chain, aave_version), pool_accounts in pools.items():
+            for i in range(0, len(pool_accounts), NOTIFICATION_TIMESTAMPS_BATCH_SIZE):
+                batch = pool_accounts[i:i + NOTIFICATION_TIMESTAMPS_BATCH_SIZE]
+                try:
+                    self.supabase.rpc('set_last_health_factor_notifications', {
+                        'p_chain': chain.value,
+                        'p_aave_version': aave_version,
+                        'p_accounts': [{'address': account.account.address, 'user_id': account.user_id} for account in batch],
+                        'p_notified_at': timestamp.isoformat(),
+                    }).execute()
+                except APIError:
+                    logging.warning('Bulk update of notification timestamps failed, updating %d accounts one by one', len(batch))
+                    for account in batch:
+                        self.set_last_health_factor_notification(account.account, account.user_id, timestamp)
+
+    def _accounts_query(self, chain: Chain | None, aave_version: int | None):
+        """Accounts that were not notified within the notification interval. The cooldown is filtered by the database."""
+        notified_before = datetime.utcnow() - timedelta(seconds=HEALTH_FACTOR_NOTIFICATION_INTERVAL)
+        query = self.supabase.table('account').select('address, chain, aave_version, user(health_factor_threshold, onesignal_id), user_id').lt('last_health_factor_notification', notified_before.isoformat())
+        if chain is not None:
+            query = query.eq('chain', chain.value)
+        if aave_version is not None:
+            query = query.eq('aave_version', aave_version)
+        return query
+
+    def _get_raw_accounts_of_address(self, make_query: Callable[[], Any], address: str) -> list[dict]:
+        """All rows of one address, read in pages by user"""
+        raw_accounts: list[dict] = []
+        last_user_id = None
+        while True:
+            query = make_query().eq('address', address).order('user_id').limit(ACCOUNTS_PAGE_SIZE)
+            if last_user_id is not None:
+                query = query.gt('user_id', last_user_id)
+            with DB_QUERY_SECONDS.time(query='accounts_page'):
+                page = query.execute().data
+            if len(page) < ACCOUNTS_PAGE_SIZE:
+                return raw_accounts + page
+
+            # Rows of the last user (one per chain and aave version) may continue on the next page, so they are read separately
+            last_user_id = page[-1]['user_id']
+            raw_accounts += [raw_account for raw_account in page if raw_account['user_id'] != last_user_id]
+            with DB_QUERY_SECONDS.time(query='accounts_page'):
+                raw_accounts += make_query().eq('address', address).eq('user_id', last_user_id).execute().data
+
+    def _iter_raw_account_pages(self, make_query: Callable[[], Any]) -> Generator[list[dict], None, None]:
+        """Read the rows of an account table query in pages ordered by address (keyset pagination), so none of them are cut off
+        by the PostgREST row limit. Rows of one address are never split between pages. The query must select address and user_id.
+        """
+        last_address = None
+        while True:
+            query = make_query().order('address').limit(ACCOUNTS_PAGE_SIZE)
+            if last_address is not None:
+                query = query.gt('address', last_address)
+            with DB_QUERY_SECONDS.time(query='accounts_page'):
+                page = query.execute().data
+            if len(page) < ACCOUNTS_PAGE_SIZE:
+                if len(page) > 0:
+                    yield page
+                return
+
+            # Other rows of the last address may continue on the next page, so they are read separately
+            last_address = page[-1]['address']
+            complete_page = [raw_account for raw_account in page if raw_account['address'] != last_address]
+            if len(complete_page) > 0:
+                yield complete_page
+            yield self._get_raw_accounts_of_address(make_query, last_address)
+
+    def _get_raw_accounts(self, chain: Chain | None = None, aave_version: int | None = None) -> list[dict]:
+        """Get accounts across all app users. Accounts of all chains and aave versions if they are not given."""
+        return [raw_account for page in self._iter_raw_account_pages(lambda: self._accounts_query(chain, aave_version)) for raw_account in page]
+
+    def get_accounts_for_hf_check(self, chain: Chain | None = None, aave_version: int | None = None) -> list[ChainAccountWithAllData]:
+        """Get accounts across all app users to check their health factors. Accounts of all chains and aave versions if they are not given."""
+        return self._parse_accounts_for_hf_check(self._get_raw_accounts(chain=chain, aave_version=aave_version))
+
+    def iter_accounts_for_hf_check(self, chain: Chain | None = None, aave_version: int | None = None) -> Generator[list[ChainAccountWithAllData], None, None]:
+        """Same as get_accounts_for_hf_check but yields the accounts page by page, so raw rows of only one page are in memory"""
+        for raw_accounts in self._iter_raw_account_pages(lambda: self._accounts_query(chain, aave_version)):
+            accounts = self._parse_accounts_for_hf_check(raw_accounts)
+            if len(accounts) > 0:
+                yield accounts
+
+    def _parse_accounts_for_hf_check(self, raw_accounts: list[dict]) -> list[ChainAccountWithAllData]:
+        return [
+            ChainAccountWithAllData(
                 account=ChainAccount(
                   address=raw_account['address'],
                   chain=Chain(raw_account['chain']),
@@ -57,11 +196,5 @@ class Database:
                 user_id=raw_account['user_id'],
                 onesignal_id=raw_account['user']['onesignal_id'],
             )
-            last_sent_seconds = int(datetime.fromisoformat(raw_account['last_health_factor_notification']).timestamp())
-            if current_timestamp_seconds - last_sent_seconds < HEALTH_FACTOR_NOTIFICATION_INTERVAL:
-                # Notification has been sent recently
-                continue
-
-            accounts.append(account)
-
-        return accounts
+            for raw_account in raw_accounts
+        ]
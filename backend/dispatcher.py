@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import os
+import random
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import NamedTuple
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
+
+from backend.metrics import NOTIFICATION_QUEUE_DEPTH, NOTIFICATION_SEND_SECONDS, NOTIFICATIONS
+
+ONESIGNAL_API_URL = 'https://onesignal.com/api/v1/notifications'
+MAX_PLAYER_IDS_PER_NOTIFICATION = 2000  # OneSignal limit for include_player_ids
+NOTIFICATION_QUEUE_SIZE = 1000  # Producers wait when the queue is full
+NOTIFICATION_WORKERS = 4
+MAX_DRAINED_NOTIFICATIONS = 500  # How many queued notifications a worker takes at once to group them
+MAX_SEND_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1  # seconds, doubled after every attempt
+MAX_RETRY_AFTER = 60  # seconds, a longer Retry-After would hold a worker and the queued notifications behind it
+
+
+class Notification(NamedTuple):
+    player_ids: tuple[str, ...]
+    title: str
+    message: str
+    delivered: asyncio.Future | None = None  # Resolved with whether OneSignal accepted the notification
+
+
+class RetryableResponse(Exception):
+    def __init__(self, status: int, retry_after: float | None) -> None:
+        super().__init__(f'OneSignal responded with {status}')
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Seconds to wait from a Retry-After header, which is either a number of seconds or an HTTP date. None if it can't be parsed."""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:  # HTTP dates are in GMT
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def group_notifications(notifications: list[Notification]) -> list[Notification]:
+    """Merge notifications with the same title and message into as few OneSignal calls as possible"""
+    recipients: dict[tuple[str, str], dict[str, None]] = {}  # Dicts keep the order and drop duplicates
+    for notification in notifications:
+        recipients.setdefault((notification.title, notification.message), {}).update(dict.fromkeys(notification.player_ids))
+
+    grouped = []
+    for (title, message), unique_player_ids in recipients.items():
+        player_ids = list(unique_player_ids)
+        for i in range(0, len(player_ids), MAX_PLAYER_IDS_PER_NOTIFICATION):
+            grouped.append(Notification(tuple(player_ids[i:i + MAX_PLAYER_IDS_PER_NOTIFICATION]), title, message))
+    return grouped
+
+
+class NotificationDispatcher():
+    """Sends push notifications from a bounded queue with a few workers sharing one pooled HTTP session.
+    Queued notifications with the same text are merged into one call. 429 and 5xx responses are retried with jittered backoff.
+    Every submitted notification gets a future that tells whether it was delivered.
+    The app id and key default to ONESIGNAL_APP_ID and ONESIGNAL_APP_KEY from the environment.
+    """
+    def __init__(self, app_id: str | None = None, app_key: str | None = None, api_url: str = ONESIGNAL_API_URL, retry_base_delay: float = RETRY_BASE_DELAY) -> None:
+        self.app_id = app_id if app_id is not None else os.environ['ONESIGNAL_APP_ID']
+        self.app_key = app_key if app_key is not None else os.environ['ONESIGNAL_APP_KEY']
+        self.api_url = api_url
+        self.retry_base_delay = retry_base_delay
+        self.queue: asyncio.Queue[Notification] | None = None
+        self.session: ClientSession | None = None
+        self.workers: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        """Must be called from the running event loop"""
+        self.queue = asyncio.Queue(maxsize=NOTIFICATION_QUEUE_SIZE)
+        NOTIFICATION_QUEUE_DEPTH.set_function(self.queue.qsize)
+        self.session = ClientSession(
+            connector=TCPConnector(limit=NOTIFICATION_WORKERS),
+            timeout=ClientTimeout(total=30),
+            headers={'Authorization': f'Bearer {self.app_key}'},  # Like the OneSignal SDK
+        )
+        self.workers = [asyncio.create_task(self.work()) for _ in range(NOTIFICATION_WORKERS)]
+
+    async def submit(self, player_ids: list[str], title: str, message: str) -> asyncio.Future:
+        """Queue a notification. Waits if the queue is full. The returned future is resolved with True once it is sent
+        and with False if OneSignal rejected it or all attempts failed.
+        """
+        if self.queue is None:
+            self.start()
+        assert self.queue is not None
+        delivered = asyncio.get_running_loop().create_future()
+        await self.queue.put(Notification(tuple(player_ids), title, message, delivered))
+        return delivered
+
+    async def join(self) -> None:
+        """Wait until all queued notifications are sent"""
+        if self.queue is not None:
+            await self.queue.join()
+
+    async def close(self) -> None:
+        await self.join()
+        for worker in self.workers:
+            worker.cancel()
+        if self.session is not None:
+            await self.session.close()
+        self.queue, self.session, self.workers = None, None, []
+
+    async def work(self) -> None:
+        assert self.queue is not None
+        while True:
+            notifications = [await self.queue.get()]
+            while not self.queue.empty() and len(notifications) < MAX_DRAINED_NOTIFICATIONS:
+                notifications.append(self.queue.get_nowait())
+
+            delivered: dict[tuple[str, str], bool] = {}  # (title, message) -> whether all the calls with this text were sent
+            try:
+                for notification in group_notifications(notifications):
+                    key = (notification.title, notification.message)
+                    previous_calls_sent = delivered.get(key, True)
+                    delivered[key] = False  # Until it is sent
+                    with NOTIFICATION_SEND_SECONDS.time():
+                        sent = await self.send(notification)
+                    delivered[key] = previous_calls_sent and sent
+            except Exception:
+                logging.exception('Unexpected error while sending notifications')
+            finally:
+                for notification in notifications:
+                    if notification.delivered is not None and not notification.delivered.done():
+                        notification.delivered.set_result(delivered.get((notification.title, notification.message), False))
+                    self.queue.task_done()
+
+    async def send(self, notification: Notification) -> bool:
+        """Returns whether OneSignal accepted the notification"""
+        assert self.session is not None
+        body = {
+            'app_id': self.app_id,
+            'include_player_ids': list(notification.player_ids),
+            'target_channel': 'push',
+            'headings': {'en': notification.title},
+            'contents': {'en': notification.message},
+        }
+        for attempt in range(MAX_SEND_ATTEMPTS):
+            retry_after = None
+            try:
+                async with self.session.post(self.api_url, json=body) as response:
+                    if response.status == 429 or response.status >= 500:
+                        raise RetryableResponse(response.status, parse_retry_after(response.headers.get('Retry-After')))
+                    if response.status >= 400:
+                        logging.error('OneSignal rejected the notification about %s for %d users: %d %s', notification.title, len(notification.player_ids), response.status, await response.text())
+                        NOTIFICATIONS.inc(result='rejected')
+                        return False
+                    result = await response.json()
+                    if result.get('errors'):
+                        logging.warning('OneSignal errors for the notification about %s: %s', notification.title, result['errors'])
+                    logging.info('Notification about %s was successfully sent to %d users!', notification.title, len(notification.player_ids))
+                    NOTIFICATIONS.inc(result='sent')
+                    return True
+            except RetryableResponse as e:
+                retry_after = e.retry_after
+                logging.warning('%s for the notification about %s. Attempt %d of %d', e, notification.title, attempt + 1, MAX_SEND_ATTEMPTS)
+            except (ClientError, asyncio.TimeoutError) as e:
+                logging.warning('%r for the notification about %s. Attempt %d of %d', e, notification.title, attempt + 1, MAX_SEND_ATTEMPTS)
+
+            NOTIFICATIONS.inc(result='retried')
+            backoff = self.retry_base_delay * 2 ** attempt
+            await asyncio.sleep(min(retry_after, MAX_RETRY_AFTER) if retry_after is not None else random.uniform(backoff / 2, backoff))
+
+        logging.error('Gave up sending the notification about %s to %d users', notification.title, len(notification.player_ids))
+        NOTIFICATIONS.inc(result='gave_up')
+        return False
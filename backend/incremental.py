@@ -0,0 +1,245 @@
+import asyncio
+import logging
+import time
+import traceback
+from typing import TYPE_CHECKING
+
+from eth_utils import event_abi_to_log_topic, to_hex
+from web3 import AsyncWeb3
+from web3.contract import AsyncContract
+from web3.types import LogReceipt
+
+from backend.abi import load_abi
+from backend.admin import send_admin_message
+from backend.codec import decode_uint256, encode_get_user_configuration
+from backend.logqueue import log_context, new_sweep_id
+from backend.metrics import BLOCK_LAG, SWEEP_SECONDS
+from backend.ratelimit import Priority, rpc_priority
+from backend.risk import PositionModel
+from backend.types import ChainAccountWithAllData
+
+if TYPE_CHECKING:
+    from backend.connector import AsyncChainConnector
+
+INCREMENTAL_CHECK_PERIOD = 12  # seconds, about one block on Ethereum
+ERROR_RETRY_PERIOD = 60  # seconds
+FULL_SWEEP_PERIOD = 60 * 15  # A full sweep is still done every 15 minutes in case some event was missed
+MAX_INCREMENTAL_BLOCK_RANGE = 1000  # If we are behind more than this, a full sweep is cheaper than catching up on events
+POSITION_EVENTS = (  # Pool events that change health factor of an account
+    'Borrow',
+    'Repay',
+    'Deposit',  # V2
+    'Supply',  # V3
+    'Withdraw',
+    'LiquidationCall',
+    'ReserveUsedAsCollateralEnabled',
+    'ReserveUsedAsCollateralDisabled',
+)
+ANSWER_UPDATED_TOPIC = AsyncWeb3.keccak(text='AnswerUpdated(int256,uint256,uint256)').hex()
+
+
+def is_using_reserve(user_configuration: int, reserve_index: int) -> bool:
+    """Aave user configuration has 2 bits per reserve: borrowing and using as collateral"""
+    return (user_configuration >> (reserve_index * 2)) & 0b11 != 0
+
+
+class HealthFactorWatcher():
+    """Rechecks only the accounts that might have changed their health factor since the last block.
+    An account is rechecked if it emitted a pool event or if the price of one of its reserves was updated.
+    Prices are watched through AnswerUpdated events of the chainlink aggregators behind the Aave oracle.
+    After a price update only the accounts whose locally predicted health factor is close to the threshold are rechecked on-chain.
+    """
+    def __init__(self, connector: 'AsyncChainConnector') -> None:
+        self.connector = connector
+        self.accounts: list[ChainAccountWithAllData] = []
+        self.reserves: list[str] = []  # Reserve index -> asset address
+        self.price_sources: dict[str, set[int]] = {}  # Lowercase price source address -> indexes of reserves priced by it
+        self.user_configurations: dict[str, int] = {}  # Lowercase account address -> aave user configuration
+        self.last_checked_block: int | None = None
+        self.last_full_sweep_timestamp = 0.0
+        self.price_oracle: AsyncContract | None = None
+        self.model = PositionModel(connector)
+        self.shards_generation: int | None = None  # Generation of the owned shards that the accounts were loaded for
+
+        self.position_events = {}
+        for event_name in POSITION_EVENTS:
+            if any(item.get('name') == event_name for item in connector.pool_abi):
+                event = getattr(connector.pool_contract.events, event_name)()
+                self.position_events[to_hex(event_abi_to_log_topic(event.abi))] = event
+
+        self.addresses_provider_abi = load_abi('addresses_provider')
+        self.price_oracle_abi = load_abi('price_oracle')
+        self.aggregator_abi = load_abi('chainlink_aggregator')
+
+    async def load_price_sources(self) -> None:
+        """Find the aggregators that emit AnswerUpdated for every reserve of the pool"""
+        pool_functions = self.connector.pool_contract.functions
+        if self.connector.aave_version == 2:
+            addresses_provider_address = await pool_functions.getAddressesProvider().call()
+        else:
+            addresses_provider_address = await pool_functions.ADDRESSES_PROVIDER().call()
+        addresses_provider = self.connector.web3.eth.contract(address=addresses_provider_address, abi=self.addresses_provider_abi)
+        self.price_oracle = self.connector.web3.eth.contract(address=await addresses_provider.functions.getPriceOracle().call(), abi=self.price_oracle_abi)
+
+        self.reserves = await pool_functions.getReservesList().call()
+        sources = await asyncio.gather(*(self.price_oracle.functions.getSourceOfAsset(asset).call() for asset in self.reserves))
+        aggregators = await asyncio.gather(*(self.get_aggregator(source) for source in sources))
+        self.price_sources = {}
+        for reserve_index, aggregator in enumerate(aggregators):
+            self.price_sources.setdefault(aggregator.lower(), set()).add(reserve_index)
+
+    async def get_aggregator(self, source: str) -> str:
+        """Chainlink proxies don't emit events themselves, the underlying aggregator does.
+        Sources that are not chainlink proxies are watched directly.
+        """
+        try:
+            return await self.connector.web3.eth.contract(address=source, abi=self.aggregator_abi).functions.aggregator().call()
+        except Exception:
+            return source
+
+    async def load_user_configurations(self, addresses: list[str]) -> dict[str, int]:
+        """Returns the loaded configurations of the given accounts"""
+        results = await self.connector.batcher.aggregate([
+            (self.connector.pool_contract.address, encode_get_user_configuration(address))
+            for address in addresses
+        ])
+        loaded = {}
+        for address, result in zip(addresses, results):
+            if result is not None:
+                loaded[address.lower()] = decode_uint256(result)
+        self.user_configurations.update(loaded)
+        return loaded
+
+    async def refresh_model(self, user_configurations: dict[str, int]) -> None:
+        """Without the model every account affected by a price update is rechecked on-chain"""
+        assert self.price_oracle is not None
+        try:
+            await self.model.refresh(self.reserves, self.price_oracle, user_configurations)
+        except Exception:
+            logging.error('Could not load the position model on %s x Aave V%d: %s', self.connector.chain.name, self.connector.aave_version, traceback.format_exc())
+
+    async def full_sweep(self, current_block: int) -> None:
+        if self.connector.shards is not None:
+            self.shards_generation = self.connector.shards.generation
+        await self.sweep_accounts()
+        await self.load_price_sources()
+        user_configurations = await self.load_user_configurations(list({account.account.address for account in self.accounts}))
+        await self.refresh_model(user_configurations)
+        self.last_checked_block = current_block
+        self.last_full_sweep_timestamp = time.monotonic()
+
+    async def sweep_accounts(self) -> None:
+        """Check all the accounts and keep the ones that were not notified for the following blocks.
+        With an accounts loader the sweep is vectorized over its AccountTable, like the periodic sweep,
+        and only the rows left to watch are turned into ChainAccountWithAllData.
+        """
+        if self.connector.accounts_loader is not None:
+            await self.connector.check_account_table(await self.connector.get_account_table())
+            self.accounts = await self.connector.load_accounts_for_hf_check()  # The notified rows are marked in the table
+            return
+        self.accounts = await self.connector.load_accounts_for_hf_check()
+        self.forget_accounts(await self.connector.check_accounts(self.accounts))
+
+    def forget_accounts(self, accounts: list[ChainAccountWithAllData]) -> None:
+        """Notified accounts are not checked again until the next full sweep, which respects the notification interval"""
+        if len(accounts) > 0:
+            notified = set(accounts)
+            self.accounts = [account for account in self.accounts if account not in notified]
+
+    def get_changed_addresses(self, position_logs: list[LogReceipt], price_logs: list[LogReceipt]) -> tuple[set[str], set[str]]:
+        """Returns lowercase addresses of accounts that emitted pool events and of accounts affected by price updates"""
+        position_changed = set()
+        for log in position_logs:
+            event = self.position_events.get(log['topics'][0].hex())
+            if event is None:
+                continue
+            for value in event.process_log(log)['args'].values():
+                if isinstance(value, str) and value.startswith('0x'):
+                    position_changed.add(value.lower())
+
+        updated_reserve_indexes: set[int] = set()
+        for log in price_logs:
+            updated_reserve_indexes |= self.price_sources.get(log['address'].lower(), set())
+
+        price_changed = set()
+        if len(updated_reserve_indexes) > 0:
+            for account in self.accounts:
+                address = account.account.address.lower()
+                user_configuration = self.user_configurations.get(address)
+                if user_configuration is None or any(is_using_reserve(user_configuration, index) for index in updated_reserve_indexes):
+                    price_changed.add(address)
+
+        return position_changed, price_changed
+
+    async def get_price_logs(self, from_block: int, to_block: int) -> list[LogReceipt]:
+        if len(self.price_sources) == 0:
+            return []  # An empty address filter would match logs of all contracts
+        return await self.connector.get_logs({
+            'address': [AsyncWeb3.to_checksum_address(source) for source in self.price_sources],
+            'topics': [ANSWER_UPDATED_TOPIC],
+            'fromBlock': from_block,
+            'toBlock': to_block,
+        })
+
+    async def check_new_blocks(self, current_block: int) -> None:
+        """Recheck the accounts affected by the events emitted since the last checked block"""
+        assert self.last_checked_block is not None
+        if current_block <= self.last_checked_block:
+            return
+
+        from_block = self.last_checked_block + 1
+        position_logs, price_logs = await asyncio.gather(
+            self.connector.get_logs({
+                'address': self.connector.pool_address,
+                'topics': [list(self.position_events.keys())],
+                'fromBlock': from_block,
+                'toBlock': current_block,
+            }),
+            self.get_price_logs(from_block, current_block),
+        )
+        position_changed, price_changed = self.get_changed_addresses(position_logs, price_logs)
+        tracked_position_changed = [account.account.address for account in self.accounts if account.account.address.lower() in position_changed]
+        if len(tracked_position_changed) > 0:
+            user_configurations = await self.load_user_configurations(list(set(tracked_position_changed)))
+            if self.model.ready:
+                await self.model.load_positions(user_configurations)
+
+        if len(price_logs) > 0 and self.model.ready:
+            assert self.price_oracle is not None
+            await self.model.load_prices(self.price_oracle)
+        accounts_to_check = [account for account in self.accounts if account.account.address.lower() in position_changed]
+        price_changed_accounts = [account for account in self.accounts if account.account.address.lower() in price_changed - position_changed]
+        accounts_to_check += self.model.get_accounts_near_threshold(price_changed_accounts)
+        if len(accounts_to_check) > 0:
+            logging.info('Blocks %d-%d changed %d tracked positions on %s x Aave V%d', from_block, current_block, len(accounts_to_check), self.connector.chain.name, self.connector.aave_version)
+            self.forget_accounts(await self.connector.check_accounts(accounts_to_check))
+        self.last_checked_block = current_block
+
+    def needs_full_sweep(self, current_block: int) -> bool:
+        return (
+            self.last_checked_block is None
+            or current_block - self.last_checked_block > MAX_INCREMENTAL_BLOCK_RANGE
+            or time.monotonic() - self.last_full_sweep_timestamp >= FULL_SWEEP_PERIOD
+            or (self.connector.shards is not None and self.connector.shards.generation != self.shards_generation)
+        )
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.connector.connect()
+                current_block = await self.connector.get_block_number() - 1  # Doing -1 because it may be that the current block is not confirmed yet on Avalanche.
+                if self.last_checked_block is not None:
+                    BLOCK_LAG.set(current_block - self.last_checked_block, chain=self.connector.chain.name, aave_version=self.connector.aave_version, monitor='health_factor')
+                kind = 'full' if self.needs_full_sweep(current_block) else 'incremental'
+                with SWEEP_SECONDS.time(chain=self.connector.chain.name, aave_version=self.connector.aave_version, kind=kind), log_context(sweep_id=new_sweep_id()):
+                    if kind == 'full':
+                        await self.full_sweep(current_block)
+                    else:
+                        with rpc_priority(Priority.AT_RISK):  # Only the accounts whose health factor may have just dropped
+                            await self.check_new_blocks(current_block)
+            except Exception:
+                await send_admin_message('Critical error!')
+                logging.error('Error while watching health factors on %s x Aave V%d: %s', self.connector.chain.name, self.connector.aave_version, traceback.format_exc())
+                await asyncio.sleep(ERROR_RETRY_PERIOD)
+
+            await asyncio.sleep(INCREMENTAL_CHECK_PERIOD)
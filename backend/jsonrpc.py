@@ -0,0 +1,256 @@
+"""JSON-RPC calls that are merged across connectors. Calls to one endpoint made within a short window are sent
+in one batch POST, identical calls are sent once and eth_getLogs calls of overlapping block ranges are merged into one call
+whose address and topic filters are the union of theirs. If a merged call fails, for example because the union of the ranges
+or filters is refused, every request of it is sent again on its own. The V2 and V3 connectors of a chain share the batcher of their endpoint.
+"""
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Callable
+
+from web3.types import FilterParams, LogReceipt
+
+from backend.codec import decode_log
+from backend.metrics import RPC_ERRORS, RPC_REQUEST_SECONDS, RPC_REQUESTS
+from backend.ratelimit import Priority, call_with_quota, current_priority, get_request_cost, rpc_priority
+from backend.rpc import get_session
+from backend.rpc_pool import RpcPool, get_min_block
+
+JSON_RPC_BATCH_WINDOW = 0.05  # seconds, calls made within this window after the first pending one share a batch
+JSON_RPC_MAX_BATCH_SIZE = 50  # calls per POST, providers limit the batch size
+BLOCK_NUMBER_CACHE_PERIOD = 5  # seconds, shorter than the check periods, so every tick sees the new blocks
+
+_batchers: dict[RpcPool | str, 'JsonRpcBatcher'] = {}
+
+TopicsFilter = list[set[str] | None]  # Allowed lowercase topics of every position, None for any
+
+
+def normalize_addresses(address: str | list[str] | None) -> set[str] | None:
+    if address is None:
+        return None
+    return {address.lower()} if isinstance(address, str) else {item.lower() for item in address}
+
+
+def normalize_topics(topics: list | None) -> TopicsFilter:
+    if topics is None:
+        return []
+    return [None if topic is None else {topic.lower()} if isinstance(topic, str) else {item.lower() for item in topic} for topic in topics]
+
+
+def merge_topics(first: TopicsFilter, second: TopicsFilter) -> TopicsFilter:
+    merged: TopicsFilter = []
+    for i in range(max(len(first), len(second))):
+        first_topic = first[i] if i < len(first) else None
+        second_topic = second[i] if i < len(second) else None
+        merged.append(None if first_topic is None or second_topic is None else first_topic | second_topic)
+    while len(merged) > 0 and merged[-1] is None:
+        merged.pop()
+    return merged
+
+
+def make_logs_filter(from_block: int, to_block: int, addresses: set[str] | None, topics: TopicsFilter) -> dict[str, Any]:
+    filter_params: dict[str, Any] = {
+        'fromBlock': hex(from_block),
+        'toBlock': hex(to_block),
+        'topics': [None if topic is None else sorted(topic) for topic in topics],
+    }
+    if addresses is not None:
+        filter_params['address'] = sorted(addresses)
+    return filter_params
+
+
+class LogsRequest():
+    """eth_getLogs request of one caller. Merged calls return a superset of its logs, so they are filtered again."""
+    def __init__(self, filter_params: FilterParams, future: asyncio.Future) -> None:
+        self.addresses = normalize_addresses(filter_params.get('address'))  # type: ignore[arg-type]
+        self.topics = normalize_topics(filter_params.get('topics'))  # type: ignore[arg-type]
+        self.from_block = int(filter_params['fromBlock'])  # type: ignore[arg-type]
+        self.to_block = int(filter_params['toBlock'])  # type: ignore[arg-type]
+        self.future = future
+        self.priority = current_priority()
+        self.merged = False  # Answered by a call merged with other requests
+
+    def matches(self, raw_log: dict) -> bool:
+        if not self.from_block <= int(raw_log['blockNumber'], 16) <= self.to_block:
+            return False
+        if self.addresses is not None and raw_log['address'].lower() not in self.addresses:
+            return False
+        log_topics = raw_log['topics']
+        return all(topic is None or (i < len(log_topics) and log_topics[i].lower() in topic) for i, topic in enumerate(self.topics))
+
+    def select(self, raw_logs: list[dict]) -> list[LogReceipt]:
+        return [decode_log(raw_log) for raw_log in raw_logs if self.matches(raw_log)]
+
+
+class RpcCall():
+    """One call of a batch and the requests answered by it"""
+    def __init__(self, method: str, params: list) -> None:
+        self.method = method
+        self.params = params
+        self.waiters: list[tuple[asyncio.Future, Callable[[Any], Any]]] = []  # (future, result -> value of the future)
+        self.priority = Priority.BACKFILL  # The highest priority of the requests
+
+    def payload(self, request_id: int) -> dict:
+        return {'jsonrpc': '2.0', 'id': request_id, 'method': self.method, 'params': self.params}
+
+    def resolve(self, response: dict) -> None:
+        for future, select in self.waiters:
+            if future.done():
+                continue
+            if 'error' in response:
+                future.set_exception(ValueError(response['error']))  # Like web3, so callers handle RPC errors the same way
+            else:
+                future.set_result(select(response.get('result')))
+
+    def fail(self, error: BaseException) -> None:
+        for future, _ in self.waiters:
+            if not future.done():
+                future.set_exception(error)
+
+
+def merge_logs_requests(requests: list[LogsRequest]) -> list[RpcCall]:
+    """One eth_getLogs call for every group of requests with overlapping block ranges"""
+    calls = []
+    group: list[LogsRequest] = []
+    for request in sorted(requests, key=lambda request: request.from_block) + [None]:
+        if request is not None and len(group) > 0 and request.from_block <= max(member.to_block for member in group):
+            group.append(request)
+            continue
+        if len(group) > 0:
+            addresses: set[str] | None = set()
+            topics = group[0].topics
+            for member in group:
+                addresses = None if addresses is None or member.addresses is None else addresses | member.addresses
+                topics = merge_topics(topics, member.topics)
+            call = RpcCall('eth_getLogs', [make_logs_filter(group[0].from_block, max(member.to_block for member in group), addresses, topics)])
+            call.waiters = [(member.future, member.select) for member in group]
+            call.priority = min(member.priority for member in group)
+            for member in group:
+                member.merged = len(group) > 1
+            calls.append(call)
+        group = [request] if request is not None else []
+    return calls
+
+
+class JsonRpcBatcher():
+    """Sends JSON-RPC calls to one endpoint or RPC pool in batches.
+    If the endpoint doesn't accept batches, the merged calls are sent one by one from then on.
+    """
+    def __init__(self, chain_name: str, rpc_url: str, rpc_pool: RpcPool | None = None) -> None:
+        self.chain_name = chain_name
+        self.rpc_url = rpc_url
+        self.rpc_pool = rpc_pool
+        self.pending_calls: dict[str, RpcCall] = {}  # Serialized (method, params) -> call, so identical calls are sent once
+        self.pending_logs: list[LogsRequest] = []
+        self.flush_task: asyncio.Task | None = None
+        self.batches_supported = True
+        self.block_number: tuple[float, int] | None = None  # (monotonic time of the request, block number)
+
+    def schedule_flush(self) -> None:
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.flush())
+
+    async def request(self, method: str, params: list) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        key = json.dumps([method, params])
+        if key not in self.pending_calls:
+            self.pending_calls[key] = RpcCall(method, params)
+        self.pending_calls[key].waiters.append((future, lambda result: result))
+        self.pending_calls[key].priority = min(self.pending_calls[key].priority, current_priority())
+        self.schedule_flush()
+        return await future
+
+    async def get_logs(self, filter_params: FilterParams) -> list[LogReceipt]:
+        future = asyncio.get_running_loop().create_future()
+        request = LogsRequest(filter_params, future)
+        self.pending_logs.append(request)
+        self.schedule_flush()
+        try:
+            return await future
+        except Exception as e:
+            if not request.merged:
+                raise
+            logging.info('Merged eth_getLogs call on %s failed with %r, sending blocks %d-%d on their own', self.rpc_url, e, request.from_block, request.to_block)
+        raw_logs = await self.request('eth_getLogs', [make_logs_filter(request.from_block, request.to_block, request.addresses, request.topics)])
+        return request.select(raw_logs)
+
+    async def get_block_number(self) -> int:
+        """Cached for BLOCK_NUMBER_CACHE_PERIOD, so the connectors of a chain ask for it once per tick"""
+        if self.block_number is not None and time.monotonic() - self.block_number[0] < BLOCK_NUMBER_CACHE_PERIOD:
+            return self.block_number[1]
+        requested_at = time.monotonic()
+        block_number = int(await self.request('eth_blockNumber', []), 16)
+        self.block_number = (requested_at, block_number)
+        return block_number
+
+    async def flush(self) -> None:
+        await asyncio.sleep(JSON_RPC_BATCH_WINDOW)
+        calls = list(self.pending_calls.values()) + merge_logs_requests(self.pending_logs)
+        self.pending_calls = {}
+        self.pending_logs = []
+        self.flush_task = None  # Calls made while this batch is in flight go to the next one
+        await asyncio.gather(*(self.send(calls[i:i + JSON_RPC_MAX_BATCH_SIZE]) for i in range(0, len(calls), JSON_RPC_MAX_BATCH_SIZE)))
+
+    async def post(self, payload: dict | list[dict]) -> Any:
+        """Send a call or a batch. Batches are measured under the 'batch' method."""
+        method = 'batch' if isinstance(payload, list) else payload['method']
+        request_data = json.dumps(payload).encode()
+        RPC_REQUESTS.inc(chain=self.chain_name, method=method)
+        start = time.perf_counter()
+        try:
+            if self.rpc_pool is not None:
+                return await self.rpc_pool.request_with_failover(method, request_data, get_request_cost(payload), get_min_block(payload))
+            session = await get_session(self.rpc_url)
+
+            async def send() -> bytes:
+                async with session.post(self.rpc_url, data=request_data, headers={'Content-Type': 'application/json'}) as response:
+                    return await response.read()
+
+            return json.loads(await call_with_quota(self.rpc_url, get_request_cost(payload), send))
+        except Exception:
+            RPC_ERRORS.inc(chain=self.chain_name, method=method)
+            raise
+        finally:
+            RPC_REQUEST_SECONDS.observe(time.perf_counter() - start, chain=self.chain_name, method=method)
+
+    async def send_one(self, call: RpcCall) -> None:
+        try:
+            with rpc_priority(call.priority):
+                call.resolve(await self.post(call.payload(0)))
+        except Exception as e:
+            call.fail(e)
+
+    async def send(self, calls: list[RpcCall]) -> None:
+        if not self.batches_supported or len(calls) == 1:
+            await asyncio.gather(*(self.send_one(call) for call in calls))
+            return
+
+        try:
+            with rpc_priority(min(call.priority for call in calls)):
+                responses = await self.post([call.payload(i) for i, call in enumerate(calls)])
+        except Exception as e:
+            for call in calls:
+                call.fail(e)
+            return
+        if not isinstance(responses, list):
+            logging.warning('%s does not accept JSON-RPC batches (%s), sending the calls one by one', self.rpc_url, responses.get('error'))
+            self.batches_supported = False
+            await asyncio.gather(*(self.send_one(call) for call in calls))
+            return
+
+        responses_by_id = {response.get('id'): response for response in responses}
+        for i, call in enumerate(calls):
+            response = responses_by_id.get(i)
+            if response is None:
+                call.fail(ValueError({'code': -32603, 'message': f'No response to {call.method} in the batch'}))
+            else:
+                call.resolve(response)
+
+
+def get_json_rpc_batcher(chain_name: str, rpc_url: str, rpc_pool: RpcPool | None = None) -> JsonRpcBatcher:
+    """Connectors that use the same endpoint or RPC pool share one batcher"""
+    key = rpc_pool if rpc_pool is not None else rpc_url
+    if key not in _batchers:
+        _batchers[key] = JsonRpcBatcher(chain_name, rpc_url, rpc_pool)
+    return _batchers[key]
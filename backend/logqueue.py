@@ -0,0 +1,148 @@
+"""Logging that doesn't block the event loop. The calling thread only puts records on a bounded queue, and a background
+thread formats and writes them: text to stdout and JSON lines to the log file, which is rotated by size and by age.
+Messages are formatted in the writer thread, so call sites pass %-style arguments instead of f-strings, and the
+arguments must not be mutated after the call. Records carry the chain, Aave version and sweep id of the log context
+they were logged in. Records logged with extra={'sample_every': N} are sampled to one of every N per message and context.
+"""
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Generator
+
+from backend.metrics import LOG_RECORDS_DROPPED
+
+LOG_QUEUE_SIZE = 10000  # records, further records are dropped while the writer is behind
+LOG_MAX_BYTES = 100 * 1024 * 1024  # The log file is rotated when it reaches this size
+LOG_ROTATION_PERIOD = 24 * 60 * 60  # seconds, or when it was written for this long
+LOG_BACKUP_COUNT = 7  # Rotated log files that are kept
+TEXT_FORMAT = '%(asctime)s %(pathname)s %(levelname)s %(message)s'
+CONTEXT_FIELDS = ('chain', 'aave_version', 'sweep_id')
+
+_context: ContextVar[dict[str, Any]] = ContextVar('log_context', default={})
+_sweep_ids = itertools.count(1)
+
+
+@contextmanager
+def log_context(**fields: Any) -> Generator[None, None, None]:
+    """Records logged in this context, also by the tasks it starts, carry these fields"""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def new_sweep_id() -> int:
+    return next(_sweep_ids)
+
+
+class ContextFilter(logging.Filter):
+    """Adds the fields of the log context to the record. Runs in the thread that logs, where the context is set."""
+    def filter(self, record: logging.LogRecord) -> bool:
+        for name, value in _context.get().items():
+            setattr(record, name, value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Passes the first of every `sample_every` records with the same message template and context.
+    Passed records get `suppressed`, the number of records dropped since the previous passed one.
+    """
+    def __init__(self) -> None:
+        super().__init__()
+        self.counts: dict[tuple, int] = {}  # (template, chain, aave version) -> records seen
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        sample_every = getattr(record, 'sample_every', None)
+        if sample_every is None or sample_every <= 1:
+            return True
+        key = (record.msg, getattr(record, 'chain', None), getattr(record, 'aave_version', None))
+        count = self.counts.get(key, 0)
+        self.counts[key] = count + 1
+        if count % sample_every != 0:
+            LOG_RECORDS_DROPPED.inc(reason='sampled')
+            return False
+        record.suppressed = 0 if count == 0 else sample_every - 1
+        return True
+
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """Leaves the formatting to the writer thread and drops records instead of blocking when the queue is full"""
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc(reason='queue_full')
+
+
+class RotatingLogFileHandler(logging.handlers.RotatingFileHandler):
+    """Rotated when it reaches max_bytes or when it was written for rotation_period seconds, whichever comes first.
+    Rotated files are numbered like with RotatingFileHandler.
+    """
+    def __init__(self, filename: str, max_bytes: int, rotation_period: float, backup_count: int) -> None:
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        self.rotation_period = rotation_period
+        self.rotate_at = time.time() + rotation_period
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        return time.time() >= self.rotate_at or bool(super().shouldRollover(record))
+
+    def doRollover(self) -> None:
+        super().doRollover()
+        self.rotate_at = time.time() + self.rotation_period
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with the context fields of the record"""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'path': record.pathname,
+            'line': record.lineno,
+            'message': record.getMessage(),
+        }
+        for name in CONTEXT_FIELDS + ('suppressed',):
+            if hasattr(record, name):
+                entry[name] = getattr(record, name)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def start_log_writer(logger: logging.Logger, handlers: list[logging.Handler]) -> logging.handlers.QueueListener:
+    """Replaces the handlers of the logger with the queue and writes its records to the handlers from a background thread"""
+    log_queue: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = AsyncQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    queue_handler.addFilter(SamplingFilter())  # After ContextFilter, records are sampled per context
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+        handler.close()
+    logger.addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def setup_logging(log_file: str, json_file: bool = True) -> logging.handlers.QueueListener:
+    """Logs INFO and above of all loggers as text to stdout and as JSON lines (or text) to the rotated log file.
+    Stop the returned listener on exit to write the queued records.
+    """
+    file_handler = RotatingLogFileHandler(log_file, LOG_MAX_BYTES, LOG_ROTATION_PERIOD, LOG_BACKUP_COUNT)
+    file_handler.setFormatter(JsonFormatter() if json_file else logging.Formatter(TEXT_FORMAT))
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    return start_log_writer(root, [file_handler, stream_handler])
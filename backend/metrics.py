@@ -0,0 +1,217 @@
+"""Prometheus-style metrics served as text on a local HTTP endpoint, and optional tracing spans.
+Spans are always measured by the span duration histogram. They are also exported through OpenTelemetry
+when the opentelemetry package is installed and TRACING=1.
+"""
+import functools
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Generator
+
+from aiohttp import web
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)  # seconds
+TRACING = os.environ.get('TRACING') == '1' and trace is not None
+
+Labels = tuple[tuple[str, str], ...]
+
+_metrics: list['Metric'] = []
+
+
+def to_labels(labels: dict[str, Any]) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def format_labels(labels: Labels, extra: tuple[str, str] | None = None) -> str:
+    pairs = labels + ((extra,) if extra is not None else ())
+    if len(pairs) == 0:
+        return ''
+    escaped = (name + '="' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for name, value in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+
+class Metric():
+    type = ''
+
+    def __init__(self, name: str, description: str) -> None:
+        self.name = name
+        self.description = description
+        _metrics.append(self)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.type}', *self.samples()])
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, description: str) -> None:
+        super().__init__(name, description)
+        self.values: dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = to_labels(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        return [f'{self.name}{format_labels(labels)} {value}' for labels, value in self.values.items()]
+
+
+class Gauge(Metric):
+    """Either set explicitly or read from the callbacks when the metrics are scraped"""
+    type = 'gauge'
+
+    def __init__(self, name: str, description: str) -> None:
+        super().__init__(name, description)
+        self.values: dict[Labels, float] = {}
+        self.callbacks: dict[Labels, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels: Any) -> None:
+        self.values[to_labels(labels)] = value
+
+    def set_function(self, callback: Callable[[], float], **labels: Any) -> None:
+        self.callbacks[to_labels(labels)] = callback
+
+    def samples(self) -> list[str]:
+        values = {**self.values, **{labels: callback() for labels, callback in self.callbacks.items()}}
+        return [f'{self.name}{format_labels(labels)} {value}' for labels, value in values.items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, description: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, description)
+        self.buckets = buckets
+        self.counts: dict[Labels, list[int]] = {}  # Not cumulative, the last one is +Inf
+        self.sums: dict[Labels, float] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = to_labels(labels)
+        if key not in self.counts:
+            self.counts[key] = [0] * (len(self.buckets) + 1)
+            self.sums[key] = 0
+        index = next((i for i, bucket in enumerate(self.buckets) if value <= bucket), len(self.buckets))
+        self.counts[key][index] += 1
+        self.sums[key] += value
+
+    @contextmanager
+    def time(self, **labels: Any) -> Generator[None, None, None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> list[str]:
+        lines = []
+        for labels, counts in self.counts.items():
+            cumulative = 0
+            for bucket, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{format_labels(labels, ("le", str(bucket)))} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(labels)} {self.sums[labels]}')
+            lines.append(f'{self.name}_count{format_labels(labels)} {cumulative}')
+        return lines
+
+
+SWEEP_SECONDS = Histogram('backend_health_factor_sweep_seconds', 'Duration of health factor checks of a connector')
+SWEEP_ACCOUNTS = Counter('backend_health_factor_checked_accounts_total', 'Accounts whose health factors were checked')
+BLOCK_LAG = Gauge('backend_block_lag', 'How many blocks a monitor was behind the head when it started processing')
+RPC_REQUEST_SECONDS = Histogram('backend_rpc_request_seconds', 'Latency of JSON-RPC requests by method')
+RPC_REQUESTS = Counter('backend_rpc_requests_total', 'JSON-RPC requests by method')
+RPC_ERRORS = Counter('backend_rpc_errors_total', 'Failed JSON-RPC requests by method, including JSON-RPC error responses')
+RPC_COMPUTE_UNITS = Counter('backend_rpc_compute_units_total', 'Compute units of JSON-RPC calls to providers with a quota, by priority')
+RPC_THROTTLED = Counter('backend_rpc_throttled_total', 'JSON-RPC calls that waited for the quota of their provider, by priority')
+RPC_QUOTA_WAIT_SECONDS = Histogram('backend_rpc_quota_wait_seconds', 'Time throttled JSON-RPC calls waited for the quota of their provider')
+RPC_QUOTA_AVAILABLE = Gauge('backend_rpc_quota_available', 'Compute units left in the token bucket of a provider')
+RPC_RATE_LIMITED = Counter('backend_rpc_rate_limited_total', 'JSON-RPC calls answered with 429 by provider')
+MULTICALL_BATCH_SECONDS = Histogram('backend_multicall_batch_seconds', 'Latency of a single aggregate3 batch')
+DB_QUERY_SECONDS = Histogram('backend_db_query_seconds', 'Round-trip time of database queries')
+NOTIFICATION_QUEUE_DEPTH = Gauge('backend_notification_queue_depth', 'Notifications waiting in the dispatcher queue')
+NOTIFICATION_SEND_SECONDS = Histogram('backend_notification_send_seconds', 'Time to deliver one notification call to OneSignal, including retries')
+NOTIFICATIONS = Counter('backend_notifications_total', 'OneSignal notification calls by result')
+SPAN_SECONDS = Histogram('backend_span_seconds', 'Duration of traced operations')
+LOG_RECORDS_DROPPED = Counter('backend_log_records_dropped_total', 'Log records that were sampled out or did not fit in the log queue, by reason')
+
+
+def render_metrics() -> str:
+    return '\n'.join(metric.render() for metric in _metrics) + '\n'
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render_metrics(), content_type='text/plain', charset='utf-8')
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info('Serving metrics on http://%s:%d/metrics', host, port)
+    return runner
+
+
+def timed(histogram: Histogram, **labels: Any) -> Callable:
+    """Decorator that observes the duration of a sync function"""
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Generator[None, None, None]:
+    with SPAN_SECONDS.time(span=name, **attributes):
+        if not TRACING:
+            yield
+            return
+        with trace.get_tracer('backend').start_as_current_span(name, attributes={key: str(value) for key, value in attributes.items()}):
+            yield
+
+
+def traced(name: str) -> Callable:
+    """Decorator that runs a coroutine method in a span. Chain and aave version of the instance are added as attributes."""
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        async def wrapper(self, *args, **kwargs):
+            attributes = {}
+            if hasattr(self, 'chain') and hasattr(self, 'aave_version'):
+                attributes = {'chain': self.chain.name, 'aave_version': self.aave_version}
+            with span(name, **attributes):
+                return await function(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def rpc_metrics_middleware(chain_name: str) -> Callable:
+    """web3 middleware that counts and times every JSON-RPC request of a chain"""
+    async def middleware(make_request: Callable, web3: Any) -> Callable:
+        async def measure(method: str, params: Any) -> Any:
+            RPC_REQUESTS.inc(chain=chain_name, method=method)
+            start = time.perf_counter()
+            try:
+                response = await make_request(method, params)
+            except Exception:
+                RPC_ERRORS.inc(chain=chain_name, method=method)
+                raise
+            finally:
+                RPC_REQUEST_SECONDS.observe(time.perf_counter() - start, chain=chain_name, method=method)
+            if 'error' in response:
+                RPC_ERRORS.inc(chain=chain_name, method=method)
+            return response
+        return measure
+    return middleware
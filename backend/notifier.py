@@ -1,3 +1,5 @@
+import asyncio
+import functools
 import logging
 import os
 import traceback
@@ -9,24 +11,30 @@ from dotenv import load_dotenv
 from onesignal.api import default_api
 
 from backend.database import Database
+from backend.dispatcher import NotificationDispatcher
+from backend.metrics import traced
 from backend.types import ChainAccount, ChainAccountWithAllData
 
 load_dotenv()
 EventType = Literal['liquidation', 'health_factor']
 
-configuration = onesignal.Configuration(app_key = os.environ["ONESIGNAL_APP_KEY"])
-ONESIGMAL_APP_ID = os.environ["ONESIGNAL_APP_ID"]
+
+@functools.cache
+def get_onesignal_configuration() -> onesignal.Configuration:
+    """Configuration of the blocking OneSignal client, created when the first notification is sent"""
+    return onesignal.Configuration(app_key = os.environ["ONESIGNAL_APP_KEY"])
+
 
 class Notifier:
     def __init__(self, database: Database) -> None:
         self.database = database
 
     def send_single_notificaion(self, onesignal_user_id: str, title: str, message: str) -> None:
-        logging.info(f'Sending a notification to {onesignal_user_id} about {title}')
-        with onesignal.ApiClient(configuration) as api_client:
+        logging.info('Sending a notification to %s about %s', onesignal_user_id, title)
+        with onesignal.ApiClient(get_onesignal_configuration()) as api_client:
             api_instance = default_api.DefaultApi(api_client)
             notification = default_api.Notification(
-                app_id=ONESIGMAL_APP_ID,
+                app_id=os.environ["ONESIGNAL_APP_ID"],
                 include_player_ids=[onesignal_user_id],
                 target_channel='push',
                 headings={'en': title},
@@ -35,29 +43,100 @@ class Notifier:
 
             try:
                 # Create notification
-                logging.info(f'Calling DefaultApi->create_notification for {onesignal_user_id} about {title}')
+                logging.info('Calling DefaultApi->create_notification for %s about %s', onesignal_user_id, title)
                 api_instance.create_notification(notification)
-                logging.info(f'Notification about {title} was successfully sent to {onesignal_user_id}!')
+                logging.info('Notification about %s was successfully sent to %s!', title, onesignal_user_id)
             except onesignal.ApiException:
-                logging.error(f'Exception when calling DefaultApi->create_notification for {onesignal_user_id} about {title}: {traceback.format_exc()}')
+                logging.error('Exception when calling DefaultApi->create_notification for %s about %s: %s', onesignal_user_id, title, traceback.format_exc())
 
     def notify_about_health_factor(self, account: ChainAccountWithAllData, message: str) -> None:
         if account.onesignal_id is None:
-            logging.error(f'Bad! No onesignal id was set for a user {account.user_id} account that tracks {str(account.account)}')
+            logging.error('Bad! No onesignal id was set for a user %s account that tracks %s', account.user_id, account.account)
             return
 
         self.send_single_notificaion(account.onesignal_id, title='Low health factor!', message=message)
         self.database.set_last_health_factor_notification(account.account, account.user_id, datetime.utcnow())
 
     def notify_about_liquidation(self, chain_account: ChainAccount, title: str, message: str) -> None:
-        logging.info(f'Might send a notification about liquidation on {str(chain_account)}')
+        logging.info('Might send a notification about liquidation on %s', chain_account)
         subscribed_accounts = self.database.get_users_for_notification(chain_account)
-        logging.info(f'Found {len(subscribed_accounts)} subscribed accounts on {str(chain_account)}')
+        logging.info('Found %d subscribed accounts on %s', len(subscribed_accounts), chain_account)
         for user_account in subscribed_accounts:
             onesignal_id, _  = user_account
             if onesignal_id is None:
-                logging.error(f'Bad! No onesignal id was sent for a user account that tracks {str(chain_account)}')
+                logging.error('Bad! No onesignal id was sent for a user account that tracks %s', chain_account)
                 continue
 
             self.send_single_notificaion(onesignal_id, title, message)
-            logging.info(f'Sent a notification to {onesignal_id} about liquidation on {str(chain_account)} and set the last notification timestamp')
+            logging.info('Sent a notification to %s about liquidation on %s and set the last notification timestamp', onesignal_id, chain_account)
+
+
+class AsyncNotifier:
+    """Same as Notifier but notifications are queued to the dispatcher instead of being sent from the event loop.
+    All users tracking a liquidated account get one grouped notification.
+    """
+    def __init__(self, database: Database, dispatcher: NotificationDispatcher) -> None:
+        self.database = database
+        self.dispatcher = dispatcher
+        self.cooldown_tasks: set[asyncio.Task] = set()
+
+    async def join(self) -> None:
+        """Wait until the queued notifications are sent and their timestamps are written"""
+        await self.dispatcher.join()
+        await asyncio.gather(*self.cooldown_tasks)
+
+    async def close(self) -> None:
+        await self.join()
+        await self.dispatcher.close()
+
+    @traced('notify_about_health_factors')
+    async def notify_about_health_factors(self, notifications: list[tuple[ChainAccountWithAllData, str]]) -> None:
+        """Notify about low health factors of many (account, message) pairs found in one sweep.
+        Timestamps of the delivered ones are saved in one bulk call once the dispatcher has sent them, so an account
+        whose notification failed is not muted for the notification interval. Until then the connectors keep
+        the notified accounts out of their checks.
+        """
+        to_send = []
+        for account, message in notifications:
+            if account.onesignal_id is None:
+                logging.error('Bad! No onesignal id was set for a user %s account that tracks %s', account.user_id, account.account)
+                continue
+            to_send.append((account, account.onesignal_id, message))
+
+        if len(to_send) == 0:
+            return
+
+        deliveries = [await self.dispatcher.submit([onesignal_id], title='Low health factor!', message=message) for _, onesignal_id, message in to_send]
+        task = asyncio.create_task(self.save_cooldowns([account for account, _, _ in to_send], deliveries))
+        self.cooldown_tasks.add(task)
+        task.add_done_callback(self.cooldown_tasks.discard)
+
+    async def save_cooldowns(self, accounts: list[ChainAccountWithAllData], deliveries: list[asyncio.Future]) -> None:
+        delivered = [account for account, sent in zip(accounts, await asyncio.gather(*deliveries)) if sent]
+        if len(delivered) < len(accounts):
+            logging.warning('%d low health factor notifications were not delivered, their accounts are not put in cooldown', len(accounts) - len(delivered))
+        if len(delivered) == 0:
+            return
+        try:
+            await asyncio.to_thread(self.database.set_last_health_factor_notifications, delivered, datetime.utcnow())
+        except Exception:
+            logging.error('Could not save the notification timestamps of %d accounts: %s', len(delivered), traceback.format_exc())
+
+    async def notify_about_health_factor(self, account: ChainAccountWithAllData, message: str) -> None:
+        await self.notify_about_health_factors([(account, message)])
+
+    @traced('notify_about_liquidation')
+    async def notify_about_liquidation(self, chain_account: ChainAccount, title: str, message: str) -> None:
+        logging.info('Might send a notification about liquidation on %s', chain_account)
+        subscribed_accounts = await asyncio.to_thread(self.database.get_users_for_notification, chain_account)
+        logging.info('Found %d subscribed accounts on %s', len(subscribed_accounts), chain_account)
+        onesignal_ids = []
+        for onesignal_id, _ in subscribed_accounts:
+            if onesignal_id is None:
+                logging.error('Bad! No onesignal id was sent for a user account that tracks %s', chain_account)
+                continue
+            onesignal_ids.append(onesignal_id)
+
+        if len(onesignal_ids) > 0:
+            await self.dispatcher.submit(onesignal_ids, title, message)
+            logging.info('Queued a notification to %d users about liquidation on %s', len(onesignal_ids), chain_account)
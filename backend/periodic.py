@@ -0,0 +1,28 @@
+import asyncio
+import logging
+import traceback
+from typing import TYPE_CHECKING
+
+from backend.admin import send_admin_message
+
+if TYPE_CHECKING:
+    from backend.connector import AsyncChainConnector
+
+HEALTH_FACTOR_CHECK_PERIOD = 60 * 15  # every 15 minutes
+
+
+class PeriodicSweeper():
+    """Checks health factors of all accounts every 15 minutes. The default health factor monitor of AsyncChainConnector."""
+    def __init__(self, connector: 'AsyncChainConnector') -> None:
+        self.connector = connector
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.connector.connect()
+                await self.connector.check_health_factors()
+            except Exception:
+                await send_admin_message('Critical error!')
+                logging.error('Error while checking health factors on %s x Aave V%d: %s', self.connector.chain.name, self.connector.aave_version, traceback.format_exc())
+
+            await asyncio.sleep(HEALTH_FACTOR_CHECK_PERIOD)
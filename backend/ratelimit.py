@@ -0,0 +1,208 @@
+"""RPC quotas of the providers. Paid plans limit compute units per second per API key, so every provider host with a
+configured limit gets a token bucket that all connectors, RPC pools and batchers share. Calls are weighted by their
+method and wait in priority order: liquidation alerts and at-risk health factor checks go before sweeps and backfills.
+A 429 halves the rate of the provider, which then recovers linearly.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Generator, TypeVar
+
+from aiohttp import ClientResponseError
+
+from backend.metrics import RPC_COMPUTE_UNITS, RPC_QUOTA_AVAILABLE, RPC_QUOTA_WAIT_SECONDS, RPC_RATE_LIMITED, RPC_THROTTLED
+from backend.rpc import rpc_host
+
+DEFAULT_METHOD_COST = 20  # compute units of a method that is not in METHOD_COSTS
+METHOD_COSTS = {  # compute units, as priced by Alchemy. Other providers weigh the methods about the same.
+    'eth_chainId': 0,
+    'net_version': 0,
+    'eth_blockNumber': 10,
+    'eth_getBlockByNumber': 16,
+    'eth_getTransactionReceipt': 15,
+    'eth_call': 26,
+    'eth_estimateGas': 87,
+    'eth_getLogs': 75,
+}
+BURST_SECONDS = 1  # A bucket holds this many seconds of its rate
+RATE_LIMITED_BACKOFF = 0.5  # The rate of a provider is multiplied by this after a 429
+MIN_RATE_SHARE = 0.1  # The rate never drops below this share of the configured one
+RATE_RECOVERY_PERIOD = 60  # seconds for the rate to recover from the minimum to the configured one
+RATE_LIMITED_RETRIES = 2  # A call answered with 429 is retried this many times
+RATE_LIMITED_RETRY_DELAY = 1  # seconds, before a retry to a provider without a configured limit
+
+T = TypeVar('T')
+
+
+class Priority(IntEnum):
+    """Lower values are served first when a provider is out of quota"""
+    LIQUIDATIONS = 0
+    AT_RISK = 1
+    SWEEP = 2
+    BACKFILL = 3
+
+
+_priority: ContextVar[Priority] = ContextVar('rpc_priority', default=Priority.SWEEP)
+_buckets: dict[str, 'TokenBucket'] = {}
+
+
+@contextmanager
+def rpc_priority(priority: Priority) -> Generator[None, None, None]:
+    """RPC calls made in this context, also by the tasks it starts, wait for quota with this priority"""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> Priority:
+    return _priority.get()
+
+
+def get_method_cost(method: str) -> int:
+    return METHOD_COSTS.get(method, DEFAULT_METHOD_COST)
+
+
+def get_request_cost(payload: dict | list[dict]) -> int:
+    """Every call of a JSON-RPC batch is charged"""
+    if isinstance(payload, list):
+        return sum(get_method_cost(item['method']) for item in payload)
+    return get_method_cost(payload['method'])
+
+
+class TokenBucket():
+    """Compute units of one provider. Waiting calls are granted in priority order, then in arrival order.
+    A call costlier than the whole bucket waits for a full bucket and leaves it in debt, so the average rate holds.
+    """
+    def __init__(self, provider: str, rate: float) -> None:
+        self.provider = provider
+        self.configured_rate = rate
+        self.rate = rate
+        self.capacity = rate * BURST_SECONDS
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.waiters: list[tuple[Priority, int, float, asyncio.Future]] = []  # Heap of (priority, arrival, cost, future)
+        self.arrivals = itertools.count()
+        self.timer: asyncio.TimerHandle | None = None
+        RPC_QUOTA_AVAILABLE.set_function(self.available, provider=provider)
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        self.rate = min(self.configured_rate, self.rate + self.configured_rate * (1 - MIN_RATE_SHARE) * elapsed / RATE_RECOVERY_PERIOD)
+        self.tokens = min(self.capacity, self.tokens + self.rate * elapsed)
+
+    def available(self) -> float:
+        self.refill()
+        return self.tokens
+
+    def can_take(self, cost: float) -> bool:
+        return self.tokens >= min(cost, self.capacity)
+
+    async def acquire(self, cost: float, priority: Priority) -> None:
+        self.refill()
+        RPC_COMPUTE_UNITS.inc(cost, provider=self.provider, priority=priority.name)
+        if len(self.waiters) == 0 and self.can_take(cost):
+            self.tokens -= cost
+            return
+
+        RPC_THROTTLED.inc(provider=self.provider, priority=priority.name)
+        start = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.arrivals), cost, future))
+        self.grant()
+        try:
+            await future  # Cancelled waiters are skipped by grant
+        finally:
+            RPC_QUOTA_WAIT_SECONDS.observe(time.monotonic() - start, provider=self.provider, priority=priority.name)
+
+    def grant(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()  # Rescheduled for the waiter that is first now
+            self.timer = None
+        self.refill()
+        while len(self.waiters) > 0:
+            _, _, cost, future = self.waiters[0]
+            if future.done():
+                heapq.heappop(self.waiters)
+            elif self.can_take(cost):
+                heapq.heappop(self.waiters)
+                self.tokens -= cost
+                future.set_result(None)
+            else:
+                break
+        if len(self.waiters) > 0:
+            deficit = min(self.waiters[0][2], self.capacity) - self.tokens
+            self.timer = asyncio.get_running_loop().call_later(deficit / self.rate, self.grant)
+
+    def penalize(self) -> None:
+        """The provider answered with 429, so its real quota is lower than the configured one or is shared with other clients"""
+        self.refill()
+        self.rate = max(self.configured_rate * MIN_RATE_SHARE, self.rate * RATE_LIMITED_BACKOFF)
+        self.tokens = min(self.tokens, 0)
+        logging.warning('RPC provider %s is rate limiting, its rate is lowered to %.0f compute units per second', self.provider, self.rate)
+
+
+def parse_rate_limits(raw_limits: str) -> dict[str, float]:
+    """`host=compute units per second` pairs separated by commas"""
+    limits = {}
+    for pair in raw_limits.split(','):
+        if pair.strip() == '':
+            continue
+        host, rate = pair.split('=')
+        limits[host.strip()] = float(rate)
+    return limits
+
+
+def configure_rate_limits(limits: dict[str, float]) -> None:
+    """Compute units per second by provider host. Calls to other providers are not throttled, only retried after a 429."""
+    _buckets.clear()
+    for host, rate in limits.items():
+        _buckets[host] = TokenBucket(host, rate)
+        logging.info('RPC provider %s is limited to %.0f compute units per second', host, rate)
+
+
+def get_bucket(rpc_url: str) -> TokenBucket | None:
+    return _buckets.get(rpc_host(rpc_url))
+
+
+def is_rate_limited_error(exception: Exception) -> bool:
+    return isinstance(exception, ClientResponseError) and exception.status == 429
+
+
+async def call_with_quota(rpc_url: str, cost: float, send: Callable[[], Awaitable[T]]) -> T:
+    """Wait for the quota of the provider, then send. A call answered with 429 lowers the rate of the provider and is retried."""
+    bucket = get_bucket(rpc_url)
+    attempt = 0
+    while True:
+        if bucket is not None:
+            await bucket.acquire(cost, current_priority())
+        try:
+            return await send()
+        except Exception as e:
+            if not is_rate_limited_error(e):
+                raise
+            RPC_RATE_LIMITED.inc(provider=rpc_host(rpc_url))
+            if bucket is not None:
+                bucket.penalize()
+            if attempt == RATE_LIMITED_RETRIES:
+                raise
+        attempt += 1
+        if bucket is None:
+            await asyncio.sleep(RATE_LIMITED_RETRY_DELAY)
+
+
+def rate_limit_middleware(rpc_url: str) -> Callable:
+    """web3 middleware that waits for the quota of the provider before every JSON-RPC request"""
+    async def middleware(make_request: Callable, web3: Any) -> Callable:
+        async def limit(method: str, params: Any) -> Any:
+            return await call_with_quota(rpc_url, get_method_cost(method), lambda: make_request(method, params))
+        return limit
+    return middleware
@@ -0,0 +1,141 @@
+import asyncio
+from typing import TYPE_CHECKING, NamedTuple
+
+import numpy as np
+from web3.contract import AsyncContract
+
+from backend.codec import decode_uint256, encode_balance_of
+from backend.types import ChainAccountWithAllData
+
+if TYPE_CHECKING:
+    from backend.connector import AsyncChainConnector
+
+# The local model ignores V3 e-mode and interest accrued since the last refresh,
+# so accounts are verified on-chain a bit before their predicted health factor reaches the threshold.
+PREDICTION_MARGIN = 0.05
+
+
+class ReserveData(NamedTuple):
+    asset: str
+    a_token: str
+    stable_debt_token: str
+    variable_debt_token: str
+    liquidation_threshold: float  # e.g. 0.825
+    decimals: int
+
+
+def parse_reserve_configuration(configuration: int) -> tuple[float, int]:
+    """Returns liquidation threshold and decimals packed in the aave reserve configuration bitmap"""
+    liquidation_threshold = (configuration >> 16) & 0xFFFF
+    decimals = (configuration >> 48) & 0xFF
+    return liquidation_threshold / 10_000, decimals
+
+
+class PositionModel():
+    """Per-reserve collateral and debt of the tracked accounts, used to predict health factors locally when prices change.
+    Health factor = sum(collateral * price * liquidation threshold) / sum(debt * price), computed for all accounts at once.
+    """
+    def __init__(self, connector: 'AsyncChainConnector') -> None:
+        self.connector = connector
+        self.reserves: list[ReserveData] = []
+        self.rows: dict[str, int] = {}  # Lowercase account address -> row in the balances matrices
+        self.unknown: set[str] = set()  # Accounts whose balances couldn't be queried
+        self.collateral = np.zeros((0, 0))  # accounts x reserves, in token units
+        self.debt = np.zeros((0, 0))  # accounts x reserves, in token units
+        self.prices = np.zeros(0)
+        self.ready = False
+
+        outputs = next(item for item in connector.pool_abi if item.get('name') == 'getReserveData')['outputs'][0]['components']
+        self.reserve_data_fields = {output['name']: index for index, output in enumerate(outputs)}
+
+    async def load_reserves(self, assets: list[str]) -> None:
+        reserves_data = await asyncio.gather(*(self.connector.pool_contract.functions.getReserveData(asset).call() for asset in assets))
+        fields = self.reserve_data_fields
+        self.reserves = []
+        for asset, reserve_data in zip(assets, reserves_data):
+            liquidation_threshold, decimals = parse_reserve_configuration(reserve_data[fields['configuration']][0])
+            self.reserves.append(ReserveData(
+                asset=asset,
+                a_token=reserve_data[fields['aTokenAddress']],
+                stable_debt_token=reserve_data[fields['stableDebtTokenAddress']],
+                variable_debt_token=reserve_data[fields['variableDebtTokenAddress']],
+                liquidation_threshold=liquidation_threshold,
+                decimals=decimals,
+            ))
+
+    async def load_prices(self, price_oracle: AsyncContract) -> None:
+        prices = await price_oracle.functions.getAssetsPrices([reserve.asset for reserve in self.reserves]).call()
+        self.prices = np.array(prices, dtype=np.float64)
+
+    async def load_positions(self, user_configurations: dict[str, int]) -> None:
+        """Query balances of the reserves used by the given accounts (lowercase address -> aave user configuration)"""
+        calls = []
+        cells = []  # (address, reserve index, is collateral)
+        for address, user_configuration in user_configurations.items():
+            account = self.connector.web3.to_checksum_address(address)
+            for reserve_index, reserve in enumerate(self.reserves):
+                if (user_configuration >> (reserve_index * 2 + 1)) & 1:
+                    calls.append((reserve.a_token, encode_balance_of(account)))
+                    cells.append((address, reserve_index, True))
+                if (user_configuration >> (reserve_index * 2)) & 1:
+                    calls.append((reserve.stable_debt_token, encode_balance_of(account)))
+                    cells.append((address, reserve_index, False))
+                    calls.append((reserve.variable_debt_token, encode_balance_of(account)))
+                    cells.append((address, reserve_index, False))
+
+        results = await self.connector.batcher.aggregate(calls)
+
+        new_addresses = [address for address in user_configurations if address not in self.rows]
+        for address in new_addresses:
+            self.rows[address] = len(self.rows)
+        reserves_count = len(self.reserves)
+        self.collateral = np.pad(self.collateral, ((0, len(self.rows) - self.collateral.shape[0]), (0, reserves_count - self.collateral.shape[1])))
+        self.debt = np.pad(self.debt, ((0, len(self.rows) - self.debt.shape[0]), (0, reserves_count - self.debt.shape[1])))
+
+        updated_rows = [self.rows[address] for address in user_configurations]
+        self.collateral[updated_rows] = 0
+        self.debt[updated_rows] = 0
+        self.unknown -= user_configurations.keys()
+        scale = np.array([10.0 ** reserve.decimals for reserve in self.reserves])
+        for (address, reserve_index, is_collateral), result in zip(cells, results):
+            if result is None:
+                self.unknown.add(address)  # Such accounts are always verified on-chain
+                continue
+            balance = decode_uint256(result) / scale[reserve_index]
+            if is_collateral:
+                self.collateral[self.rows[address], reserve_index] = balance
+            else:
+                self.debt[self.rows[address], reserve_index] += balance
+
+    async def refresh(self, assets: list[str], price_oracle: AsyncContract, user_configurations: dict[str, int]) -> None:
+        self.ready = False
+        self.rows = {}
+        self.unknown = set()
+        self.collateral = np.zeros((0, len(assets)))
+        self.debt = np.zeros((0, len(assets)))
+        await self.load_reserves(assets)
+        await self.load_prices(price_oracle)
+        await self.load_positions(user_configurations)
+        self.ready = True
+
+    def predict_health_factors(self) -> np.ndarray:
+        """Health factors of all rows. Accounts without debt get infinity."""
+        liquidation_thresholds = np.array([reserve.liquidation_threshold for reserve in self.reserves])
+        weighted_collateral = self.collateral @ (self.prices * liquidation_thresholds)
+        total_debt = self.debt @ self.prices
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(total_debt > 0, weighted_collateral / total_debt, np.inf)
+
+    def get_accounts_near_threshold(self, accounts: list[ChainAccountWithAllData]) -> list[ChainAccountWithAllData]:
+        """Accounts whose predicted health factor is below their threshold (with the margin) or unknown to the model"""
+        if not self.ready:
+            return accounts
+        health_factors = self.predict_health_factors()
+        addresses = [account.account.address.lower() for account in accounts]
+        rows = np.array([self.rows.get(address, -1) if address not in self.unknown else -1 for address in addresses], dtype=np.int64)
+        thresholds = np.array([account.health_factor_threshold for account in accounts], dtype=np.float64)
+        predicted = np.full(len(accounts), -np.inf)
+        known = rows >= 0
+        predicted[known] = health_factors[rows[known]]
+        mask = predicted < thresholds * (1 + PREDICTION_MARGIN)
+        return [account for account, near in zip(accounts, mask) if near]
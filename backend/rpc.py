@@ -0,0 +1,54 @@
+import asyncio
+from urllib.parse import urlparse
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from web3 import AsyncHTTPProvider, AsyncWeb3
+
+RPC_CONNECTIONS_PER_HOST = 20  # Size of the keep-alive pool shared by all connectors that use the same RPC host
+RPC_REQUEST_TIMEOUT = 30  # seconds
+RPC_MAX_CONCURRENT_MULTICALLS = 4  # How many multicall batches can be in flight at once for one RPC host
+
+_sessions: dict[str, ClientSession] = {}
+_semaphores: dict[str, asyncio.Semaphore] = {}
+
+
+def rpc_host(rpc_url: str) -> str:
+    return urlparse(rpc_url).netloc
+
+
+async def get_session(rpc_url: str) -> ClientSession:
+    """Get the pooled HTTP session for the host of the given RPC url. Creates it on the first call."""
+    host = rpc_host(rpc_url)
+    session = _sessions.get(host)
+    if session is None or session.closed:
+        session = ClientSession(
+            connector=TCPConnector(limit=RPC_CONNECTIONS_PER_HOST, ttl_dns_cache=300),
+            timeout=ClientTimeout(total=RPC_REQUEST_TIMEOUT),
+            raise_for_status=True,
+        )
+        _sessions[host] = session
+    return session
+
+
+def get_semaphore(rpc_url: str) -> asyncio.Semaphore:
+    """Limits the number of concurrent heavy calls to the host of the given RPC url"""
+    host = rpc_host(rpc_url)
+    if host not in _semaphores:
+        _semaphores[host] = asyncio.Semaphore(RPC_MAX_CONCURRENT_MULTICALLS)
+    return _semaphores[host]
+
+
+def make_async_web3(rpc_url: str) -> AsyncWeb3:
+    return AsyncWeb3(AsyncHTTPProvider(rpc_url))
+
+
+async def attach_session(web3: AsyncWeb3, rpc_url: str) -> None:
+    """Make the web3 provider send its requests through the pooled session of its RPC host"""
+    provider: AsyncHTTPProvider = web3.provider  # type: ignore[assignment]
+    await provider.cache_async_session(await get_session(rpc_url))
+
+
+async def close_sessions() -> None:
+    for session in _sessions.values():
+        await session.close()
+    _sessions.clear()
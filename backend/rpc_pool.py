@@ -0,0 +1,227 @@
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from typing import Any
+
+from web3.providers.async_base import AsyncJSONBaseProvider
+from web3.types import RPCEndpoint, RPCResponse
+
+from backend.ratelimit import call_with_quota, get_method_cost
+from backend.rpc import get_session
+from backend.types import Chain
+
+LATENCY_WINDOW = 100  # How many latest requests of an endpoint are used for its statistics
+MIN_LATENCY_SAMPLES = 10  # Fewer samples than this are not enough to estimate p99 of a method
+DEFAULT_HEDGE_DELAY = 2.0  # seconds, used until there are enough samples
+MIN_HEDGE_DELAY = 0.2  # seconds
+MAX_HEDGE_DELAY = 5.0  # seconds
+MAX_REQUESTS_IN_FLIGHT = 2  # A request is hedged at most once at a time, failover still tries all endpoints
+ERROR_RATE_PENALTY = 10  # Score of an endpoint is its p50 latency multiplied by 1 + this * error rate
+MAX_CONSECUTIVE_FAILURES = 3  # After this many failures in a row the endpoint is skipped for ENDPOINT_COOLDOWN
+ENDPOINT_COOLDOWN = 30  # seconds
+UNHEDGED_METHODS = {  # Not idempotent, or too heavy to send twice (aggregate3 calls of thousands of accounts)
+    'eth_sendRawTransaction',
+    'eth_sendTransaction',
+    'eth_call',
+}
+RPC_NODES_PATH = './data/rpc_nodes.json'
+
+
+def percentile(samples: list[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def load_rpc_urls(chain: Chain, rpc_urls: str, include_public_node: bool = False) -> list[str]:
+    """Comma separated urls from the environment first, then optionally the public endpoint of the chain from data/rpc_nodes.json"""
+    urls = [url.strip() for url in rpc_urls.split(',') if url.strip()]
+    if include_public_node:
+        with open(RPC_NODES_PATH) as f:
+            public_url = json.loads(f.read()).get(chain.value)
+        if public_url is not None:
+            urls.append(public_url)
+    return list(dict.fromkeys(urls))
+
+
+def get_min_block(payload: dict | list[dict]) -> int | None:
+    """Highest toBlock of the eth_getLogs calls of a request. A node behind it would return the logs of the range partially."""
+    to_blocks = []
+    for call in payload if isinstance(payload, list) else [payload]:
+        if call['method'] == 'eth_getLogs' and len(call['params']) > 0:
+            to_block = call['params'][0].get('toBlock')
+            if isinstance(to_block, int):
+                to_blocks.append(to_block)
+            elif isinstance(to_block, str) and to_block.startswith('0x'):
+                to_blocks.append(int(to_block, 16))
+    return max(to_blocks) if len(to_blocks) > 0 else None
+
+
+class EndpointBehindError(Exception):
+    """The endpoint has not synced the blocks the request asks for"""
+
+
+class EndpointStats():
+    """Latency and error statistics of the latest requests to one RPC endpoint"""
+    def __init__(self, url: str) -> None:
+        self.url = url
+        self.latencies: deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.method_latencies: dict[str, deque[float]] = {}
+        self.results: deque[bool] = deque(maxlen=LATENCY_WINDOW)  # True for failed requests
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+        self.head_block = 0  # The highest block number the endpoint reported
+
+    def record_latency(self, method: str, latency: float) -> None:
+        self.latencies.append(latency)
+        self.method_latencies.setdefault(method, deque(maxlen=LATENCY_WINDOW)).append(latency)
+
+    def record_success(self, method: str, latency: float) -> None:
+        self.record_latency(method, latency)
+        self.results.append(False)
+        self.consecutive_failures = 0
+
+    def record_failure(self, error: Exception) -> None:
+        self.results.append(True)
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= MAX_CONSECUTIVE_FAILURES and self.is_healthy():
+            self.unhealthy_until = time.monotonic() + ENDPOINT_COOLDOWN
+            logging.warning('RPC endpoint %s is skipped for %ss after %d failures in a row, the last one is %r. %s', self.url, ENDPOINT_COOLDOWN, self.consecutive_failures, error, self)
+
+    def is_healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+    def error_rate(self) -> float:
+        return sum(self.results) / len(self.results) if len(self.results) > 0 else 0.0
+
+    def p50(self, method: str | None = None) -> float:
+        samples = self.method_latencies.get(method) if method is not None else None
+        if samples is None or len(samples) < MIN_LATENCY_SAMPLES:
+            samples = self.latencies
+        return percentile(list(samples), 0.5) if len(samples) > 0 else 0.0
+
+    def p99(self, method: str | None = None) -> float | None:
+        samples = self.method_latencies.get(method) if method is not None else self.latencies
+        if samples is None or len(samples) < MIN_LATENCY_SAMPLES:
+            return None
+        return percentile(list(samples), 0.99)
+
+    def score(self, method: str) -> float:
+        """Lower is better. Endpoints without samples score 0, so they are tried early."""
+        return self.p50(method) * (1 + ERROR_RATE_PENALTY * self.error_rate())
+
+    def __str__(self) -> str:
+        p99 = self.p99()
+        return f'{self.url}: p50 {self.p50() * 1000:.0f}ms, p99 {"-" if p99 is None else f"{p99 * 1000:.0f}ms"}, errors {self.error_rate():.0%}'
+
+
+class RpcPool(AsyncJSONBaseProvider):
+    """web3 provider that spreads requests of one chain across several RPC endpoints.
+    Every request goes to the healthy endpoint with the lowest latency for its method. If it doesn't answer within
+    its p99 latency, the request is hedged to the next endpoint and the first answer wins. Failed requests fail over
+    to the next endpoint, and endpoints that fail repeatedly are skipped for a while.
+    Only transport errors count as failures, JSON-RPC errors are returned to web3 as they are.
+    eth_getLogs is only sent to endpoints that have synced its toBlock, since the endpoint that reported the head may not serve it.
+    """
+    def __init__(self, rpc_urls: list[str]) -> None:
+        assert len(rpc_urls) > 0
+        self.endpoints = [EndpointStats(url) for url in rpc_urls]
+        self.endpoint_uri = rpc_urls[0]  # The primary endpoint, also used as the key of the per host limits
+        super().__init__()
+
+    def __str__(self) -> str:
+        return f'RPC pool {", ".join(endpoint.url for endpoint in self.endpoints)}'
+
+    def rank_endpoints(self, method: str) -> list[EndpointStats]:
+        """Healthy endpoints by score, then the skipped ones as the last resort. Ties keep the configured order."""
+        healthy = sorted((endpoint for endpoint in self.endpoints if endpoint.is_healthy()), key=lambda endpoint: endpoint.score(method))
+        unhealthy = sorted((endpoint for endpoint in self.endpoints if not endpoint.is_healthy()), key=lambda endpoint: endpoint.unhealthy_until)
+        return healthy + unhealthy
+
+    def hedge_delay(self, endpoint: EndpointStats, method: str) -> float:
+        p99 = endpoint.p99(method)
+        if p99 is None:
+            return DEFAULT_HEDGE_DELAY
+        return min(MAX_HEDGE_DELAY, max(MIN_HEDGE_DELAY, p99))
+
+    async def fetch_head_block(self, endpoint: EndpointStats) -> int:
+        response = await self.send(endpoint, 'eth_blockNumber', self.encode_rpc_request(RPCEndpoint('eth_blockNumber'), []), get_method_cost('eth_blockNumber'))
+        if 'result' not in response:
+            raise ValueError(response.get('error'))
+        return endpoint.head_block
+
+    async def send(self, endpoint: EndpointStats, method: str, request_data: bytes, cost: float, min_block: int | None = None) -> Any:
+        if min_block is not None and endpoint.head_block < min_block and await self.fetch_head_block(endpoint) < min_block:
+            raise EndpointBehindError(f'{endpoint.url} is at block {endpoint.head_block}, behind block {min_block}')
+        session = await get_session(endpoint.url)
+
+        async def post() -> bytes:
+            async with session.post(endpoint.url, data=request_data, headers={'Content-Type': 'application/json'}) as response:
+                return await response.read()
+
+        start = time.monotonic()
+        try:
+            rpc_response = self.decode_rpc_response(await call_with_quota(endpoint.url, cost, post))
+        except asyncio.CancelledError:
+            # Another endpoint answered first, so this one took at least that long
+            endpoint.record_latency(method, time.monotonic() - start)
+            raise
+        except Exception as e:
+            endpoint.record_failure(e)
+            raise
+        endpoint.record_success(method, time.monotonic() - start)
+        if method == 'eth_blockNumber' and isinstance(rpc_response.get('result'), str):
+            endpoint.head_block = max(endpoint.head_block, int(rpc_response['result'], 16))
+        return rpc_response
+
+    async def make_request(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        min_block = get_min_block({'method': method, 'params': params})
+        return await self.request_with_failover(method, self.encode_rpc_request(method, params), get_method_cost(method), min_block)
+
+    async def request_with_failover(self, method: str, request_data: bytes, cost: float, min_block: int | None = None) -> Any:
+        """Send encoded request data, also a JSON-RPC batch, with hedging and failover. Method labels the latency statistics
+        and cost is charged to the quota of every endpoint the request is sent to. Endpoints behind min_block fail over.
+        """
+        candidates = self.rank_endpoints(method)
+        pending: set[asyncio.Task[Any]] = set()
+        last_error: BaseException | None = None
+        next_candidate = 0
+
+        def start_next() -> EndpointStats:
+            nonlocal next_candidate
+            endpoint = candidates[next_candidate]
+            next_candidate += 1
+            pending.add(asyncio.create_task(self.send(endpoint, method, request_data, cost, min_block)))
+            return endpoint
+
+        latest_endpoint = start_next()
+        try:
+            while len(pending) > 0:
+                can_hedge = method not in UNHEDGED_METHODS and next_candidate < len(candidates) and len(pending) < MAX_REQUESTS_IN_FLIGHT
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=self.hedge_delay(latest_endpoint, method) if can_hedge else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if len(done) == 0:
+                    logging.debug('Hedging %s from %s to %s', method, latest_endpoint.url, candidates[next_candidate].url)
+                    latest_endpoint = start_next()
+                    continue
+
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    last_error = task.exception()
+                if len(pending) == 0 and next_candidate < len(candidates):
+                    logging.info('Failing over %s to %s after %r', method, candidates[next_candidate].url, last_error)
+                    latest_endpoint = start_next()
+        finally:
+            for task in pending:
+                task.cancel()
+
+        assert last_error is not None
+        raise last_error
+
+    def log_stats(self) -> None:
+        logging.info('%s: %s', self, '; '.join(str(endpoint) for endpoint in self.endpoints))
@@ -0,0 +1,242 @@
+import asyncio
+import heapq
+import logging
+import time
+import traceback
+from typing import TYPE_CHECKING, NamedTuple
+
+from backend.admin import send_admin_message
+from backend.database import Database
+from backend.logqueue import log_context, new_sweep_id
+from backend.metrics import SWEEP_SECONDS
+from backend.ratelimit import Priority, rpc_priority
+from backend.sharding import ShardOwnership, get_address_range_bounds
+from backend.types import Chain, ChainAccountWithAllData
+
+if TYPE_CHECKING:
+    from backend.connector import AsyncChainConnector
+
+MIN_CHECK_INTERVAL = 12  # seconds, about one block on Ethereum
+MAX_CHECK_INTERVAL = 60 * 60  # seconds, for accounts without debt or far from their threshold
+FAILED_CHECK_INTERVAL = 60  # seconds, for accounts whose health factor couldn't be queried
+DEFAULT_VOLATILITY = 0.1  # Relative health factor change per hour assumed until an account was seen twice
+MIN_VOLATILITY = 0.05  # Relative health factor change per hour, even a flat account is assumed to move this fast
+VOLATILITY_DECAY = 0.8  # Weight of the previous volatility estimate when a new change is observed
+MIN_VOLATILITY_WINDOW = 60  # seconds, shorter windows between checks are stretched to this to damp the noise
+SAFETY_FACTOR = 0.2  # Share of the expected time to reach the threshold that is waited before the next check
+ACCOUNTS_RELOAD_PERIOD = 60 * 15  # seconds, new accounts and changed thresholds are picked up after this
+STORE_SAVE_PERIOD = 60 * 5  # seconds
+STALE_RECORD_AGE = 60 * 60 * 24 * 7  # seconds, tracked accounts are checked at least hourly, older rows are of untracked accounts
+ERROR_RETRY_PERIOD = 60  # seconds
+AT_RISK_CHECK_INTERVAL = 60 * 5  # seconds, checks of accounts due this often go before the sweeps and backfills sharing the RPC quota
+
+
+class HealthFactorRecord(NamedTuple):
+    health_factor: float  # -1 for accounts without debt
+    checked_at: float  # unix timestamp
+    volatility: float  # Recent relative health factor change per hour
+
+
+def get_check_interval(record: HealthFactorRecord, threshold: float) -> float:
+    """Seconds until the account should be checked again: a share of the time its health factor needs to reach
+    the threshold if it keeps moving as fast as it recently did
+    """
+    if record.health_factor == -1:
+        return MAX_CHECK_INTERVAL  # No debt, it can't be liquidated before it borrows, which is seen within the hour
+    if record.health_factor <= threshold:
+        return MIN_CHECK_INTERVAL
+    headroom = 1 - threshold / record.health_factor  # How much the health factor can drop before reaching the threshold
+    hours_to_threshold = headroom / max(record.volatility, MIN_VOLATILITY)
+    return min(MAX_CHECK_INTERVAL, max(MIN_CHECK_INTERVAL, SAFETY_FACTOR * hours_to_threshold * 3600))
+
+
+class HealthFactorStore():
+    """Last seen health factor of every account of a pool by lowercase address.
+    Saved to the health_factor table, one row per address, so after a restart accounts are scheduled by their last health factor
+    instead of all at once. Only the records that changed since the previous save are written.
+    In sharded mode only the rows of the owned address ranges are loaded and deleted, the others belong to other workers.
+    """
+    def __init__(self, database: Database, chain: Chain, aave_version: int, shards: ShardOwnership | None = None) -> None:
+        self.database = database
+        self.chain = chain
+        self.aave_version = aave_version
+        self.shards = shards
+        self.records: dict[str, HealthFactorRecord] = {}
+        self.changed: set[str] = set()  # Addresses whose records were updated since the last save
+
+    def load(self) -> None:
+        """Replace the records by the rows of the owned address ranges. Save the changes first."""
+        if self.shards is None:
+            rows = self.database.get_health_factor_rows(self.chain, self.aave_version)
+        else:
+            rows = [
+                row
+                for address_range in self.shards.get_owned_address_ranges(self.chain, self.aave_version)
+                for row in self.database.get_health_factor_rows(self.chain, self.aave_version, *get_address_range_bounds(address_range, self.shards.address_ranges))
+            ]
+        self.records = {row['address']: HealthFactorRecord(row['health_factor'], row['checked_at'], row['volatility']) for row in rows}
+        self.changed = set()
+        logging.info('Loaded last health factors of %d accounts on %s x Aave V%d', len(self.records), self.chain.name, self.aave_version)
+
+    def save(self) -> None:
+        """Save the changed records and delete the stale ones. Accounts missing from the checks, like the ones in their
+        notification cooldown, keep their rows until they are stale.
+        """
+        changed = list(self.changed)
+        self.changed = set()
+        self.database.upsert_health_factor_rows(self.chain, self.aave_version, [
+            {'address': address, **{name: round(value, 4) for name, value in self.records[address]._asdict().items()}}
+            for address in changed
+        ])
+        checked_before = time.time() - STALE_RECORD_AGE
+        stale = [
+            address for address, record in self.records.items()
+            if record.checked_at < checked_before and (self.shards is None or self.shards.owns_address(self.chain, self.aave_version, address))
+        ]
+        self.database.delete_health_factor_rows(self.chain, self.aave_version, stale, checked_before)
+        for address in stale:
+            del self.records[address]
+
+    def get(self, address: str) -> HealthFactorRecord | None:
+        return self.records.get(address.lower())
+
+    def update(self, accounts: list[ChainAccountWithAllData], health_factors: list[float | None], checked_at: float) -> None:
+        for account, health_factor in zip(accounts, health_factors):
+            if health_factor is None:
+                continue
+            address = account.account.address.lower()
+            previous = self.records.get(address)
+            volatility = DEFAULT_VOLATILITY if previous is None else previous.volatility
+            if previous is not None and previous.health_factor > 0 and health_factor > 0 and checked_at > previous.checked_at:
+                change = abs(health_factor - previous.health_factor) / previous.health_factor
+                hours = max(checked_at - previous.checked_at, MIN_VOLATILITY_WINDOW) / 3600
+                volatility = VOLATILITY_DECAY * volatility + (1 - VOLATILITY_DECAY) * change / hours
+            self.records[address] = HealthFactorRecord(health_factor, checked_at, volatility)
+            self.changed.add(address)
+
+
+class AdaptiveScheduler():
+    """Checks every account at its own interval instead of all of them every 15 minutes.
+    Accounts close to their threshold or moving fast are checked about every block, safe ones and the ones without debt hourly.
+    Addresses wait in a heap by their next check time. An address tracked by several users is checked once
+    and scheduled by the highest threshold among them. The state is kept per address, so the accounts are taken
+    from the loader as a list once per reload instead of checking its AccountTable like the sweeps.
+    """
+    def __init__(self, connector: 'AsyncChainConnector', store: HealthFactorStore) -> None:
+        self.connector = connector
+        self.store = store  # Updated by the connector on every check of the scheduled accounts
+        self.accounts: dict[str, list[ChainAccountWithAllData]] = {}  # Lowercase address -> accounts tracking it
+        self.queue: list[tuple[float, str]] = []  # (next check time, lowercase address), stale entries are skipped
+        self.next_checks: dict[str, float] = {}  # Lowercase address -> its current next check time
+        self.accounts_loaded_at: float | None = None
+        self.shards_generation: int | None = None  # Generation of the owned shards that the accounts were loaded for
+        self.store_loaded = False
+        self.store_saved_at = time.monotonic()
+
+    def push(self, address: str, next_check: float) -> None:
+        self.next_checks[address] = next_check
+        heapq.heappush(self.queue, (next_check, address))
+
+    def schedule(self, address: str, now: float) -> None:
+        threshold = max(account.health_factor_threshold for account in self.accounts[address])
+        record = self.store.get(address)
+        if record is None:
+            self.push(address, now)
+            return
+        # After a restart the interval counts from the last check of the previous run
+        self.push(address, max(now, record.checked_at + get_check_interval(record, threshold)))
+
+    def is_at_risk(self, address: str) -> bool:
+        record = self.store.get(address)
+        if record is None:
+            return True
+        threshold = max(account.health_factor_threshold for account in self.accounts[address])
+        return get_check_interval(record, threshold) <= AT_RISK_CHECK_INTERVAL
+
+    def needs_reload(self) -> bool:
+        return (
+            self.accounts_loaded_at is None
+            or time.monotonic() - self.accounts_loaded_at >= ACCOUNTS_RELOAD_PERIOD
+            or (self.connector.shards is not None and self.connector.shards.generation != self.shards_generation)
+        )
+
+    async def reload_accounts(self) -> None:
+        shards_generation = self.connector.shards.generation if self.connector.shards is not None else None
+        if not self.store_loaded or shards_generation != self.shards_generation:  # Load the rows of newly owned shards
+            if self.store_loaded:
+                await asyncio.to_thread(self.store.save)
+            await asyncio.to_thread(self.store.load)
+            self.store_loaded = True
+        self.shards_generation = shards_generation
+
+        accounts: dict[str, list[ChainAccountWithAllData]] = {}
+        for account in await self.connector.load_accounts_for_hf_check():
+            accounts.setdefault(account.account.address.lower(), []).append(account)
+        self.accounts = accounts
+        self.queue = []
+        self.next_checks = {}
+        now = time.time()
+        for address in accounts:
+            self.schedule(address, now)
+        self.accounts_loaded_at = time.monotonic()
+        logging.info('Scheduled %d addresses on %s x Aave V%d', len(accounts), self.connector.chain.name, self.connector.aave_version)
+
+    def pop_due_addresses(self, now: float) -> list[str]:
+        due = []
+        while len(self.queue) > 0 and self.queue[0][0] <= now:
+            next_check, address = heapq.heappop(self.queue)
+            if self.next_checks.get(address) == next_check:
+                due.append(address)
+        return due
+
+    async def check_due_accounts(self) -> None:
+        started_at = time.time()
+        due = self.pop_due_addresses(started_at)
+        if len(due) == 0:
+            return
+
+        accounts = [account for address in due for account in self.accounts[address]]
+        priority = Priority.AT_RISK if any(self.is_at_risk(address) for address in due) else Priority.SWEEP
+        try:
+            with SWEEP_SECONDS.time(chain=self.connector.chain.name, aave_version=self.connector.aave_version, kind='scheduled'), rpc_priority(priority), log_context(sweep_id=new_sweep_id()):
+                notified = await self.connector.check_accounts(accounts, self.store)
+        except Exception:
+            for address in due:
+                self.push(address, started_at + FAILED_CHECK_INTERVAL)
+            raise
+
+        for account in notified:  # In their notification cooldown until the next reload
+            address = account.account.address.lower()
+            self.accounts[address] = [other for other in self.accounts[address] if other != account]
+        checked_at = time.time()
+        for address in due:
+            record = self.store.get(address)
+            if len(self.accounts[address]) == 0:
+                del self.accounts[address]
+                del self.next_checks[address]
+            elif record is None or record.checked_at < started_at:  # The health factor couldn't be queried
+                self.push(address, checked_at + FAILED_CHECK_INTERVAL)
+            else:
+                self.schedule(address, checked_at)
+
+    def get_sleep_time(self) -> float:
+        if len(self.queue) == 0:
+            return MIN_CHECK_INTERVAL
+        return min(STORE_SAVE_PERIOD, max(MIN_CHECK_INTERVAL / 4, self.queue[0][0] - time.time()))
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.connector.connect()
+                if self.needs_reload():
+                    await self.reload_accounts()
+                await self.check_due_accounts()
+                if time.monotonic() - self.store_saved_at >= STORE_SAVE_PERIOD:
+                    await asyncio.to_thread(self.store.save)
+                    self.store_saved_at = time.monotonic()
+            except Exception:
+                await send_admin_message('Critical error!')
+                logging.error('Error while checking scheduled health factors on %s x Aave V%d: %s', self.connector.chain.name, self.connector.aave_version, traceback.format_exc())
+                await asyncio.sleep(ERROR_RETRY_PERIOD)
+
+            await asyncio.sleep(self.get_sleep_time())
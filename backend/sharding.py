@@ -0,0 +1,230 @@
+"""Sharded mode: every (chain, aave version) pool is split into address ranges and every range is a shard.
+Workers own shards through leases, so a shard is monitored by exactly one worker at a time.
+A shard is preferred by one worker (round robin), other workers take it over only while that worker is down.
+When the preferred worker is back, the lease is handed over to it directly and it polls for it, so the shard is not left unwatched.
+"""
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+import traceback
+from typing import NamedTuple, Protocol
+
+from postgrest.exceptions import APIError
+
+from backend.database import Database
+from backend.types import Chain
+
+SHARD_LEASE_PERIOD = 90  # seconds
+SHARD_LEASE_RENEW_PERIOD = 20  # seconds, several renewals fit in one lease period
+SHARD_HANDOVER_POLL_PERIOD = 2  # seconds between renewals while a preferred shard is held by another worker
+SHARD_LEASE_MARGIN = 10  # seconds, a worker stops acting on a shard this long before its lease expires
+ORPHAN_SHARD_GRACE_PERIOD = 60  # seconds after start before a worker takes shards preferred by other workers
+WORKER_RESTART_DELAY = 5  # seconds
+
+
+class Shard(NamedTuple):
+    chain: Chain
+    aave_version: int
+    address_range: int
+
+    def lease_key(self) -> str:
+        return f'SHARD_LEASE_{self.chain.value}_V{self.aave_version}_{self.address_range}'
+
+
+def worker_lease_key(worker_index: int) -> str:
+    return f'SHARD_WORKER_{worker_index}'
+
+
+def get_address_range(address: str, address_ranges: int) -> int:
+    """Addresses are uniformly distributed hashes, so their leading 32 bits split them into even ranges"""
+    return int(address[2:10], 16) * address_ranges >> 32
+
+
+def get_address_range_bounds(address_range: int, address_ranges: int) -> tuple[str, str | None]:
+    """Lowercase addresses of the range are at least the first bound and below the second one, None for the last range"""
+    def bound(address_range: int) -> str:
+        return f'0x{-(-address_range << 32) // address_ranges:08x}'
+    return bound(address_range), bound(address_range + 1) if address_range + 1 < address_ranges else None
+
+
+class LeaseStore(Protocol):
+    def try_acquire(self, key: str, owner: str, period: int) -> bool:
+        """Acquire or renew the lease. Fails if it is held by another owner."""
+
+    def release(self, key: str, owner: str, next_owner: str | None = None, period: int = 0) -> bool:
+        """Release the lease if it is held by owner, or hand it over to next_owner for period seconds. Fails if another owner holds it."""
+
+    def get_owner(self, key: str) -> str | None:
+        """Owner of the unexpired lease"""
+
+
+class SettingLeaseStore():
+    """Leases in the setting table. Acquiring and releasing are atomic through the acquire_setting_lease and
+    release_setting_lease functions from backend/sql.
+    """
+    def __init__(self, database: Database) -> None:
+        self.database = database
+
+    def try_acquire(self, key: str, owner: str, period: int) -> bool:
+        try:
+            response = self.database.supabase.rpc('acquire_setting_lease', {'p_key': key, 'p_owner': owner, 'p_lease_seconds': period}).execute()
+        except APIError:
+            logging.error('Could not acquire the lease %s. Is backend/sql/acquire_setting_lease.sql deployed? %s', key, traceback.format_exc())
+            return False
+        return response.data is True
+
+    def release(self, key: str, owner: str, next_owner: str | None = None, period: int = 0) -> bool:
+        params = {'p_key': key, 'p_owner': owner, 'p_next_owner': next_owner, 'p_lease_seconds': period}
+        try:
+            response = self.database.supabase.rpc('release_setting_lease', params).execute()
+        except APIError:
+            logging.error('Could not release the lease %s. Is backend/sql/release_setting_lease.sql deployed? %s', key, traceback.format_exc())
+            return False
+        return response.data is True
+
+    def get_owner(self, key: str) -> str | None:
+        value = self.database.get_setting(key)
+        if value is None:
+            return None
+        lease = json.loads(value)
+        return lease['owner'] if lease['expires_at'] > time.time() else None
+
+
+class LocalLeaseStore():
+    """Local stand-in for the setting table: leases of the workers of one host in a JSON file guarded by a file lock"""
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def update(self, key: str, owner: str, expires_at: float, only_if_available: bool, only_if_held_by: str | None = None) -> bool:
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            content = f.read()
+            leases = json.loads(content) if content else {}
+            lease = leases.get(key)
+            if only_if_available and lease is not None and lease['owner'] != owner and lease['expires_at'] > time.time():
+                return False
+            if only_if_held_by is not None and (lease is None or lease['owner'] != only_if_held_by):
+                return False
+            leases[key] = {'owner': owner, 'expires_at': expires_at}
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(leases))
+            return True
+
+    def try_acquire(self, key: str, owner: str, period: int) -> bool:
+        return self.update(key, owner, time.time() + period, only_if_available=True)
+
+    def release(self, key: str, owner: str, next_owner: str | None = None, period: int = 0) -> bool:
+        if next_owner is None:
+            return self.update(key, owner, 0, only_if_available=False, only_if_held_by=owner)
+        return self.update(key, next_owner, time.time() + period, only_if_available=False, only_if_held_by=owner)
+
+    def get_owner(self, key: str) -> str | None:
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            content = f.read()
+        lease = (json.loads(content) if content else {}).get(key)
+        return lease['owner'] if lease is not None and lease['expires_at'] > time.time() else None
+
+
+class ShardOwnership():
+    """Shards owned by this worker. Leases are renewed in the background and a shard is considered owned
+    only until shortly before its lease expires, so two workers never act on the same shard.
+    """
+    def __init__(self, store: LeaseStore, worker_index: int, workers_count: int, pools: list[tuple[Chain, int]], address_ranges: int) -> None:
+        self.store = store
+        self.worker_index = worker_index
+        self.workers_count = workers_count
+        self.address_ranges = address_ranges
+        self.owner = f'worker-{worker_index}-{os.getpid()}'
+        self.shards = [Shard(chain, aave_version, address_range) for chain, aave_version in pools for address_range in range(address_ranges)]
+        self.owned: dict[Shard, float] = {}  # Shard -> monotonic time until which this worker can act on it
+        self.generation = 0  # Incremented whenever the set of owned shards changes
+        self.awaiting_handover = False  # A preferred shard is held by another worker, which hands it over on its next renewal
+        self.started_at = time.monotonic()
+
+    def preferred_worker(self, shard: Shard) -> int:
+        return self.shards.index(shard) % self.workers_count
+
+    def owns(self, shard: Shard) -> bool:
+        return self.owned.get(shard, 0) > time.monotonic()
+
+    def owns_address(self, chain: Chain, aave_version: int, address: str) -> bool:
+        return self.owns(Shard(chain, aave_version, get_address_range(address, self.address_ranges)))
+
+    def get_owned_address_ranges(self, chain: Chain, aave_version: int) -> list[int]:
+        return [address_range for address_range in range(self.address_ranges) if self.owns(Shard(chain, aave_version, address_range))]
+
+    def owns_liquidations(self, chain: Chain, aave_version: int) -> bool:
+        """Liquidation logs of a pool are processed by the owner of its first address range"""
+        return self.owns(Shard(chain, aave_version, 0))
+
+    def get_worker_owner(self, worker_index: int) -> str | None:
+        """Lease owner of a worker that is alive, None if it is down"""
+        return self.store.get_owner(worker_lease_key(worker_index))
+
+    def set_owned(self, shard: Shard, acquired_at: float | None) -> None:
+        was_owned = self.owns(shard)
+        if acquired_at is None:
+            self.owned.pop(shard, None)
+        else:
+            self.owned[shard] = acquired_at + SHARD_LEASE_PERIOD - SHARD_LEASE_MARGIN
+        if was_owned != self.owns(shard):
+            self.generation += 1
+            logging.info('Worker %d %s the shard %s', self.worker_index, 'now owns' if self.owns(shard) else 'no longer owns', shard.lease_key())
+
+    def renew(self) -> None:
+        """Renew the owned leases, claim the preferred shards and take over the shards of workers that are down"""
+        self.store.try_acquire(worker_lease_key(self.worker_index), self.owner, SHARD_LEASE_PERIOD)
+        worker_owners: dict[int, str | None] = {}
+        awaiting_handover = False
+        for shard in self.shards:
+            preferred_worker = self.preferred_worker(shard)
+            acquired_at = time.monotonic()
+            if preferred_worker != self.worker_index:
+                if preferred_worker not in worker_owners:
+                    worker_owners[preferred_worker] = self.get_worker_owner(preferred_worker)
+                preferred_owner = worker_owners[preferred_worker]
+                if preferred_owner is not None:
+                    if shard in self.owned:  # Hand the lease over to the preferred worker, no other worker can take it in between
+                        self.store.release(shard.lease_key(), self.owner, preferred_owner, SHARD_LEASE_PERIOD)
+                        self.set_owned(shard, None)
+                    continue
+                if shard not in self.owned and time.monotonic() - self.started_at < ORPHAN_SHARD_GRACE_PERIOD:
+                    continue
+
+            acquired = self.store.try_acquire(shard.lease_key(), self.owner, SHARD_LEASE_PERIOD)
+            self.set_owned(shard, acquired_at if acquired else None)
+            awaiting_handover = awaiting_handover or (preferred_worker == self.worker_index and not acquired)
+        self.awaiting_handover = awaiting_handover
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.renew)
+            except Exception:
+                logging.error('Error while renewing shard leases of worker %d: %s', self.worker_index, traceback.format_exc())
+            await asyncio.sleep(SHARD_HANDOVER_POLL_PERIOD if self.awaiting_handover else SHARD_LEASE_RENEW_PERIOD)
+
+
+def run_workers(workers_count: int) -> None:
+    """Coordinator of one host: runs the workers as child processes and restarts the ones that exit"""
+    workers: dict[int, subprocess.Popen] = {}
+    while True:
+        for worker_index in range(workers_count):
+            worker = workers.get(worker_index)
+            if worker is not None and worker.poll() is None:
+                continue
+            if worker is not None:
+                logging.error('Worker %d exited with %d. Restarting it', worker_index, worker.returncode)
+            workers[worker_index] = subprocess.Popen([sys.executable, '-m', 'backend'], env={**os.environ, 'SHARD_WORKER_INDEX': str(worker_index)})
+            logging.info('Started worker %d of %d', worker_index, workers_count)
+        time.sleep(WORKER_RESTART_DELAY)
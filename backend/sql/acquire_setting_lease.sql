@@ -0,0 +1,22 @@
+-- Atomically acquires or renews the lease stored in the setting row p_key. Returns false if another owner holds an unexpired lease.
+-- Called by SettingLeaseStore in backend/sharding.py.
+create or replace function acquire_setting_lease(
+    p_key text,
+    p_owner text,
+    p_lease_seconds int
+) returns boolean
+language plpgsql
+as $$
+declare
+    acquired boolean;
+begin
+    insert into setting (key, value)
+    values (p_key, json_build_object('owner', p_owner, 'expires_at', extract(epoch from now()) + p_lease_seconds)::text)
+    on conflict (key) do update
+    set value = excluded.value
+    where setting.value::json->>'owner' = p_owner
+       or (setting.value::json->>'expires_at')::float < extract(epoch from now())
+    returning true into acquired;
+    return coalesce(acquired, false);
+end;
+$$;
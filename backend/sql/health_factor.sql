@@ -0,0 +1,11 @@
+-- Last seen health factor of every account of a pool, one row per address, read and written by HealthFactorStore
+-- in backend/scheduling.py through Database.get_health_factor_rows, upsert_health_factor_rows and delete_health_factor_rows.
+create table if not exists health_factor (
+    chain text not null,
+    aave_version int not null,
+    address text not null,
+    health_factor double precision not null,
+    checked_at double precision not null,
+    volatility double precision not null,
+    primary key (chain, aave_version, address)
+);
@@ -0,0 +1,25 @@
+-- Atomically releases the lease stored in the setting row p_key if p_owner still holds it, so a lease that another
+-- worker has just taken is never overwritten. With p_next_owner the lease is handed over to it for p_lease_seconds.
+-- Returns false if p_owner doesn't hold the lease. Called by SettingLeaseStore in backend/sharding.py.
+create or replace function release_setting_lease(
+    p_key text,
+    p_owner text,
+    p_next_owner text,
+    p_lease_seconds int
+) returns boolean
+language plpgsql
+as $$
+declare
+    released boolean;
+begin
+    update setting
+    set value = case
+        when p_next_owner is null then json_build_object('owner', p_owner, 'expires_at', 0)::text
+        else json_build_object('owner', p_next_owner, 'expires_at', extract(epoch from now()) + p_lease_seconds)::text
+    end
+    where key = p_key
+      and value::json->>'owner' = p_owner
+    returning true into released;
+    return coalesce(released, false);
+end;
+$$;
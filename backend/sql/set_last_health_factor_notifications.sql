@@ -0,0 +1,18 @@
+-- Sets last_health_factor_notification of many (address, user_id) accounts of one pool in a single statement.
+-- Called by Database.set_last_health_factor_notifications.
+create or replace function set_last_health_factor_notifications(
+    p_chain text,
+    p_aave_version int,
+    p_accounts jsonb,  -- [{"address": "0x...", "user_id": "..."}, ...]
+    p_notified_at timestamp
+) returns void
+language sql
+as $$
+    update account
+    set last_health_factor_notification = p_notified_at
+    from jsonb_to_recordset(p_accounts) as notified(address text, user_id text)
+    where account.chain::text = p_chain
+      and account.aave_version = p_aave_version
+      and account.address = notified.address
+      and account.user_id::text = notified.user_id;
+$$;
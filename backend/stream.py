@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import traceback
+from typing import TYPE_CHECKING, Any
+
+from aiohttp import ClientSession, ClientWebSocketResponse, WSMsgType
+from web3.types import LogReceipt
+
+from backend.admin import send_admin_message
+from backend.codec import decode_log
+
+if TYPE_CHECKING:
+    from backend.connector import AsyncChainConnector
+
+WS_HEARTBEAT = 30  # seconds between pings, a connection without a pong is considered dead
+MIN_RECONNECT_DELAY = 1  # seconds
+MAX_RECONNECT_DELAY = 60  # seconds, the delay doubles after every failed connection
+SHARD_CHECK_PERIOD = 30  # seconds, how often an idle stream checks that this worker still owns the liquidations
+
+
+class LiquidationStream():
+    """Receives liquidation logs of a pool as they are mined through an eth_subscribe logs subscription.
+    After every (re)connection the blocks missed while disconnected are gap-filled with catchup_on_liquidations,
+    so the last checked block setting is advanced by the stream as well. Logs delivered by both are processed once,
+    also across restarts, as the position of the last streamed log is saved too.
+    """
+    def __init__(self, connector: 'AsyncChainConnector', ws_rpc_url: str, subscription_message: dict) -> None:
+        self.connector = connector
+        self.ws_rpc_url = ws_rpc_url
+        self.subscription_message = subscription_message
+        self.reconnect_delay = MIN_RECONNECT_DELAY
+        self.last_checked_block: int | None = None
+
+    def owns_liquidations(self) -> bool:
+        shards = self.connector.shards
+        return shards is None or shards.owns_liquidations(self.connector.chain, self.connector.aave_version)
+
+    async def subscribe(self, ws: ClientWebSocketResponse) -> str:
+        await ws.send_json(self.subscription_message)
+        while True:
+            response = await ws.receive_json()
+            if response.get('id') != self.subscription_message['id']:
+                continue
+            if 'error' in response:
+                raise ValueError(response['error'])
+            return response['result']
+
+    async def process_log(self, raw_log: dict[str, Any]) -> None:
+        if raw_log.get('removed', False):
+            return  # Reorged out. A liquidation that is mined again is delivered again.
+        log: LogReceipt = decode_log(raw_log)
+        await self.connector.process_liquidation_log(log)
+
+        # The block of the log may have more logs, so it is not checked yet. The handled log is saved, so the gap-fill
+        # after a restart doesn't alert it again.
+        streamed_log = (log['blockNumber'], log['logIndex'])
+        if self.connector.last_streamed_log is None or streamed_log > self.connector.last_streamed_log:
+            await asyncio.to_thread(self.connector.database.set_setting, self.connector.last_streamed_log_setting_key(), f'{streamed_log[0]}:{streamed_log[1]}')
+            self.connector.last_streamed_log = streamed_log
+
+        # Logs are delivered in block order, so all the blocks before this one are done
+        checked_block = log['blockNumber'] - 1
+        if self.last_checked_block is None or checked_block > self.last_checked_block:
+            await asyncio.to_thread(self.connector.database.set_setting, self.connector.last_checked_block_setting_key(), str(checked_block))
+            self.last_checked_block = checked_block
+
+    async def stream(self, ws: ClientWebSocketResponse) -> None:
+        subscription = await self.subscribe(ws)
+        logging.info('Subscribed to liquidations on %s x Aave V%d', self.connector.chain.name, self.connector.aave_version)
+        # Logs mined during the gap-fill wait in the websocket buffer
+        self.last_checked_block = await self.connector.catchup_on_liquidations()
+        self.reconnect_delay = MIN_RECONNECT_DELAY
+
+        while True:
+            try:
+                message = await ws.receive(timeout=SHARD_CHECK_PERIOD)
+            except asyncio.TimeoutError:
+                message = None
+            if not self.owns_liquidations():
+                logging.info('Liquidations on %s x Aave V%d are owned by another worker now', self.connector.chain.name, self.connector.aave_version)
+                return
+            if message is None:
+                continue
+            if message.type in (WSMsgType.CLOSE, WSMsgType.CLOSING, WSMsgType.CLOSED, WSMsgType.ERROR):
+                raise ConnectionError(f'Websocket closed: {message.data!r}')
+
+            notification = message.json()
+            params = notification.get('params', {})
+            if notification.get('method') == 'eth_subscription' and params.get('subscription') == subscription:
+                await self.process_log(params['result'])
+
+    async def run(self) -> None:
+        while True:
+            if not self.owns_liquidations():
+                await asyncio.sleep(SHARD_CHECK_PERIOD)
+                continue
+
+            try:
+                await self.connector.connect()
+                async with ClientSession() as session:
+                    async with session.ws_connect(self.ws_rpc_url, heartbeat=WS_HEARTBEAT) as ws:
+                        await self.stream(ws)
+                continue
+            except Exception:
+                logging.error('Liquidations stream on %s x Aave V%d failed, reconnecting in %ss: %s', self.connector.chain.name, self.connector.aave_version, self.reconnect_delay, traceback.format_exc())
+                if self.reconnect_delay == MAX_RECONNECT_DELAY:
+                    await send_admin_message('Critical error!')
+
+            await asyncio.sleep(self.reconnect_delay)
+            self.reconnect_delay = min(MAX_RECONNECT_DELAY, self.reconnect_delay * 2)
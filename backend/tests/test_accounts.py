@@ -0,0 +1,106 @@
+import asyncio
+
+from backend.accounts import HealthFactorAccountsLoader
+from backend.benchmarks.fakes import FakeAccountDataBatcher, FakeAccountsDatabase, make_account
+from backend.connector import AsyncChainConnector
+from backend.sharding import LocalLeaseStore, ShardOwnership, worker_lease_key
+from backend.types import Chain, ChainAccountWithAllData
+
+
+class CooldownNotifier():
+    """Writes the notification cooldowns to the database like AsyncNotifier"""
+    def __init__(self, database: FakeAccountsDatabase) -> None:
+        self.database = database
+        self.notified: list[ChainAccountWithAllData] = []
+
+    async def notify_about_health_factors(self, notifications: list[tuple[ChainAccountWithAllData, str]]) -> None:
+        self.database.notified += [account for account, _ in notifications]
+        self.notified += [account for account, _ in notifications]
+
+
+def test_all_pools_are_loaded_with_one_query():
+    database = FakeAccountsDatabase([
+        make_account('0x' + '01' * 20, Chain.ETHEREUM, 2, 'user-id-1'),
+        make_account('0x' + '01' * 20, Chain.ETHEREUM, 3, 'user-id-1'),
+        make_account('0x' + '02' * 20, Chain.POLYGON, 3, 'user-id-2'),
+    ])
+    loader = HealthFactorAccountsLoader(database)  # type: ignore[arg-type]
+
+    async def run() -> list[list[ChainAccountWithAllData]]:
+        return list(await asyncio.gather(
+            loader.get(Chain.ETHEREUM, 2),
+            loader.get(Chain.ETHEREUM, 3),
+            loader.get(Chain.POLYGON, 3),
+            loader.get(Chain.BASE, 3),
+        ))
+
+    assert asyncio.run(run()) == [[database.accounts[0]], [database.accounts[1]], [database.accounts[2]], []]
+    assert database.queries_count == 1
+
+    loader.forget([database.accounts[0]])  # Notified
+    assert asyncio.run(loader.get(Chain.ETHEREUM, 2)) == []
+    assert asyncio.run(loader.get(Chain.ETHEREUM, 3)) == [database.accounts[1]]
+    assert database.queries_count == 1  # The next sweeps use the cached snapshot
+
+
+def test_address_tracked_by_several_users_is_queried_once():
+    connector = AsyncChainConnector(
+        chain=Chain.ETHEREUM,
+        http_rpc_url='https://it-is-mocked.anyway',
+        notifier=None,  # type: ignore[arg-type]
+        database=None,  # type: ignore[arg-type]
+        pool_address='0x87870Bca3F3fD6335C3F4ce8392D69350B4fA4E2',
+        aave_version=3,
+    )
+    connector.batcher = FakeAccountDataBatcher()  # type: ignore[assignment]
+    whale = '0x' + '00' * 19 + '02'
+    accounts = [make_account(whale, Chain.ETHEREUM, 3, f'user-id-{i}') for i in range(50)]
+    accounts.append(make_account('0x' + '00' * 19 + '01', Chain.ETHEREUM, 3, 'user-id-50'))
+    accounts.append(make_account(whale.upper().replace('0X', '0x'), Chain.ETHEREUM, 3, 'user-id-51'))
+
+    health_factors = asyncio.run(connector.get_health_factors(accounts))
+
+    assert health_factors == [2.0] * 50 + [1.0, 2.0]
+    assert len(connector.batcher.calls) == 2  # type: ignore[attr-defined]
+
+
+def test_account_notified_before_a_handoff_is_not_notified_again(tmp_path):
+    """Worker 1 loaded its snapshot before worker 0 notified the account, then takes over the shard of worker 0"""
+    database = FakeAccountsDatabase([make_account('0x' + '00' * 19 + '01', Chain.ETHEREUM, 3, 'user-id-1')])  # Health factor 1 is below 1.2
+    store = LocalLeaseStore(str(tmp_path / 'leases.json'))
+    connectors = []
+    for worker_index in range(2):
+        connector = AsyncChainConnector(
+            chain=Chain.ETHEREUM,
+            http_rpc_url='https://it-is-mocked.anyway',
+            notifier=CooldownNotifier(database),  # type: ignore[arg-type]
+            database=database,  # type: ignore[arg-type]
+            pool_address='0x87870Bca3F3fD6335C3F4ce8392D69350B4fA4E2',
+            aave_version=3,
+            accounts_loader=HealthFactorAccountsLoader(database),  # type: ignore[arg-type]
+            shards=ShardOwnership(store, worker_index=worker_index, workers_count=2, pools=[(Chain.ETHEREUM, 3)], address_ranges=1),
+        )
+        connector.batcher = FakeAccountDataBatcher()  # type: ignore[assignment]
+        connectors.append(connector)
+
+    async def sweep(connector: AsyncChainConnector) -> None:
+        await connector.check_health_factors()
+
+    for connector in connectors:
+        connector.shards.renew()  # type: ignore[union-attr]
+    for connector in reversed(connectors):
+        asyncio.run(sweep(connector))
+    assert [len(connector.notifier.notified) for connector in connectors] == [1, 0]  # type: ignore[attr-defined]
+
+    # Worker 0 is down, its leases expire and worker 1 takes over its shard
+    new_owner = connectors[1].shards
+    assert new_owner is not None
+    for key in [worker_lease_key(0), new_owner.shards[0].lease_key()]:
+        store.update(key, connectors[0].shards.owner, 0, only_if_available=False)  # type: ignore[union-attr]
+    new_owner.started_at -= 3600
+    new_owner.renew()
+    assert new_owner.owns(new_owner.shards[0])
+
+    asyncio.run(sweep(connectors[1]))
+
+    assert connectors[1].notifier.notified == []  # type: ignore[attr-defined]
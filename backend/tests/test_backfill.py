@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+from aiohttp import ClientResponseError, RequestInfo
+from yarl import URL
+
+from backend.backfill import LogBackfiller
+
+
+class FakeEth():
+    """Returns one log per block and refuses ranges wider than max_range like public RPCs do. Raises `error` if it is set."""
+    def __init__(self, max_range: int, error: Exception | None = None) -> None:
+        self.max_range = max_range
+        self.error = error
+        self.calls = 0
+
+    async def get_logs(self, filter_params: dict) -> list[dict]:
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        from_block, to_block = filter_params['fromBlock'], filter_params['toBlock']
+        if to_block - from_block + 1 > self.max_range:
+            raise ValueError({'code': -32005, 'message': 'block range is too wide'})
+        return [{'blockNumber': block} for block in range(from_block, to_block + 1)]
+
+
+class FakeWeb3():
+    def __init__(self, max_range: int, error: Exception | None = None) -> None:
+        self.eth = FakeEth(max_range, error)
+
+
+def test_backfill_adapts_range_and_checkpoints():
+    """All logs are processed once and in order, every window is checkpointed, and the range shrinks to what the provider allows"""
+    backfiller = LogBackfiller(FakeWeb3(max_range=60), 'https://it-is-mocked.anyway', block_range=100)  # type: ignore[arg-type]
+    processed_blocks = []
+    checkpoints = []
+
+    async def process_logs(logs):
+        processed_blocks.extend(log['blockNumber'] for log in logs)
+
+    async def checkpoint(block):
+        checkpoints.append(block)
+
+    logs_count = asyncio.run(backfiller.backfill({'address': '0xpool'}, 1001, 2000, process_logs, checkpoint))
+
+    assert logs_count == 1000
+    assert processed_blocks == list(range(1001, 2001))
+    assert checkpoints == sorted(checkpoints) and checkpoints[-1] == 2000
+    assert backfiller.block_range <= 60
+
+
+@pytest.mark.parametrize('error, calls', [
+    (ValueError({'code': -32000, 'message': 'header not found'}), 1),
+    (ValueError({'code': -32005, 'message': 'daily request count exceeded, request rate limited'}), 1),
+    (ClientResponseError(RequestInfo(URL('https://it-is-mocked.anyway'), 'POST', {}), (), status=503), 1),  # type: ignore[arg-type]
+    (asyncio.TimeoutError(), 3),  # Split once
+])
+def test_errors_other_than_refused_ranges_are_raised(error, calls):
+    web3 = FakeWeb3(max_range=1000, error=error)
+    backfiller = LogBackfiller(web3, 'https://it-is-mocked.anyway', block_range=100)  # type: ignore[arg-type]
+
+    async def ignore(_) -> None:
+        pass
+
+    with pytest.raises(type(error)):
+        asyncio.run(backfiller.backfill({'address': '0xpool'}, 1001, 1100, ignore, ignore))
+    assert web3.eth.calls == calls
@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+from aiohttp import ClientResponseError
+
+from backend.batching import MIN_BATCH_SIZE, MulticallBatcher
+
+
+class FakeAggregate3():
+    def __init__(self, contract: 'FakeMulticallContract', calls: list) -> None:
+        self.contract = contract
+        self.calls = calls
+
+    async def call(self):
+        self.contract.batch_sizes.append(len(self.calls))
+        if self.contract.error is not None:
+            raise self.contract.error
+        if len(self.calls) > self.contract.max_calls:
+            raise ValueError({'code': -32000, 'message': 'out of gas'})
+        return [(data != b'bad', data) for _, _, data in self.calls]
+
+
+class FakeMulticallContract():
+    """Runs out of gas on batches bigger than max_calls and fails calls with b'bad' calldata. Raises error on every batch if it is set."""
+    def __init__(self, max_calls: int, error: Exception | None = None) -> None:
+        self.max_calls = max_calls
+        self.error = error
+        self.batch_sizes: list[int] = []
+        self.functions = self
+
+    def aggregate3(self, calls: list) -> FakeAggregate3:
+        return FakeAggregate3(self, calls)
+
+
+def test_batches_are_split_and_failures_isolated():
+    """A batch of 40 doesn't fit in gas so it is split into batches of 10 and the failed call doesn't affect the others"""
+    contract = FakeMulticallContract(max_calls=10)
+    batcher = MulticallBatcher(contract, 'https://it-is-mocked.anyway', batch_size=40)  # type: ignore[arg-type]
+    calls = [('0xpool', i.to_bytes(2, 'big')) for i in range(40)]
+    calls[7] = ('0xpool', b'bad')
+
+    results = asyncio.run(batcher.aggregate(calls))
+
+    assert results == [None if i == 7 else i.to_bytes(2, 'big') for i in range(40)]
+    assert contract.batch_sizes.count(10) == 4
+    assert batcher.batch_size < 20  # Shrunk to 10, then slowly grows back after successful batches
+
+
+def test_batch_size_grows_back_after_successes():
+    contract = FakeMulticallContract(max_calls=1000)
+    batcher = MulticallBatcher(contract, 'https://it-is-mocked.anyway', batch_size=MIN_BATCH_SIZE)  # type: ignore[arg-type]
+    calls = [('0xpool', i.to_bytes(2, 'big')) for i in range(100)]
+
+    async def run() -> None:
+        for _ in range(5):
+            await batcher.aggregate(calls)
+
+    asyncio.run(run())
+
+    assert batcher.batch_size > 2 * MIN_BATCH_SIZE
+
+
+def test_node_outage_is_raised_without_splitting():
+    """A node that answers every call with 503 fails the sweep, so monitor_health_factor sends the admin alert"""
+    contract = FakeMulticallContract(max_calls=1000, error=ClientResponseError(None, (), status=503))  # type: ignore[arg-type]
+    batcher = MulticallBatcher(contract, 'https://it-is-mocked.anyway', batch_size=100)  # type: ignore[arg-type]
+    calls = [('0xpool', i.to_bytes(2, 'big')) for i in range(300)]
+
+    with pytest.raises(ClientResponseError):
+        asyncio.run(batcher.aggregate(calls))
+
+    assert contract.batch_sizes == [100, 100, 100]
+    assert batcher.batch_size == 100
+
+
+def test_timed_out_batch_is_split_once():
+    contract = FakeMulticallContract(max_calls=1000, error=asyncio.TimeoutError())
+    batcher = MulticallBatcher(contract, 'https://it-is-mocked.anyway', batch_size=40)  # type: ignore[arg-type]
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(batcher.aggregate([('0xpool', i.to_bytes(2, 'big')) for i in range(40)]))
+
+    assert contract.batch_sizes == [40, 20, 20]
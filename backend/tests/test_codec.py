@@ -0,0 +1,23 @@
+import json
+
+from eth_abi import decode
+from web3 import Web3
+
+from backend.codec import MAX_UINT256, decode_user_account_data_bulk, encode_get_user_account_data, encode_get_user_configuration
+
+
+def test_codec_matches_web3():
+    """Local encoding must be the same as web3's for both pool versions, and all six fields must be decoded"""
+    address = '0x28fe46db880072E129816EE2BCE5BC5a9712A058'
+    for aave_version in (2, 3):
+        with open(f'./backend/abi/v{aave_version}_pool.json') as f:
+            pool_contract = Web3().eth.contract(abi=json.loads(f.read()))
+        assert encode_get_user_account_data(address).hex() == pool_contract.encodeABI(fn_name='getUserAccountData', args=[address])[2:]
+        assert encode_get_user_configuration(address).hex() == pool_contract.encodeABI(fn_name='getUserConfiguration', args=[address])[2:]
+
+    result = b''.join(value.to_bytes(32, 'big') for value in (10 ** 20, 5 * 10 ** 19, 0, 8250, 8000, MAX_UINT256))
+    account_data, failed, malformed = decode_user_account_data_bulk([result, None, result[:32]])
+    assert account_data is not None
+    assert tuple(account_data) == decode(['uint256'] * 6, result)
+    assert account_data.health_factor_float() == -1
+    assert failed is None and malformed is None
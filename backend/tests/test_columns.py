@@ -0,0 +1,72 @@
+import asyncio
+
+import numpy as np
+
+from backend.accounts import HealthFactorAccountsLoader
+from backend.benchmarks.fakes import FakeAccountDataBatcher, FakeAccountsDatabase, make_account
+from backend.codec import MAX_UINT256, WORD_SIZE
+from backend.columns import AccountTable, decode_health_factors, format_addresses, parse_addresses
+from backend.connector import AsyncChainConnector
+from backend.types import Chain, ChainAccountWithAllData
+
+ADDRESSES = ['0x87870Bca3F3fD6335C3F4ce8392D69350B4fA4E2', '0x' + 'ab' * 20, '0x' + 'AB' * 20, '0x' + '00' * 19 + '03']
+
+
+class FakeNotifier():
+    def __init__(self) -> None:
+        self.notified: list[ChainAccountWithAllData] = []
+
+    async def notify_about_health_factors(self, notifications: list[tuple[ChainAccountWithAllData, str]]) -> None:
+        self.notified += [account for account, _ in notifications]
+
+
+def test_addresses_are_restored_exactly():
+    addresses, case_masks = parse_addresses(ADDRESSES)
+    assert addresses.dtype.itemsize == 20
+    assert addresses[1] == addresses[2]  # Same account whatever the case
+    assert format_addresses(addresses, case_masks) == ADDRESSES
+
+    table = AccountTable(Chain.ETHEREUM, 3)
+    accounts = [make_account(address, Chain.ETHEREUM, 3, f'user-id-{i % 2}') for i, address in enumerate(ADDRESSES + ['0x01'])]
+    table.append(accounts[:2])
+    table.append(accounts[2:])
+    table.pack()
+    assert table.to_accounts(np.arange(len(table))) == accounts[:-1]  # The invalid address is skipped
+    assert len(table.user_ids) == 2
+
+
+def test_health_factors_are_decoded_in_bulk():
+    results = [
+        bytes(5 * WORD_SIZE) + (15 * 10 ** 17).to_bytes(WORD_SIZE, 'big'),
+        bytes(5 * WORD_SIZE) + MAX_UINT256.to_bytes(WORD_SIZE, 'big'),
+        None,
+        b'\x00',
+    ]
+    health_factors = decode_health_factors(results)
+    assert health_factors[:2].tolist() == [1.5, -1]
+    assert np.isnan(health_factors[2:]).all()
+
+
+def test_sweep_notifies_rows_below_threshold_once():
+    # FakeAccountDataBatcher returns the last byte of the address as the health factor, thresholds are 1.2
+    database = FakeAccountsDatabase([make_account('0x' + '00' * 19 + last_byte, Chain.ETHEREUM, 3, f'user-id-{i}') for i, last_byte in enumerate(['01', '01', '02', '03'])])
+    loader = HealthFactorAccountsLoader(database)  # type: ignore[arg-type]
+    notifier = FakeNotifier()
+    connector = AsyncChainConnector(
+        chain=Chain.ETHEREUM,
+        http_rpc_url='https://it-is-mocked.anyway',
+        notifier=notifier,  # type: ignore[arg-type]
+        database=None,  # type: ignore[arg-type]
+        pool_address='0x87870Bca3F3fD6335C3F4ce8392D69350B4fA4E2',
+        aave_version=3,
+        accounts_loader=loader,
+    )
+    connector.batcher = FakeAccountDataBatcher()  # type: ignore[assignment]
+
+    asyncio.run(connector.check_health_factors())
+    assert notifier.notified == database.accounts[:2]  # Health factor 1 is below the threshold, 2 is not
+    assert len(connector.batcher.calls) == 3  # type: ignore[attr-defined]
+
+    asyncio.run(connector.check_health_factors())
+    assert notifier.notified == database.accounts[:2]  # In their notification cooldown
+    assert asyncio.run(loader.get(Chain.ETHEREUM, 3)) == database.accounts[2:]
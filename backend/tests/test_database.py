@@ -0,0 +1,157 @@
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from postgrest.exceptions import APIError
+
+from backend.database import Database
+from backend.types import Chain, ChainAccount, ChainAccountWithAllData
+
+
+class FakeAccountsQuery():
+    """Supports the subset of the PostgREST query builder used to page through the account table"""
+    def __init__(self, rows: list[dict], max_rows: int | None = None) -> None:
+        self.rows = rows
+        self.max_rows = max_rows  # Like the max rows setting of PostgREST, results are cut without an error
+        self.order_column: str | None = None
+        self.limit_size: int | None = None
+
+    def select(self, columns: str) -> 'FakeAccountsQuery':
+        return self
+
+    def eq(self, column: str, value) -> 'FakeAccountsQuery':
+        return FakeAccountsQuery([row for row in self.rows if row[column] == value], self.max_rows)
+
+    def gt(self, column: str, value) -> 'FakeAccountsQuery':
+        return FakeAccountsQuery([row for row in self.rows if row[column] > value], self.max_rows)
+
+    def lt(self, column: str, value) -> 'FakeAccountsQuery':
+        return FakeAccountsQuery([row for row in self.rows if row[column] < value], self.max_rows)
+
+    def order(self, column: str) -> 'FakeAccountsQuery':
+        self.order_column = column
+        return self
+
+    def limit(self, size: int) -> 'FakeAccountsQuery':
+        self.limit_size = size
+        return self
+
+    def execute(self) -> SimpleNamespace:
+        rows = sorted(self.rows, key=lambda row: row[self.order_column]) if self.order_column else self.rows
+        limits = [limit for limit in (self.limit_size, self.max_rows) if limit is not None]
+        return SimpleNamespace(data=rows[:min(limits)] if len(limits) > 0 else rows)
+
+
+def test_accounts_are_paged_without_losing_rows():
+    """Pages of 3 rows, the whale address 0x02 is tracked by 4 users on 2 chains and spans several pages.
+    The recently notified account is filtered out by the query.
+    """
+    rows = []
+    for address, user_ids in (('0x01', ['u1']), ('0x02', ['u1', 'u2', 'u3', 'u4']), ('0x03', ['u2', 'u5'])):
+        for user_id in user_ids:
+            for chain in ('ETHEREUM', 'POLYGON') if address == '0x02' else ('ETHEREUM',):
+                rows.append({
+                    'address': address,
+                    'chain': chain,
+                    'aave_version': 3,
+                    'user': {'health_factor_threshold': 1.2, 'onesignal_id': None},
+                    'user_id': user_id,
+                    'last_health_factor_notification': '2023-01-01T00:00:00',
+                })
+
+    recently_notified = {**rows[0], 'user_id': 'u9', 'last_health_factor_notification': datetime.utcnow().isoformat()}
+
+    with patch('backend.database.create_client', new=lambda x, y: SimpleNamespace(table=lambda name: FakeAccountsQuery(rows + [recently_notified]))):
+        database = Database(supabase_url='https://it-is-mocked.anyway', supabase_key='key')
+    with patch('backend.database.ACCOUNTS_PAGE_SIZE', new=3):
+        pages = list(database.iter_accounts_for_hf_check())
+
+    loaded = sorted((account.account.address, account.account.chain.value, account.user_id) for page in pages for account in page)
+    assert loaded == sorted((row['address'], row['chain'], row['user_id']) for row in rows)
+    for page in pages:  # Rows of one address are never split between pages
+        assert sum(1 for other in pages if {a.account.address for a in other} & {a.account.address for a in page}) == 1
+
+
+def test_tracked_accounts_are_paged():
+    """More rows than the PostgREST row limit of 4, with pages of 3 rows"""
+    rows = [
+        {'address': f'0x{i:02x}', 'chain': 'ETHEREUM', 'aave_version': 3, 'user_id': user_id}
+        for i in range(7) for user_id in (['u1', 'u2'] if i % 3 == 0 else ['u1'])
+    ]
+
+    with patch('backend.database.create_client', new=lambda x, y: SimpleNamespace(table=lambda name: FakeAccountsQuery(rows, max_rows=4))):
+        database = Database(supabase_url='https://it-is-mocked.anyway', supabase_key='key')
+    with patch('backend.database.ACCOUNTS_PAGE_SIZE', new=3):
+        accounts = database.get_tracked_accounts()
+
+    assert len(accounts) == len(rows)
+    assert {account.address for account in accounts} == {f'0x{i:02x}' for i in range(7)}
+
+
+class FakeNotificationsClient():
+    """Records set_last_health_factor_notifications calls and per account updates. The function fails if it is not deployed."""
+    def __init__(self, function_deployed: bool) -> None:
+        self.function_deployed = function_deployed
+        self.rpc_calls: list[dict] = []
+        self.updates: list[tuple[dict, dict]] = []  # (values, filters)
+
+    def rpc(self, name: str, params: dict) -> SimpleNamespace:
+        def execute() -> None:
+            if not self.function_deployed:
+                raise APIError({'message': f'Could not find the function {name}', 'code': 'PGRST202'})
+            self.rpc_calls.append(params)
+        return SimpleNamespace(execute=execute)
+
+    def table(self, name: str) -> 'FakeNotificationsClient':
+        return self
+
+    def update(self, values: dict) -> SimpleNamespace:
+        filters: dict = {}
+
+        def eq(column: str, value) -> SimpleNamespace:
+            filters[column] = value
+            return query
+
+        query = SimpleNamespace(eq=eq, execute=lambda: self.updates.append((values, filters)))
+        return query
+
+
+def make_notified_accounts() -> list[ChainAccountWithAllData]:
+    return [
+        ChainAccountWithAllData(ChainAccount(f'0x0{i}', chain, 3), health_factor_threshold=1.2, user_id=f'u{i}', onesignal_id=None)
+        for i, chain in enumerate([Chain.ETHEREUM, Chain.ETHEREUM, Chain.ETHEREUM, Chain.POLYGON])
+    ]
+
+
+def test_notification_timestamps_are_set_in_bulk_per_pool():
+    client = FakeNotificationsClient(function_deployed=True)
+    with patch('backend.database.create_client', new=lambda x, y: client):
+        database = Database(supabase_url='https://it-is-mocked.anyway', supabase_key='key')
+    timestamp = datetime(2024, 1, 1)
+    with patch('backend.database.NOTIFICATION_TIMESTAMPS_BATCH_SIZE', new=2):
+        database.set_last_health_factor_notifications(make_notified_accounts(), timestamp)
+
+    assert [(call['p_chain'], [account['user_id'] for account in call['p_accounts']]) for call in client.rpc_calls] == [
+        ('ETHEREUM', ['u0', 'u1']),
+        ('ETHEREUM', ['u2']),
+        ('POLYGON', ['u3']),
+    ]
+    assert all(call['p_notified_at'] == timestamp.isoformat() and call['p_aave_version'] == 3 for call in client.rpc_calls)
+    assert client.updates == []
+
+
+def test_notification_timestamps_fall_back_to_per_account_updates():
+    client = FakeNotificationsClient(function_deployed=False)
+    with patch('backend.database.create_client', new=lambda x, y: client):
+        database = Database(supabase_url='https://it-is-mocked.anyway', supabase_key='key')
+    timestamp = datetime(2024, 1, 1)
+    database.set_last_health_factor_notifications(make_notified_accounts(), timestamp)
+
+    assert client.rpc_calls == []
+    assert [(filters['address'], filters['chain'], filters['user_id']) for _, filters in client.updates] == [
+        ('0x00', 'ETHEREUM', 'u0'),
+        ('0x01', 'ETHEREUM', 'u1'),
+        ('0x02', 'ETHEREUM', 'u2'),
+        ('0x03', 'POLYGON', 'u3'),
+    ]
+    assert all(values == {'last_health_factor_notification': timestamp.isoformat()} for values, _ in client.updates)
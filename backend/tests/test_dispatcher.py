@@ -0,0 +1,62 @@
+import asyncio
+import time
+from email.utils import formatdate
+
+from backend.benchmarks.fakes import FakeOneSignal
+from backend.dispatcher import NotificationDispatcher, parse_retry_after
+
+
+def test_notifications_are_grouped_and_retried():
+    """Notifications with the same text are sent in one call and rate limited requests are retried"""
+    async def run() -> FakeOneSignal:
+        async with FakeOneSignal(failures=2) as onesignal:
+            dispatcher = NotificationDispatcher(app_id='app-id', app_key='app-key', api_url=onesignal.url, retry_base_delay=0.01)
+            for player_id in ('onesignal-id-1', 'onesignal-id-2', 'onesignal-id-1'):
+                await dispatcher.submit([player_id], 'Liquidation occured!', 'Your account was liquidated.')
+            await dispatcher.submit(['onesignal-id-3'], 'Low health factor!', 'Health factor is low.')
+            await dispatcher.close()
+        return onesignal
+
+    onesignal = asyncio.run(run())
+
+    assert sorted(onesignal.notifications) == [
+        (['onesignal-id-1', 'onesignal-id-2'], 'Liquidation occured!', 'Your account was liquidated.'),
+        (['onesignal-id-3'], 'Low health factor!', 'Health factor is low.'),
+    ]
+    assert onesignal.requests_count == 4
+    assert set(onesignal.authorizations) == {'Bearer app-key'}
+
+
+def test_retry_after_is_seconds_or_an_http_date():
+    assert parse_retry_after('120') == 120
+    assert 290 < parse_retry_after(formatdate(time.time() + 300, usegmt=True)) <= 300  # type: ignore[operator]
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+    assert parse_retry_after('soon') is None
+    assert parse_retry_after(None) is None
+
+
+def test_http_date_retry_after_is_retried():
+    async def run() -> FakeOneSignal:
+        async with FakeOneSignal(failures=1, failure_status=503, retry_after='Wed, 21 Oct 2015 07:28:00 GMT') as onesignal:
+            dispatcher = NotificationDispatcher(app_id='app-id', app_key='app-key', api_url=onesignal.url, retry_base_delay=0.01)
+            await dispatcher.submit(['onesignal-id-1'], 'Low health factor!', 'Health factor is low.')
+            await dispatcher.close()
+        return onesignal
+
+    onesignal = asyncio.run(run())
+
+    assert onesignal.requests_count == 2
+    assert onesignal.notifications == [(['onesignal-id-1'], 'Low health factor!', 'Health factor is low.')]
+
+
+def test_delivery_is_reported_to_the_submitter():
+    async def run() -> list[bool]:
+        async with FakeOneSignal(failures=1, failure_status=400) as onesignal:
+            dispatcher = NotificationDispatcher(app_id='app-id', app_key='app-key', api_url=onesignal.url, retry_base_delay=0.01)
+            rejected = await dispatcher.submit(['onesignal-id-1'], 'Low health factor!', 'Health factor is 1.1.')
+            await dispatcher.join()
+            sent = await dispatcher.submit(['onesignal-id-2'], 'Low health factor!', 'Health factor is 1.2.')
+            await dispatcher.close()
+        return [await rejected, await sent]
+
+    assert asyncio.run(run()) == [False, True]
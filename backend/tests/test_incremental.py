@@ -0,0 +1,174 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+from hexbytes import HexBytes
+
+from backend.accounts import HealthFactorAccountsLoader
+from backend.benchmarks.fakes import FakeAccountDataBatcher, FakeAccountsDatabase, FakeChain, make_pool_event_log
+from backend.connector import AsyncChainConnector
+from backend.incremental import ANSWER_UPDATED_TOPIC, HealthFactorWatcher
+from backend.rpc import close_sessions
+from backend.types import Chain, ChainAccount, ChainAccountWithAllData
+
+V2_POOL_ADDRESS = '0x7d2768dE32b0b80b7a3454c06BdAc94A69DDc7A9'
+V3_POOL_ADDRESS = '0x87870Bca3F3fD6335C3F4ce8392D69350B4fA4E2'
+RESERVES = ['0x' + '0a' * 20, '0x' + '0b' * 20]
+USERS = ['0x' + '01' * 20, '0x' + '02' * 20, '0x' + '03' * 20]
+AGGREGATOR = '0x' + 'cc' * 20
+
+
+def make_event_log(aave_version: int, event_name: str, block_number: int, args: dict) -> dict:
+    return make_pool_event_log(V2_POOL_ADDRESS if aave_version == 2 else V3_POOL_ADDRESS, aave_version, event_name, block_number, args)
+
+
+def to_log_receipt(raw_log: dict) -> dict:
+    return {
+        **raw_log,
+        'topics': [HexBytes(topic) for topic in raw_log['topics']],
+        'data': HexBytes(raw_log['data']),
+        'blockNumber': int(raw_log['blockNumber'], 16),
+        'blockHash': HexBytes(raw_log['blockHash']),
+        'transactionHash': HexBytes(raw_log['transactionHash']),
+        'transactionIndex': 0,
+        'logIndex': 0,
+    }
+
+
+def make_account(address: str, aave_version: int = 3) -> ChainAccountWithAllData:
+    return ChainAccountWithAllData(ChainAccount(address, Chain.ETHEREUM, aave_version), health_factor_threshold=1.2, user_id=f'user-id-{address[-2:]}', onesignal_id=None)
+
+
+def make_connector(url: str, aave_version: int = 3, notifier: 'FakeNotifier | None' = None) -> AsyncChainConnector:
+    return AsyncChainConnector(
+        chain=Chain.ETHEREUM,
+        http_rpc_url=url,
+        notifier=notifier,  # type: ignore[arg-type]
+        database=None,  # type: ignore[arg-type]
+        pool_address=V2_POOL_ADDRESS if aave_version == 2 else V3_POOL_ADDRESS,
+        aave_version=aave_version,
+    )
+
+
+class FakeNotifier():
+    def __init__(self) -> None:
+        self.notified: list[str] = []
+
+    async def notify_about_health_factors(self, notifications: list[tuple[ChainAccountWithAllData, str]]) -> None:
+        self.notified += [account.account.address for account, _ in notifications]
+
+
+@pytest.mark.parametrize('aave_version, event_name', [(2, 'Deposit'), (2, 'Borrow'), (3, 'Supply'), (3, 'Borrow')])
+def test_position_events_are_decoded_to_user_and_on_behalf_of(aave_version, event_name):
+    watcher = HealthFactorWatcher(make_connector('https://it-is-mocked.anyway', aave_version))
+    args = {
+        'reserve': RESERVES[0], 'user': USERS[0], 'onBehalfOf': USERS[1], 'amount': 10 ** 18, 'referral': 0, 'referralCode': 0,
+        'borrowRateMode': 2, 'interestRateMode': 2, 'borrowRate': 0,
+    }
+
+    position_changed, price_changed = watcher.get_changed_addresses([to_log_receipt(make_event_log(aave_version, event_name, 100, args))], [])  # type: ignore[list-item]
+
+    assert {USERS[0], USERS[1]} <= position_changed
+    assert USERS[2] not in position_changed
+    assert price_changed == set()
+
+
+def test_price_updates_select_accounts_using_the_reserve():
+    watcher = HealthFactorWatcher(make_connector('https://it-is-mocked.anyway'))
+    watcher.accounts = [make_account(user) for user in USERS]
+    watcher.price_sources = {AGGREGATOR: {1}}
+    watcher.user_configurations = {USERS[0]: 0b1000, USERS[1]: 0b0010}  # USERS[0] uses reserve 1, USERS[1] only reserve 0, USERS[2] is unknown
+    price_log = {'address': AGGREGATOR, 'topics': [HexBytes(ANSWER_UPDATED_TOPIC)]}
+
+    position_changed, price_changed = watcher.get_changed_addresses([], [price_log])  # type: ignore[list-item]
+
+    assert position_changed == set()
+    assert price_changed == {USERS[0], USERS[2]}
+
+
+async def start_chain(chain: FakeChain) -> tuple[web.AppRunner, str]:
+    runner = web.AppRunner(chain.make_app())
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 0).start()
+    return runner, f'http://127.0.0.1:{runner.addresses[0][1]}/'
+
+
+def supply(block_number: int, user: str) -> dict:
+    return make_event_log(3, 'Supply', block_number, {'reserve': RESERVES[0], 'user': user, 'onBehalfOf': user, 'amount': 10 ** 18, 'referralCode': 0})
+
+
+def test_new_blocks_are_checked_once_and_notified_accounts_are_skipped():
+    """USERS[0] is below its threshold and notified after its first event, its second event doesn't notify it again
+    during its cooldown. USERS[2] emits an event but is not tracked.
+    """
+    chain = FakeChain(V3_POOL_ADDRESS, {USERS[0]: 1.1, USERS[1]: 2.0}, RESERVES, [supply(105, USERS[0]), supply(106, USERS[2]), supply(115, USERS[0]), supply(116, USERS[1])], head_block=200)
+
+    async def run() -> tuple[list[str], list[int], int, int]:
+        runner, url = await start_chain(chain)
+        notifier = FakeNotifier()
+        watcher = HealthFactorWatcher(make_connector(url, notifier=notifier))
+        watcher.accounts = [make_account(USERS[0]), make_account(USERS[1])]
+        watcher.last_checked_block = 100
+
+        checked_accounts = []
+        await watcher.check_new_blocks(110)
+        checked_accounts.append(chain.calls['aggregate3 inner calls'])
+        await watcher.check_new_blocks(110)  # No new blocks
+        checked_accounts.append(chain.calls['aggregate3 inner calls'])
+        get_logs_calls = chain.calls['eth_getLogs']
+        await watcher.check_new_blocks(120)
+        await close_sessions()
+        await runner.cleanup()
+        return notifier.notified, checked_accounts, get_logs_calls, watcher.last_checked_block
+
+    notified, checked_accounts, get_logs_calls, last_checked_block = asyncio.run(run())
+
+    assert notified == [USERS[0]]
+    assert checked_accounts[0] == checked_accounts[1]  # The same range is not checked twice
+    assert get_logs_calls == 1
+    assert chain.calls['aggregate3 inner calls'] == checked_accounts[0] + 2  # Configuration and health factor of USERS[1] only
+    assert last_checked_block == 120
+
+
+def test_failed_range_is_retried():
+    chain = FakeChain(V3_POOL_ADDRESS, {USERS[0]: 1.1}, RESERVES, [supply(105, USERS[0])], head_block=200, failure_rate=1)
+
+    async def run() -> tuple[list[str], int]:
+        runner, url = await start_chain(chain)
+        notifier = FakeNotifier()
+        watcher = HealthFactorWatcher(make_connector(url, notifier=notifier))
+        watcher.accounts = [make_account(USERS[0])]
+        watcher.last_checked_block = 100
+        with pytest.raises(Exception):
+            await watcher.check_new_blocks(110)
+        assert watcher.last_checked_block == 100
+
+        chain.failure_rate = 0
+        await watcher.check_new_blocks(110)
+        await close_sessions()
+        await runner.cleanup()
+        return notifier.notified, watcher.last_checked_block
+
+    notified, last_checked_block = asyncio.run(run())
+
+    assert notified == [USERS[0]]
+    assert last_checked_block == 110
+
+
+def test_full_sweep_checks_the_account_table(monkeypatch):
+    """Health factor 1 of the first account is below its threshold, it is notified and not watched until the next full sweep"""
+    database = FakeAccountsDatabase([make_account('0x' + '00' * 19 + '01'), make_account('0x' + '00' * 19 + '02')])
+    notifier = FakeNotifier()
+    connector = make_connector('https://it-is-mocked.anyway', notifier=notifier)
+    connector.accounts_loader = HealthFactorAccountsLoader(database)  # type: ignore[arg-type]
+    connector.batcher = FakeAccountDataBatcher()  # type: ignore[assignment]
+
+    async def check_accounts(accounts: list[ChainAccountWithAllData]) -> list[ChainAccountWithAllData]:
+        raise AssertionError('The full sweep must not turn every row into an account to check it')
+
+    monkeypatch.setattr(connector, 'check_accounts', check_accounts)
+    watcher = HealthFactorWatcher(connector)
+    asyncio.run(watcher.sweep_accounts())
+
+    assert notifier.notified == [database.accounts[0].account.address]
+    assert watcher.accounts == [database.accounts[1]]
@@ -1,12 +1,16 @@
+import asyncio
 from unittest.mock import patch
 
 import freezegun
+from web3.contract.async_contract import AsyncContractFunction
 from web3.contract.contract import ContractFunction
 from web3.types import HexBytes
 
-from backend.connector import ChainConnector
+from backend.benchmarks.fakes import FakeOneSignal
+from backend.connector import AsyncChainConnector, ChainConnector
 from backend.database import Database
-from backend.notifier import Notifier
+from backend.dispatcher import NotificationDispatcher
+from backend.notifier import AsyncNotifier, Notifier
 from backend.types import Chain
 
 
@@ -176,3 +180,77 @@ def test_liquidation():
        (['onesignal-id-1'], 'Liquidation occured!', 'Your account 0x612348CD2197D941B0AEfd2e133d3591B26997c1 on chain ETHEREUM was liquidated. WETH 0.1639374988304341 was liquidated to cover USDT 256.977494 debt.'),
        (['onesignal-id-2'], 'Liquidation occured!', 'Your account 0x612348CD2197D941B0AEfd2e133d3591B26997c1 on chain ETHEREUM was liquidated. WETH 0.1639374988304341 was liquidated to cover USDT 256.977494 debt.'),
     ]
+
+
+def test_liquidation_async():
+    """Same as test_liquidation but for the non-blocking connector.
+    Both users get one grouped notification through the local OneSignal stand-in.
+    """
+    sent_notifications = []
+
+    with patch('backend.database.create_client', new=lambda x, y: object):
+      database = Database(
+        supabase_url='https://mocked.url',
+        supabase_key='mocked-key'
+      )
+
+    async def new_get_logs(*args, **kwargs):
+       return [
+          {
+            'address': '0xB3E147cCc3822c84f94719487C3031Fd24513F92',
+            'topics': [
+               HexBytes('0xe413a321e8681d831f4dbccbca790d2952b56f977908e45be37335533e005286'),
+               HexBytes('0x000000000000000000000000c02aaa39b223fe8d0a0e5c4f27ead9083c756cc2'),
+               HexBytes('0x000000000000000000000000dac17f958d2ee523a2206206994597c13d831ec7'),
+               HexBytes('0x000000000000000000000000612348cd2197d941b0aefd2e133d3591b26997c1'),
+            ],
+            'data': bytes.fromhex('000000000000000000000000000000000000000000000000000000000f512a5600000000000000000000000000000000000000000000000002466c495f276f3c000000000000000000000000b6569481dccddd527c2b0e8ba32f494e52224ca10000000000000000000000000000000000000000000000000000000000000000'),
+          },
+       ]
+
+    async def new_block_number():
+       return 10010
+
+    get_logs_patch = patch('web3.eth.async_eth.AsyncEth.get_logs', new=new_get_logs)
+    block_number_patch = patch('web3.eth.async_eth.AsyncEth.block_number', new=property(lambda self: new_block_number()))
+
+    async def new_contract_call(self: AsyncContractFunction, *args, **kwargs):
+        if self.fn_name == 'decimals':
+            if self.address == '0xC02aaA39b223FE8D0A0e5C4F27eAD9083C756Cc2':
+                return 18
+            else:
+                return 6
+        if self.fn_name == 'symbol':
+            if self.address == '0xC02aaA39b223FE8D0A0e5C4F27eAD9083C756Cc2':
+                return 'WETH'
+            else:
+                return 'USDT'
+
+    contract_call_patch = patch('web3.contract.async_contract.AsyncContractFunction.call', new=new_contract_call)
+
+    get_setting_patch = patch.object(database, 'get_setting', new=lambda setting_key: '10000' if setting_key.endswith('_CHECKED_BLOCK') else None)
+    is_tracked_patch = patch.object(database, 'is_tracked', new=lambda account: True)
+    get_users_for_notification_patch = patch.object(database, 'get_users_for_notification', new=lambda account: [('onesignal-id-1', 'user-id-1'), ('onesignal-id-2', 'user-id-2')])
+    disable_set_setting_patch = patch.object(database, 'set_setting', new=lambda key, value: None)
+
+    async def catchup_with_fake_onesignal():
+        async with FakeOneSignal() as onesignal:
+            dispatcher = NotificationDispatcher(app_id='app-id', app_key='app-key', api_url=onesignal.url)
+            connector = AsyncChainConnector(
+                chain=Chain.ETHEREUM,
+                http_rpc_url='https://it-is-mocked.anyway',
+                notifier=AsyncNotifier(database=database, dispatcher=dispatcher),
+                database=database,
+                pool_address='0xB3E147cCc3822c84f94719487C3031Fd24513F92',
+                aave_version=2,
+            )
+            await connector.catchup_on_liquidations()
+            await dispatcher.close()
+        sent_notifications.extend(onesignal.notifications)
+
+    with get_logs_patch, get_setting_patch, block_number_patch, is_tracked_patch, contract_call_patch, get_users_for_notification_patch, disable_set_setting_patch:
+      asyncio.run(catchup_with_fake_onesignal())
+
+    assert sent_notifications == [
+       (['onesignal-id-1', 'onesignal-id-2'], 'Liquidation occured!', 'Your account 0x612348CD2197D941B0AEfd2e133d3591B26997c1 on chain ETHEREUM was liquidated. WETH 0.1639374988304341 was liquidated to cover USDT 256.977494 debt.'),
+    ]
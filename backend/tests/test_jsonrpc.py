@@ -0,0 +1,131 @@
+import asyncio
+
+from aiohttp import web
+
+from backend.benchmarks.fakes import FakeChain, FakeLiquidationNotifier, FakeSettingsDatabase, make_liquidation_log
+from backend.connector import LIQUIDATION_TOPIC, AsyncChainConnector
+from backend.jsonrpc import JsonRpcBatcher
+from backend.rpc import close_sessions
+from backend.types import Chain
+
+V2_POOL_ADDRESS = '0x7d2768dE32b0b80b7a3454c06BdAc94A69DDc7A9'
+V3_POOL_ADDRESS = '0x87870Bca3F3fD6335C3F4ce8392D69350B4fA4E2'
+RESERVES = ['0x' + '0a' * 20, '0x' + '0b' * 20]
+USERS = ['0x' + '01' * 20, '0x' + '02' * 20]
+
+
+async def start_chain(chain: FakeChain) -> tuple[web.AppRunner, str]:
+    runner = web.AppRunner(chain.make_app())
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', 0).start()
+    return runner, f'http://127.0.0.1:{runner.addresses[0][1]}/'
+
+
+def test_v2_and_v3_catchups_share_rpc_calls():
+    logs = [
+        make_liquidation_log(V2_POOL_ADDRESS, 995, 0, RESERVES[0], RESERVES[1], USERS[0]),
+        make_liquidation_log(V3_POOL_ADDRESS, 996, 0, RESERVES[0], RESERVES[1], USERS[1]),
+    ]
+
+    async def run() -> tuple[FakeChain, list[FakeLiquidationNotifier]]:
+        chain = FakeChain(V3_POOL_ADDRESS, {}, RESERVES, logs, head_block=1000)
+        runner, url = await start_chain(chain)
+        database = FakeSettingsDatabase({'LAST_ETHEREUM_V2_CHECKED_BLOCK': '990', 'LAST_ETHEREUM_V3_CHECKED_BLOCK': '990'})
+        notifiers = [FakeLiquidationNotifier(), FakeLiquidationNotifier()]
+        connectors = [
+            AsyncChainConnector(
+                chain=Chain.ETHEREUM,
+                http_rpc_url=url,
+                notifier=notifier,  # type: ignore[arg-type]
+                database=database,  # type: ignore[arg-type]
+                pool_address=pool_address,
+                aave_version=aave_version,
+                batch_rpc=True,
+            )
+            for notifier, pool_address, aave_version in zip(notifiers, (V2_POOL_ADDRESS, V3_POOL_ADDRESS), (2, 3))
+        ]
+        chain.calls.clear()
+        await asyncio.gather(*(connector.catchup_on_liquidations() for connector in connectors))
+        await close_sessions()
+        await runner.cleanup()
+        return chain, notifiers
+
+    chain, notifiers = asyncio.run(run())
+
+    assert [notifier.liquidated for notifier in notifiers] == [[USERS[0]], [USERS[1]]]  # Every connector gets the logs of its pool only
+    assert chain.calls['eth_blockNumber'] == 1
+    assert chain.calls['eth_getLogs'] == 1
+
+
+def test_calls_are_sent_one_by_one_if_batches_are_not_supported():
+    async def run() -> tuple[FakeChain, list[int], int]:
+        chain = FakeChain(V3_POOL_ADDRESS, {}, RESERVES, [], head_block=1000, batches_supported=False)
+        runner, url = await start_chain(chain)
+        batcher = JsonRpcBatcher(Chain.ETHEREUM.name, url)
+        results = await asyncio.gather(batcher.request('eth_chainId', []), batcher.request('eth_blockNumber', []), batcher.request('eth_blockNumber', []))
+        block_number = await batcher.get_block_number()
+        await close_sessions()
+        await runner.cleanup()
+        return chain, [int(result, 16) for result in results], block_number
+
+    chain, results, block_number = asyncio.run(run())
+
+    assert results == [1, 1000, 1000]
+    assert block_number == 1000
+    assert chain.calls['eth_blockNumber'] == 2  # Identical calls of a batch are sent once
+
+
+def test_merged_logs_are_filtered_per_caller():
+    """The ranges overlap, so both calls are merged, but every caller gets only the logs of its own range and filters"""
+    def to_topic(address: str) -> str:
+        return '0x' + '00' * 12 + address[2:]
+
+    logs = [
+        make_liquidation_log(V2_POOL_ADDRESS, 992, 0, RESERVES[0], RESERVES[1], USERS[0]),
+        make_liquidation_log(V2_POOL_ADDRESS, 993, 0, RESERVES[0], RESERVES[1], USERS[1]),  # Another user
+        make_liquidation_log(V2_POOL_ADDRESS, 1003, 0, RESERVES[0], RESERVES[1], USERS[0]),  # After the range of the V2 caller
+        make_liquidation_log(V3_POOL_ADDRESS, 991, 0, RESERVES[0], RESERVES[1], USERS[0]),  # Before the range of the V3 caller
+        make_liquidation_log(V3_POOL_ADDRESS, 1001, 0, RESERVES[0], RESERVES[1], USERS[1]),
+    ]
+
+    async def run() -> tuple[FakeChain, list[list[int]]]:
+        chain = FakeChain(V3_POOL_ADDRESS, {}, RESERVES, logs, head_block=1010)
+        runner, url = await start_chain(chain)
+        batcher = JsonRpcBatcher(Chain.ETHEREUM.name, url)
+        results = await asyncio.gather(
+            batcher.get_logs({'fromBlock': 990, 'toBlock': 1000, 'address': V2_POOL_ADDRESS, 'topics': [LIQUIDATION_TOPIC, None, None, to_topic(USERS[0])]}),
+            batcher.get_logs({'fromBlock': 995, 'toBlock': 1005, 'address': V3_POOL_ADDRESS, 'topics': [LIQUIDATION_TOPIC]}),
+        )
+        await close_sessions()
+        await runner.cleanup()
+        return chain, [[log['blockNumber'] for log in result] for result in results]
+
+    chain, block_numbers = asyncio.run(run())
+
+    assert block_numbers == [[992], [1001]]
+    assert chain.calls['eth_getLogs'] == 1
+
+
+def test_requests_of_a_failed_merged_call_are_sent_on_their_own():
+    """The merged range is wider than the node allows, the range of every caller is not"""
+    logs = [
+        make_liquidation_log(V2_POOL_ADDRESS, 992, 0, RESERVES[0], RESERVES[1], USERS[0]),
+        make_liquidation_log(V3_POOL_ADDRESS, 1001, 0, RESERVES[0], RESERVES[1], USERS[1]),
+    ]
+
+    async def run() -> tuple[FakeChain, list[list[int]]]:
+        chain = FakeChain(V3_POOL_ADDRESS, {}, RESERVES, logs, head_block=1010, max_logs_range=11)
+        runner, url = await start_chain(chain)
+        batcher = JsonRpcBatcher(Chain.ETHEREUM.name, url)
+        results = await asyncio.gather(
+            batcher.get_logs({'fromBlock': 990, 'toBlock': 1000, 'address': V2_POOL_ADDRESS, 'topics': [LIQUIDATION_TOPIC]}),
+            batcher.get_logs({'fromBlock': 995, 'toBlock': 1005, 'address': V3_POOL_ADDRESS, 'topics': [LIQUIDATION_TOPIC]}),
+        )
+        await close_sessions()
+        await runner.cleanup()
+        return chain, [[log['blockNumber'] for log in result] for result in results]
+
+    chain, block_numbers = asyncio.run(run())
+
+    assert block_numbers == [[992], [1001]]
+    assert chain.calls['eth_getLogs'] == 3  # The merged call and the two requests on their own
@@ -0,0 +1,48 @@
+import asyncio
+import json
+import logging
+
+from backend.logqueue import JsonFormatter, RotatingLogFileHandler, log_context, start_log_writer
+
+
+def test_records_carry_their_context_and_are_sampled(tmp_path):
+    file_handler = logging.FileHandler(tmp_path / 'test.log')
+    file_handler.setFormatter(JsonFormatter())
+    logger = logging.getLogger('test_logqueue')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    listener = start_log_writer(logger, [file_handler])
+
+    async def sweep(chain: str) -> None:
+        with log_context(chain=chain, aave_version=3, sweep_id=7):
+            await asyncio.sleep(0)
+            for i in range(25):
+                logger.info('The liquidated address %s is not being tracked. Skipping.', f'0x{i}', extra={'sample_every': 10})
+
+    async def run() -> None:
+        await asyncio.gather(sweep('ETHEREUM'), sweep('POLYGON'))
+
+    asyncio.run(run())
+    logger.info('Done')
+    listener.stop()
+    file_handler.close()
+
+    records = [json.loads(line) for line in (tmp_path / 'test.log').read_text().splitlines()]
+    ethereum_records = [record for record in records if record.get('chain') == 'ETHEREUM']
+    assert [record['message'] for record in ethereum_records] == [f'The liquidated address 0x{i} is not being tracked. Skipping.' for i in (0, 10, 20)]
+    assert [record['suppressed'] for record in ethereum_records] == [0, 9, 9]
+    assert all(record['aave_version'] == 3 and record['sweep_id'] == 7 for record in ethereum_records)
+    assert len([record for record in records if record.get('chain') == 'POLYGON']) == 3  # Sampled per context
+    assert 'chain' not in records[-1] and records[-1]['message'] == 'Done'
+
+
+def test_log_file_is_rotated_by_age(tmp_path):
+    handler = RotatingLogFileHandler(str(tmp_path / 'backend.log'), max_bytes=10_000, rotation_period=0, backup_count=2)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    for message in ('first', 'second', 'third'):
+        handler.emit(logging.LogRecord('test', logging.INFO, __file__, 0, message, None, None))
+    handler.close()
+
+    assert (tmp_path / 'backend.log').read_text() == 'third\n'
+    assert (tmp_path / 'backend.log.1').read_text() == 'second\n'
+    assert (tmp_path / 'backend.log.2').read_text() == 'first\n'
@@ -0,0 +1,41 @@
+import asyncio
+
+from web3 import AsyncWeb3
+
+from backend.benchmarks.fakes import FakeRpcNode
+from backend.metrics import Histogram, render_metrics, rpc_metrics_middleware
+from backend.rpc import close_sessions
+from backend.rpc_pool import RpcPool
+
+
+def test_histogram_is_rendered_cumulatively(monkeypatch):
+    monkeypatch.setattr('backend.metrics._metrics', [])  # The test histogram is not served with the backend metrics
+    histogram = Histogram('test_latency_seconds', 'Test latency', buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.7, 3):
+        histogram.observe(value, chain='ETHEREUM')
+
+    assert histogram.render().splitlines() == [
+        '# HELP test_latency_seconds Test latency',
+        '# TYPE test_latency_seconds histogram',
+        'test_latency_seconds_bucket{chain="ETHEREUM",le="0.1"} 1',
+        'test_latency_seconds_bucket{chain="ETHEREUM",le="1"} 3',
+        'test_latency_seconds_bucket{chain="ETHEREUM",le="+Inf"} 4',
+        'test_latency_seconds_sum{chain="ETHEREUM"} 4.25',
+        'test_latency_seconds_count{chain="ETHEREUM"} 4',
+    ]
+
+
+def test_rpc_requests_are_counted():
+    async def run() -> None:
+        async with FakeRpcNode(1) as node:
+            web3 = AsyncWeb3(RpcPool([node.url]))
+            web3.middleware_onion.add(rpc_metrics_middleware('TEST_CHAIN'), 'metrics')
+            for _ in range(3):
+                await web3.eth.block_number
+            await close_sessions()
+
+    asyncio.run(run())
+
+    metrics = render_metrics()
+    assert 'backend_rpc_requests_total{chain="TEST_CHAIN",method="eth_blockNumber"} 3' in metrics
+    assert 'backend_rpc_request_seconds_count{chain="TEST_CHAIN",method="eth_blockNumber"} 3' in metrics
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from backend.notifier import AsyncNotifier
+from backend.types import Chain, ChainAccount, ChainAccountWithAllData
+
+
+class FakeDatabase():
+    def __init__(self, events: list[str]) -> None:
+        self.events = events
+
+    def set_last_health_factor_notifications(self, accounts: list[ChainAccountWithAllData], timestamp) -> None:
+        self.events.append(f'cooldown {",".join(account.user_id for account in accounts)}')
+
+
+class FakeDispatcher():
+    """Sends immediately. Notifications to the failing player ids are not delivered."""
+    def __init__(self, events: list[str], failing_player_ids: frozenset[str] = frozenset()) -> None:
+        self.events = events
+        self.failing_player_ids = failing_player_ids
+
+    async def submit(self, player_ids: list[str], title: str, message: str) -> asyncio.Future:
+        self.events.append(f'push {",".join(player_ids)}')
+        delivered = asyncio.get_running_loop().create_future()
+        delivered.set_result(not self.failing_player_ids.intersection(player_ids))
+        return delivered
+
+    async def join(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+
+def make_account(user_id: str, onesignal_id: str | None) -> ChainAccountWithAllData:
+    return ChainAccountWithAllData(ChainAccount('0x' + '01' * 20, Chain.ETHEREUM, 3), health_factor_threshold=1.2, user_id=user_id, onesignal_id=onesignal_id)
+
+
+def notify(notifier: AsyncNotifier, notifications: list[tuple[ChainAccountWithAllData, str]]) -> None:
+    async def run() -> None:
+        await notifier.notify_about_health_factors(notifications)
+        await notifier.close()
+
+    asyncio.run(run())
+
+
+def test_cooldowns_are_written_after_the_pushes():
+    events: list[str] = []
+    notifier = AsyncNotifier(database=FakeDatabase(events), dispatcher=FakeDispatcher(events))  # type: ignore[arg-type]
+
+    notify(notifier, [
+        (make_account('u1', 'onesignal-id-1'), 'Health factor is low.'),
+        (make_account('u2', None), 'Health factor is low.'),  # Can't be notified, so its cooldown is not written
+        (make_account('u3', 'onesignal-id-3'), 'Health factor is low.'),
+    ])
+
+    assert events == ['push onesignal-id-1', 'push onesignal-id-3', 'cooldown u1,u3']
+
+
+def test_accounts_whose_notification_failed_are_not_put_in_cooldown():
+    events: list[str] = []
+    notifier = AsyncNotifier(database=FakeDatabase(events), dispatcher=FakeDispatcher(events, failing_player_ids=frozenset({'onesignal-id-1'})))  # type: ignore[arg-type]
+
+    notify(notifier, [
+        (make_account('u1', 'onesignal-id-1'), 'Health factor is low.'),
+        (make_account('u3', 'onesignal-id-3'), 'Health factor is low.'),
+    ])
+
+    assert events == ['push onesignal-id-1', 'push onesignal-id-3', 'cooldown u3']
+
+
+def test_notifier_is_imported_without_onesignal_settings():
+    """The OneSignal app id and key are read when the clients are built, not when __main__ imports the notifier"""
+    env = {name: value for name, value in os.environ.items() if not name.startswith('ONESIGNAL_')}
+    subprocess.run([sys.executable, '-c', 'import backend.notifier'], env=env, cwd=Path(__file__).parents[2], check=True)
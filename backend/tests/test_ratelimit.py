@@ -0,0 +1,44 @@
+import asyncio
+
+from aiohttp import ClientResponseError
+
+from backend.metrics import RPC_RATE_LIMITED, RPC_THROTTLED, to_labels
+from backend.ratelimit import Priority, TokenBucket, call_with_quota, configure_rate_limits, get_bucket, rpc_priority
+
+
+def test_throttled_calls_are_served_by_priority():
+    async def run() -> list[Priority]:
+        bucket = TokenBucket('priorities.test', rate=1000)
+        served: list[Priority] = []
+
+        async def call(priority: Priority) -> None:
+            await bucket.acquire(100, priority)
+            served.append(priority)
+
+        await bucket.acquire(1000, Priority.SWEEP)  # Empties the bucket
+        await asyncio.gather(call(Priority.BACKFILL), call(Priority.SWEEP), call(Priority.LIQUIDATIONS), call(Priority.AT_RISK))
+        return served
+
+    assert asyncio.run(run()) == [Priority.LIQUIDATIONS, Priority.AT_RISK, Priority.SWEEP, Priority.BACKFILL]
+    assert RPC_THROTTLED.values[to_labels({'provider': 'priorities.test', 'priority': 'BACKFILL'})] == 1
+
+
+def test_rate_limited_calls_are_retried_at_a_lower_rate():
+    configure_rate_limits({'quota.test': 1000})
+    responses: list[Exception | str] = [ClientResponseError(None, (), status=429), 'result']  # type: ignore[arg-type]
+
+    async def send() -> str:
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    async def run() -> str:
+        with rpc_priority(Priority.LIQUIDATIONS):
+            return await call_with_quota('https://quota.test/v2/key', 26, send)
+
+    assert asyncio.run(run()) == 'result'
+    bucket = get_bucket('https://quota.test/v2/key')
+    assert bucket is not None and bucket.rate < 1000
+    assert RPC_RATE_LIMITED.values[to_labels({'provider': 'quota.test'})] == 1
+    configure_rate_limits({})
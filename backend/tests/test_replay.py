@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+from eth_abi import encode
+
+from backend.benchmarks.fakes import FakeChain, make_liquidation_log, make_pool_event_log
+from backend.benchmarks.replay import FixtureMeta, FixtureStore, record, replay
+from backend.types import Chain
+
+POOL_ADDRESS = '0x87870Bca3F3fD6335C3F4ce8392D69350B4fA4E2'
+RESERVES = ['0x' + '0a' * 20, '0x' + '0b' * 20]
+USERS = ['0x' + '01' * 20, '0x' + '02' * 20, '0x' + '03' * 20]
+
+
+def test_recorded_range_is_replayed_with_alert_latencies(tmp_path):
+    # USERS[0] is below the threshold from the start and liquidated at 1050, USERS[1] has no recorded debt and is liquidated at 1080
+    logs = [
+        make_liquidation_log(POOL_ADDRESS, 1050, 0, RESERVES[0], RESERVES[1], USERS[0]),
+        make_liquidation_log(POOL_ADDRESS, 1080, 0, RESERVES[0], RESERVES[1], USERS[1]),
+    ]
+    chain = FakeChain(POOL_ADDRESS, {USERS[0]: 1.05, USERS[2]: 2.0}, RESERVES, logs, head_block=2000)
+
+    async def record_chain() -> None:
+        runner = web.AppRunner(chain.make_app())
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', 0).start()
+        url = f'http://127.0.0.1:{runner.addresses[0][1]}/'
+        await record(FixtureStore(str(tmp_path)), url, Chain.ETHEREUM, 3, POOL_ADDRESS, 1000, 1100, step=10, accounts=[(USERS[2], 1.5)], threshold=1.1)
+        await runner.cleanup()
+
+    asyncio.run(record_chain())
+    store = FixtureStore(str(tmp_path))
+    assert len(store.load_meta().accounts) == 3
+    assert len(list(store.iter_account_data())) == 11
+
+    chain.calls.clear()
+    result = asyncio.run(replay(store, hf_check_interval=20, liquidation_check_interval=25))
+
+    assert sum(chain.calls.values()) == 0  # Nothing is sent to the recorded node
+    assert result['liquidated_accounts'] == 2
+    assert result['warned_before_liquidation'] == 1
+    assert result['median_warning_lead_blocks'] == 50
+    assert result['liquidation_alerts'] == 2
+    assert result['max_alert_delay_blocks'] == 20  # Liquidated at 1080, found by the catchup at 1100
+
+
+@pytest.mark.parametrize('scheduler, min_lead, max_lead', [('periodic', 0, 0), ('incremental', 50, 50), ('adaptive', 1, 49)])
+def test_schedulers_are_replayed_over_the_recorded_blocks(tmp_path, scheduler, min_lead, max_lead):
+    """USERS[0] borrows at 1100, which drops its health factor from 1.2 to 1.05, and is liquidated at 1150.
+    The periodic sweeps at 1075 and 1150 warn it only at the liquidation, the incremental watcher rechecks it on the
+    Borrow event and the adaptive scheduler checks it often enough as it is close to its threshold.
+    """
+    def account_data(health_factor: float) -> str:
+        return '0x' + encode(['uint256'] * 6, [10 ** 18, 10 ** 18, 0, 8000, 7500, int(health_factor * 10 ** 18)]).hex()
+
+    store = FixtureStore(str(tmp_path))
+    store.save_meta(FixtureMeta(Chain.ETHEREUM.value, 3, POOL_ADDRESS, 1000, 1200, 10, [(USERS[0], 1.1), (USERS[1], 1.1)]))
+    store.save_logs([make_liquidation_log(POOL_ADDRESS, 1150, 0, RESERVES[0], RESERVES[1], USERS[0])])
+    borrow_args = {'reserve': RESERVES[1], 'user': USERS[0], 'onBehalfOf': USERS[0], 'amount': 10 ** 18, 'interestRateMode': 2, 'borrowRate': 0, 'referralCode': 0}
+    store.save_position_logs([make_pool_event_log(POOL_ADDRESS, 3, 'Borrow', 1100, borrow_args)])
+    for block in range(1000, 1201, 10):
+        store.append_account_data(block, {USERS[0].lower(): account_data(1.2 if block < 1100 else 1.05), USERS[1].lower(): account_data(3.0)})
+
+    result = asyncio.run(replay(store, hf_check_interval=75, liquidation_check_interval=25, scheduler=scheduler))
+
+    assert result['liquidated_accounts'] == 1
+    assert result['warned_before_liquidation'] == 1
+    assert min_lead <= result['median_warning_lead_blocks'] <= max_lead
+    assert result['liquidation_alerts'] == 1
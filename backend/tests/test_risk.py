@@ -0,0 +1,42 @@
+import numpy as np
+
+from backend.connector import AsyncChainConnector
+from backend.risk import PositionModel, ReserveData, parse_reserve_configuration
+from backend.types import Chain, ChainAccount, ChainAccountWithAllData
+
+
+def test_accounts_near_threshold():
+    """Account 1 has 1000 USDC collateral and 0.5 WETH debt, account 2 has no debt, account 3 is unknown to the model.
+    After ETH price goes from 1000 to 1500, account 1 is predicted to be below its threshold of 1.2.
+    """
+    assert parse_reserve_configuration((6 << 48) | (8500 << 16) | 8000) == (0.85, 6)
+
+    connector = AsyncChainConnector(
+        chain=Chain.ETHEREUM,
+        http_rpc_url='https://it-is-mocked.anyway',
+        notifier=None,  # type: ignore[arg-type]
+        database=None,  # type: ignore[arg-type]
+        pool_address='0x87870Bca3F3fD6335C3F4ce8392D69350B4fA4E2',
+        aave_version=3,
+    )
+    model = PositionModel(connector)
+    model.reserves = [
+        ReserveData('0xUSDC', '0xaUSDC', '0xsUSDC', '0xvUSDC', liquidation_threshold=0.85, decimals=6),
+        ReserveData('0xWETH', '0xaWETH', '0xsWETH', '0xvWETH', liquidation_threshold=0.8, decimals=18),
+    ]
+    model.rows = {'0x01': 0, '0x02': 1}
+    model.collateral = np.array([[1000.0, 0], [0, 1]])
+    model.debt = np.array([[0, 0.5], [0, 0]])
+    model.prices = np.array([1.0, 1000.0])
+    model.ready = True
+
+    assert np.allclose(model.predict_health_factors(), [1.7, np.inf])
+
+    accounts = [
+        ChainAccountWithAllData(ChainAccount(address, Chain.ETHEREUM, 3), health_factor_threshold=1.2, user_id='user-id', onesignal_id=None)
+        for address in ('0x01', '0x02', '0x03')
+    ]
+    assert model.get_accounts_near_threshold(accounts) == [accounts[2]]
+
+    model.prices = np.array([1.0, 1500.0])
+    assert model.get_accounts_near_threshold(accounts) == [accounts[0], accounts[2]]
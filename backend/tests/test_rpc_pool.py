@@ -0,0 +1,58 @@
+import asyncio
+import time
+
+from web3 import AsyncWeb3
+
+from backend.benchmarks.fakes import FakeRpcNode
+from backend.rpc import close_sessions
+from backend.rpc_pool import MAX_CONSECUTIVE_FAILURES, RpcPool, load_rpc_urls
+from backend.types import Chain
+
+
+def test_failing_endpoint_is_failed_over_and_skipped():
+    async def run() -> tuple[list[int], FakeRpcNode]:
+        async with FakeRpcNode(1, status=503) as broken, FakeRpcNode(2) as healthy:
+            web3 = AsyncWeb3(RpcPool([broken.url, healthy.url]))
+            block_numbers = [await web3.eth.block_number for _ in range(MAX_CONSECUTIVE_FAILURES + 5)]
+            await close_sessions()
+        return block_numbers, broken
+
+    block_numbers, broken = asyncio.run(run())
+
+    assert block_numbers == [2] * (MAX_CONSECUTIVE_FAILURES + 5)
+    assert broken.requests_count == MAX_CONSECUTIVE_FAILURES  # Skipped after that
+
+
+def test_slow_request_is_hedged():
+    async def run() -> tuple[int, float]:
+        async with FakeRpcNode(1, delay=10) as stalled, FakeRpcNode(2) as healthy:
+            pool = RpcPool([stalled.url, healthy.url])
+            start = time.monotonic()
+            block_number = await AsyncWeb3(pool).eth.block_number
+            elapsed = time.monotonic() - start
+            await close_sessions()
+        return block_number, elapsed
+
+    block_number, elapsed = asyncio.run(run())
+
+    assert block_number == 2
+    assert elapsed < 5  # Hedged after the default delay instead of waiting for the stalled endpoint
+
+
+def test_logs_are_not_requested_from_an_endpoint_behind_the_range():
+    async def run() -> tuple[FakeRpcNode, FakeRpcNode]:
+        async with FakeRpcNode(990) as behind, FakeRpcNode(1000) as synced:
+            web3 = AsyncWeb3(RpcPool([behind.url, synced.url]))
+            assert await web3.eth.get_logs({'fromBlock': 995, 'toBlock': 1000}) == []
+            await close_sessions()
+        return behind, synced
+
+    behind, synced = asyncio.run(run())
+
+    assert behind.methods == ['eth_blockNumber']  # Asked for its head first, then skipped
+    assert synced.methods[-1] == 'eth_getLogs'
+
+
+def test_public_node_is_opt_in():
+    assert load_rpc_urls(Chain.ETHEREUM, 'https://a.example, https://b.example') == ['https://a.example', 'https://b.example']
+    assert load_rpc_urls(Chain.ETHEREUM, 'https://a.example', include_public_node=True) == ['https://a.example', 'https://eth.llamarpc.com']
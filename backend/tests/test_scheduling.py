@@ -0,0 +1,150 @@
+import asyncio
+
+from backend.scheduling import MAX_CHECK_INTERVAL, MIN_CHECK_INTERVAL, STALE_RECORD_AGE, AdaptiveScheduler, HealthFactorRecord, HealthFactorStore, get_check_interval
+from backend.sharding import LocalLeaseStore, ShardOwnership
+from backend.types import Chain, ChainAccount, ChainAccountWithAllData
+
+HEALTH_FACTORS = {'0x01': 1.12, '0x02': 5.0, '0x03': -1}  # Risky, safe and without debt
+
+
+class FakeClock():
+    def __init__(self) -> None:
+        self.now = 1_700_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+class FakeDatabase():
+    def __init__(self) -> None:
+        self.rows: dict[str, dict] = {}  # address -> health_factor row
+        self.upserted: list[str] = []
+
+    def get_health_factor_rows(self, chain: Chain, aave_version: int, min_address: str | None = None, max_address: str | None = None) -> list[dict]:
+        return [row for address, row in self.rows.items() if (min_address is None or address >= min_address) and (max_address is None or address < max_address)]
+
+    def upsert_health_factor_rows(self, chain: Chain, aave_version: int, rows: list[dict]) -> None:
+        self.rows.update({row['address']: row for row in rows})
+        self.upserted += [row['address'] for row in rows]
+
+    def delete_health_factor_rows(self, chain: Chain, aave_version: int, addresses: list[str], checked_before: float) -> None:
+        for address in addresses:
+            if self.rows[address]['checked_at'] < checked_before:
+                del self.rows[address]
+
+
+class FakeConnector():
+    def __init__(self, clock: FakeClock) -> None:
+        self.chain = Chain.ETHEREUM
+        self.aave_version = 3
+        self.shards = None
+        self.clock = clock
+        self.checked: list[str] = []
+
+    async def load_accounts_for_hf_check(self) -> list[ChainAccountWithAllData]:
+        return [
+            ChainAccountWithAllData(ChainAccount(address, Chain.ETHEREUM, 3), user_id='user', health_factor_threshold=1.1, onesignal_id=None)
+            for address in HEALTH_FACTORS
+        ]
+
+    async def check_accounts(self, accounts: list[ChainAccountWithAllData], store: HealthFactorStore | None = None) -> list[ChainAccountWithAllData]:
+        self.checked.extend(account.account.address for account in accounts)
+        assert store is not None
+        store.update(accounts, [HEALTH_FACTORS[account.account.address] for account in accounts], self.clock.time())
+        return []
+
+
+def test_check_interval_follows_risk():
+    now = 0
+    assert get_check_interval(HealthFactorRecord(1.05, now, 0.1), threshold=1.1) == MIN_CHECK_INTERVAL
+    assert MIN_CHECK_INTERVAL < get_check_interval(HealthFactorRecord(1.15, now, 0.1), threshold=1.1) < get_check_interval(HealthFactorRecord(1.5, now, 0.1), threshold=1.1)
+    assert get_check_interval(HealthFactorRecord(1.5, now, 1.0), threshold=1.1) < get_check_interval(HealthFactorRecord(1.5, now, 0.1), threshold=1.1)
+    assert get_check_interval(HealthFactorRecord(50, now, 0.1), threshold=1.1) == MAX_CHECK_INTERVAL
+    assert get_check_interval(HealthFactorRecord(-1, now, 0.1), threshold=1.1) == MAX_CHECK_INTERVAL
+
+
+def test_risky_accounts_are_checked_more_often_and_survive_restarts(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr('backend.scheduling.time', clock)
+    database = FakeDatabase()
+    store = HealthFactorStore(database, Chain.ETHEREUM, 3)  # type: ignore[arg-type]
+    connector = FakeConnector(clock)
+    scheduler = AdaptiveScheduler(connector, store)  # type: ignore[arg-type]
+
+    async def run_for(seconds: float) -> None:
+        end = clock.now + seconds
+        while clock.now < end:
+            await scheduler.check_due_accounts()
+            clock.now += MIN_CHECK_INTERVAL
+
+    asyncio.run(scheduler.reload_accounts())
+    asyncio.run(run_for(MAX_CHECK_INTERVAL - MIN_CHECK_INTERVAL))
+    assert connector.checked.count('0x02') == connector.checked.count('0x03') == 1
+    assert connector.checked.count('0x01') > 10
+
+    # After a restart the accounts are not all due at once
+    store.save()
+    restarted_store = HealthFactorStore(database, Chain.ETHEREUM, 3)  # type: ignore[arg-type]
+    restarted = FakeConnector(clock)
+    scheduler = AdaptiveScheduler(restarted, restarted_store)  # type: ignore[arg-type]
+    asyncio.run(scheduler.reload_accounts())
+    assert restarted_store.get('0x02') == store.get('0x02')
+    asyncio.run(scheduler.check_due_accounts())
+    assert '0x02' not in restarted.checked and '0x03' not in restarted.checked
+
+
+def test_store_writes_only_changed_records(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr('backend.scheduling.time', clock)
+    database = FakeDatabase()
+    store = HealthFactorStore(database, Chain.ETHEREUM, 3)  # type: ignore[arg-type]
+    accounts = [ChainAccountWithAllData(ChainAccount(address, Chain.ETHEREUM, 3), user_id='user', health_factor_threshold=1.1, onesignal_id=None) for address in HEALTH_FACTORS]
+
+    store.update(accounts, list(HEALTH_FACTORS.values()), clock.now)
+    store.save()
+    assert sorted(database.upserted) == ['0x01', '0x02', '0x03']
+
+    database.upserted = []
+    clock.now += 60
+    store.update(accounts[:1], [1.11], clock.now)
+    store.save()  # 0x02 and 0x03 were not checked, for example because they are in their notification cooldown
+    assert database.upserted == ['0x01']
+    assert sorted(database.rows) == ['0x01', '0x02', '0x03']
+    assert database.rows['0x01']['health_factor'] == 1.11
+
+    # Rows that nobody updated for a long time are of accounts that are not tracked anymore
+    clock.now += STALE_RECORD_AGE
+    store.update(accounts[:2], [1.11, 5.0], clock.now)
+    store.save()
+    assert sorted(database.rows) == ['0x01', '0x02']
+
+
+def test_workers_load_and_delete_only_their_shards(monkeypatch, tmp_path):
+    clock = FakeClock()
+    monkeypatch.setattr('backend.scheduling.time', clock)
+    lease_store = LocalLeaseStore(str(tmp_path / 'leases.json'))
+    workers = [ShardOwnership(lease_store, worker_index=i, workers_count=2, pools=[(Chain.ETHEREUM, 3)], address_ranges=2) for i in range(2)]
+    for worker in workers:
+        worker.renew()
+    addresses = ['0x1000000000000000000000000000000000000000', '0x9000000000000000000000000000000000000000']  # In the shards of worker 0 and worker 1
+    accounts = [ChainAccountWithAllData(ChainAccount(address, Chain.ETHEREUM, 3), user_id='user', health_factor_threshold=1.1, onesignal_id=None) for address in addresses]
+    database = FakeDatabase()
+    database.upsert_health_factor_rows(Chain.ETHEREUM, 3, [
+        {'address': address, 'health_factor': 2.0, 'checked_at': clock.now - STALE_RECORD_AGE - 60, 'volatility': 0.1}
+        for address in addresses
+    ])
+
+    stores = [HealthFactorStore(database, Chain.ETHEREUM, 3, worker) for worker in workers]  # type: ignore[arg-type]
+    for store in stores:
+        store.load()
+    assert list(stores[0].records) == addresses[:1] and list(stores[1].records) == addresses[1:]
+
+    # Worker 1 refreshes its account while worker 0 deletes its stale row without touching the other one
+    stores[1].update(accounts[1:], [1.5], clock.now)
+    for store in stores:
+        store.save()
+    assert list(database.rows) == addresses[1:]
+    assert database.rows[addresses[1]]['health_factor'] == 1.5
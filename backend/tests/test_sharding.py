@@ -0,0 +1,53 @@
+from backend.sharding import LocalLeaseStore, ShardOwnership, get_address_range, worker_lease_key
+from backend.types import Chain
+
+POOLS = [(Chain.ETHEREUM, 2), (Chain.ETHEREUM, 3), (Chain.POLYGON, 3)]
+
+
+def test_address_ranges_are_even():
+    assert get_address_range('0x0000000000000000000000000000000000000001', 4) == 0
+    assert get_address_range('0x4000000000000000000000000000000000000000', 4) == 1
+    assert get_address_range('0xFFFFFFFF00000000000000000000000000000000', 4) == 3
+
+
+def test_shards_are_split_and_taken_over(tmp_path):
+    store = LocalLeaseStore(str(tmp_path / 'leases.json'))
+    workers = [ShardOwnership(store, worker_index=i, workers_count=2, pools=POOLS, address_ranges=2) for i in range(2)]
+    for worker in workers:
+        worker.renew()
+
+    owned = [{shard for shard in worker.shards if worker.owns(shard)} for worker in workers]
+    assert len(owned[0]) == len(owned[1]) == 3
+    assert owned[0].isdisjoint(owned[1])
+
+    # Worker 1 is down: its leases expire and worker 0 takes over its shards after the grace period
+    for key in [worker_lease_key(1)] + [shard.lease_key() for shard in owned[1]]:
+        store.update(key, workers[1].owner, 0, only_if_available=False)
+    workers[0].started_at -= 3600
+    workers[0].renew()
+    assert all(workers[0].owns(shard) for shard in workers[0].shards)
+    assert workers[0].owns_liquidations(Chain.POLYGON, 3)
+
+    # Worker 1 is back: worker 0 hands the leases of its shards over, worker 1 claims them on its next renewal
+    workers[1] = ShardOwnership(store, worker_index=1, workers_count=2, pools=POOLS, address_ranges=2)
+    workers[1].renew()
+    assert not any(workers[1].owns(shard) for shard in owned[1])
+    assert workers[1].awaiting_handover
+    workers[0].renew()
+    assert all(store.get_owner(shard.lease_key()) == workers[1].owner for shard in owned[1])  # Never free for another worker
+    workers[1].renew()
+    assert not workers[1].awaiting_handover
+    assert {shard for shard in workers[1].shards if workers[1].owns(shard)} == owned[1]
+    assert {shard for shard in workers[0].shards if workers[0].owns(shard)} == owned[0]
+
+
+def test_release_keeps_a_lease_taken_by_another_worker(tmp_path):
+    store = LocalLeaseStore(str(tmp_path / 'leases.json'))
+    assert store.try_acquire('lease', 'worker-0', 90)
+    store.update('lease', 'worker-0', 0, only_if_available=False)  # Expired
+    assert store.try_acquire('lease', 'worker-1', 90)
+
+    assert not store.release('lease', 'worker-0')
+    assert store.get_owner('lease') == 'worker-1'
+    assert store.release('lease', 'worker-1', 'worker-2', 90)
+    assert store.get_owner('lease') == 'worker-2'
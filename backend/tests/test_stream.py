@@ -0,0 +1,121 @@
+import asyncio
+from typing import Callable
+
+from aiohttp import web
+
+from backend.benchmarks.fakes import FakeChain, FakeLiquidationNotifier, FakeSettingsDatabase, make_liquidation_log
+from backend.connector import AsyncChainConnector
+from backend.rpc import close_sessions
+from backend.types import Chain
+
+POOL_ADDRESS = '0x87870Bca3F3fD6335C3F4ce8392D69350B4fA4E2'
+RESERVES = ['0x' + '0a' * 20, '0x' + '0b' * 20]
+USERS = ['0x' + '01' * 20, '0x' + '02' * 20, '0x' + '03' * 20]
+
+
+async def wait_until(condition: Callable[[], bool]) -> None:
+    for _ in range(500):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise TimeoutError
+
+
+def liquidation(block_number: int, user: str) -> dict:
+    return make_liquidation_log(POOL_ADDRESS, block_number, 0, RESERVES[0], RESERVES[1], user)
+
+
+def test_streamed_liquidations_are_gap_filled_and_deduplicated(monkeypatch):
+    monkeypatch.setattr('backend.stream.MIN_RECONNECT_DELAY', 0)
+
+    async def run() -> tuple[list[str], dict[str, str]]:
+        chain = FakeChain(POOL_ADDRESS, {}, RESERVES, [liquidation(995, USERS[0])], head_block=1000)
+        runner = web.AppRunner(chain.make_app())
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', 0).start()
+        url = f'http://127.0.0.1:{runner.addresses[0][1]}/'
+
+        notifier = FakeLiquidationNotifier()
+        database = FakeSettingsDatabase({'LAST_ETHEREUM_V3_CHECKED_BLOCK': '990'})
+        connector = AsyncChainConnector(
+            chain=Chain.ETHEREUM,
+            http_rpc_url=url,
+            notifier=notifier,  # type: ignore[arg-type]
+            database=database,  # type: ignore[arg-type]
+            pool_address=POOL_ADDRESS,
+            aave_version=3,
+            ws_rpc_url=url + 'ws',
+        )
+        task = asyncio.create_task(connector.monitor_liquidations())
+
+        # The liquidation mined before the start is found by the gap-fill
+        await wait_until(lambda: len(notifier.liquidated) == 1 and len(chain.subscriptions) == 1)
+        # A log delivered twice is processed once
+        await chain.mine_log(liquidation(1001, USERS[1]))
+        await chain.mine_log(liquidation(1001, USERS[1]))
+        await wait_until(lambda: len(notifier.liquidated) == 2)
+
+        # A liquidation mined while disconnected is gap-filled after the reconnection. The streamed one is not repeated.
+        await chain.drop_subscriptions()
+        chain.logs.append(liquidation(1002, USERS[2]))
+        chain.head_block = 1003
+        await wait_until(lambda: len(notifier.liquidated) == 3)
+        await asyncio.sleep(0.1)
+
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await close_sessions()
+        await runner.cleanup()
+        return notifier.liquidated, database.settings
+
+    liquidated, settings = asyncio.run(run())
+
+    assert liquidated == USERS
+    assert settings['LAST_ETHEREUM_V3_CHECKED_BLOCK'] == '1002'
+
+
+def test_streamed_liquidation_is_not_alerted_again_after_a_restart():
+    """The stream handled the first log of block 1001 and the process stopped. After the restart the gap-fill starts
+    at 1001 again, it skips that log but not the second log of the block.
+    """
+    def make_connector(url: str, notifier: FakeLiquidationNotifier, database: FakeSettingsDatabase) -> AsyncChainConnector:
+        return AsyncChainConnector(
+            chain=Chain.ETHEREUM,
+            http_rpc_url=url,
+            notifier=notifier,  # type: ignore[arg-type]
+            database=database,  # type: ignore[arg-type]
+            pool_address=POOL_ADDRESS,
+            aave_version=3,
+            ws_rpc_url=url + 'ws',
+        )
+
+    async def run() -> tuple[list[str], list[str], dict[str, str]]:
+        chain = FakeChain(POOL_ADDRESS, {}, RESERVES, [], head_block=1000)
+        runner = web.AppRunner(chain.make_app())
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', 0).start()
+        url = f'http://127.0.0.1:{runner.addresses[0][1]}/'
+        database = FakeSettingsDatabase({'LAST_ETHEREUM_V3_CHECKED_BLOCK': '999'})
+
+        notifier = FakeLiquidationNotifier()
+        task = asyncio.create_task(make_connector(url, notifier, database).monitor_liquidations())
+        await wait_until(lambda: len(chain.subscriptions) == 1)
+        await chain.mine_log(liquidation(1001, USERS[0]))
+        await wait_until(lambda: len(notifier.liquidated) == 1)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+        chain.logs.append(make_liquidation_log(POOL_ADDRESS, 1001, 1, RESERVES[0], RESERVES[1], USERS[1]))
+        chain.head_block = 1003
+        restarted_notifier = FakeLiquidationNotifier()
+        await make_connector(url, restarted_notifier, database).catchup_on_liquidations()
+        await close_sessions()
+        await runner.cleanup()
+        return notifier.liquidated, restarted_notifier.liquidated, database.settings
+
+    liquidated, liquidated_after_restart, settings = asyncio.run(run())
+
+    assert liquidated == [USERS[0]]
+    assert liquidated_after_restart == [USERS[1]]
+    assert settings['LAST_ETHEREUM_V3_STREAMED_LIQUIDATION'] == '1001:0'
+    assert settings['LAST_ETHEREUM_V3_CHECKED_BLOCK'] == '1002'
@@ -0,0 +1,72 @@
+import asyncio
+
+from eth_abi import encode
+from eth_utils import is_checksum_address
+
+from backend.codec import DECIMALS_SELECTOR, SYMBOL_SELECTOR
+from backend.tokens import TokenMetadata, TokenMetadataCache
+from backend.types import Chain
+
+TOKENS = ['0x' + '0a' * 20, '0x' + '0B' * 20]
+
+
+class FakeDatabase():
+    def __init__(self) -> None:
+        self.settings: dict[str, str] = {}
+
+    def get_setting(self, key: str) -> str | None:
+        return self.settings.get(key)
+
+    def set_setting(self, key: str, value: str) -> None:
+        self.settings[key] = value
+
+
+class FakeBatcher():
+    """Every token is 'TKN' with 18 decimals. Calls wait for `release` if it is set."""
+    def __init__(self, release: asyncio.Event | None = None) -> None:
+        self.release = release
+        self.calls: list[tuple[str, bytes]] = []
+
+    async def aggregate(self, calls: list[tuple[str, bytes]]) -> list[bytes | None]:
+        self.calls += calls
+        if self.release is not None:
+            await self.release.wait()
+        return [encode(['string'], ['TKN']) if data == SYMBOL_SELECTOR else encode(['uint8'], [18]) if data == DECIMALS_SELECTOR else None for _, data in calls]
+
+
+def test_missing_tokens_are_queried_once_and_saved():
+    database = FakeDatabase()
+    cache = TokenMetadataCache(database)  # type: ignore[arg-type]
+    batcher = FakeBatcher()
+
+    async def run() -> list[dict[str, TokenMetadata]]:
+        return [await cache.get(Chain.ETHEREUM, TOKENS, batcher), await cache.get(Chain.ETHEREUM, [TOKENS[1]], batcher)]  # type: ignore[arg-type]
+
+    first, second = asyncio.run(run())
+
+    assert first == {TOKENS[0]: TokenMetadata('TKN', 18), TOKENS[1].lower(): TokenMetadata('TKN', 18)}
+    assert second == {TOKENS[1].lower(): TokenMetadata('TKN', 18)}
+    assert len(batcher.calls) == 4  # Symbol and decimals of both tokens, the second lookup is a hit
+    assert all(is_checksum_address(target) for target, _ in batcher.calls)  # web3 refuses the others in the multicall
+
+    # A restarted backend loads the saved metadata instead of querying it
+    restarted_batcher = FakeBatcher()
+    restarted = asyncio.run(TokenMetadataCache(database).get(Chain.ETHEREUM, TOKENS, restarted_batcher))  # type: ignore[arg-type]
+    assert restarted == first
+    assert restarted_batcher.calls == []
+
+
+def test_slow_chain_does_not_block_other_chains():
+    cache = TokenMetadataCache(FakeDatabase())  # type: ignore[arg-type]
+
+    async def run() -> dict[str, TokenMetadata]:
+        stalled = FakeBatcher(release=asyncio.Event())
+        stalled_lookup = asyncio.create_task(cache.get(Chain.POLYGON, TOKENS, stalled))  # type: ignore[arg-type]
+        await asyncio.sleep(0.01)
+        tokens = await asyncio.wait_for(cache.get(Chain.ETHEREUM, TOKENS, FakeBatcher()), 1)  # type: ignore[arg-type]
+        assert stalled.release is not None
+        stalled.release.set()
+        await stalled_lookup
+        return tokens
+
+    assert len(asyncio.run(run())) == 2
@@ -0,0 +1,71 @@
+import asyncio
+import json
+import logging
+from typing import NamedTuple
+
+from eth_utils import to_checksum_address
+
+from backend.batching import MulticallBatcher
+from backend.codec import DECIMALS_SELECTOR, SYMBOL_SELECTOR, decode_string, decode_uint256
+from backend.database import Database
+from backend.types import Chain
+
+
+class TokenMetadata(NamedTuple):
+    symbol: str
+    decimals: int
+
+
+def token_metadata_setting_key(chain: Chain) -> str:
+    return f'TOKEN_METADATA_{chain.name}'
+
+
+class TokenMetadataCache():
+    """Symbols and decimals of ERC-20 tokens by (chain, token address), shared by all connectors.
+    Missing tokens are queried in one multicall. Every chain's cache is saved to the setting table, so restarts are warm.
+    Every chain has its own lock, so a slow RPC of one chain doesn't delay the lookups on the others.
+    """
+    def __init__(self, database: Database) -> None:
+        self.database = database
+        self.tokens: dict[Chain, dict[str, TokenMetadata]] = {}  # chain -> lowercase token address -> metadata
+        self.locks: dict[Chain, asyncio.Lock] = {}
+
+    def load(self, chain: Chain) -> dict[str, TokenMetadata]:
+        raw_tokens = self.database.get_setting(token_metadata_setting_key(chain))
+        tokens = {}
+        if raw_tokens is not None:
+            tokens = {address: TokenMetadata(symbol, decimals) for address, (symbol, decimals) in json.loads(raw_tokens).items()}
+        logging.info('Loaded metadata of %d tokens on %s', len(tokens), chain.name)
+        return tokens
+
+    def save(self, chain: Chain) -> None:
+        raw_tokens = json.dumps({address: list(metadata) for address, metadata in self.tokens[chain].items()})
+        self.database.set_setting(token_metadata_setting_key(chain), raw_tokens)
+
+    async def get(self, chain: Chain, addresses: list[str], batcher: MulticallBatcher) -> dict[str, TokenMetadata]:
+        """Get metadata of the tokens on the chain. Returns lowercase token address -> metadata."""
+        async with self.locks.setdefault(chain, asyncio.Lock()):
+            if chain not in self.tokens:
+                self.tokens[chain] = await asyncio.to_thread(self.load, chain)
+
+            tokens = self.tokens[chain]
+            missing = list({address.lower() for address in addresses if address.lower() not in tokens})
+            if len(missing) > 0:
+                await self.query(chain, missing, batcher)
+                await asyncio.to_thread(self.save, chain)
+
+        return {address.lower(): tokens[address.lower()] for address in addresses if address.lower() in tokens}
+
+    async def query(self, chain: Chain, addresses: list[str], batcher: MulticallBatcher) -> None:
+        calls = []
+        for address in addresses:  # web3 encodes only checksum addresses into the multicall
+            calls.append((to_checksum_address(address), SYMBOL_SELECTOR))
+            calls.append((to_checksum_address(address), DECIMALS_SELECTOR))
+        results = await batcher.aggregate(calls)
+
+        for i, address in enumerate(addresses):
+            symbol_result, decimals_result = results[2 * i], results[2 * i + 1]
+            if symbol_result is None or decimals_result is None:
+                logging.warning('Could not query metadata of the token %s on %s', address, chain.name)
+                continue
+            self.tokens[chain][address] = TokenMetadata(symbol=decode_string(symbol_result), decimals=decode_uint256(decimals_result))
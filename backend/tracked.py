@@ -0,0 +1,44 @@
+import asyncio
+import logging
+import time
+
+from backend.database import Database
+from backend.types import Chain, ChainAccount
+
+TRACKED_INDEX_REFRESH_PERIOD = 60  # seconds
+USER_TOPIC_FILTER_LIMIT = 100  # If fewer addresses are tracked on a pool, liquidation logs are filtered by the user topic
+
+TrackedKey = tuple[str, Chain, int]  # (lowercase address, chain, aave version)
+
+
+def to_tracked_key(account: ChainAccount) -> TrackedKey:
+    return (account.address.lower(), account.chain, account.aave_version)
+
+
+class TrackedAccountsIndex():
+    """In-memory set of all tracked accounts, so liquidation logs can be filtered without querying the database.
+    It is reloaded from the account table when it is older than TRACKED_INDEX_REFRESH_PERIOD.
+    """
+    def __init__(self, database: Database) -> None:
+        self.database = database
+        self.keys: set[TrackedKey] = set()
+        self.loaded_at: float | None = None
+        self.lock = asyncio.Lock()
+
+    def load(self) -> None:
+        accounts = self.database.get_tracked_accounts()
+        self.keys = {to_tracked_key(account) for account in accounts}
+        self.loaded_at = time.monotonic()
+        logging.info('Loaded %d tracked accounts into the index', len(self.keys))
+
+    async def refresh_if_stale(self) -> None:
+        async with self.lock:  # All connectors share the index, only one of them reloads it
+            if self.loaded_at is None or time.monotonic() - self.loaded_at >= TRACKED_INDEX_REFRESH_PERIOD:
+                await asyncio.to_thread(self.load)
+
+    def is_tracked(self, account: ChainAccount) -> bool:
+        return to_tracked_key(account) in self.keys
+
+    def get_addresses(self, chain: Chain, aave_version: int) -> list[str]:
+        """Lowercase addresses tracked on the given pool"""
+        return [address for address, key_chain, key_aave_version in self.keys if key_chain == chain and key_aave_version == aave_version]